@@ -1,15 +1,42 @@
 #!/usr/bin/env python
 """test_walkdir - unittests for the walkdir module"""
 import unittest2 as unittest
+import fnmatch
 import os.path
 from collections import namedtuple
 from tempfile import mkdtemp
 from shutil import rmtree
 from copy import deepcopy
+from itertools import chain, islice
+import pickle
+import random
+import re
+import threading
+import walkdir
+
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
 
 from walkdir import (include_dirs, exclude_dirs, include_files, exclude_files,
-                     limit_depth, min_depth, handle_symlink_loops,
-                     filtered_walk, all_paths, dir_paths, file_paths,
+                     exclude_ignored, attach_stat, filter_stat,
+                     WalkStats, limit_depth, min_depth, subtree_roots,
+                     handle_symlink_loops, VisitedDirs, sort_walk,
+                     limit_walk, WalkCursor,
+                     merge_sorted_paths,
+                     filtered_walk, scandir_walk, WalkEntry, BytesWalkEntry,
+                     WalkTriple,
+                     parallel_walk, sharded_walk, breadth_first_walk,
+                     best_first_walk,
+                     async_filtered_walk, async_all_paths, async_dir_paths,
+                     async_file_paths, DirCache, cached_walk, cache_changes,
+                     snapshot_entries, write_snapshot, read_snapshot,
+                     diff_snapshots,
+                     all_paths, dir_paths, file_paths,
+                     batched_all_paths, batched_dir_paths, batched_file_paths,
+                     top_files, sample_files, find_duplicates, DuplicateStats,
+                     search_files, disk_usage, DiskUsage,
                      iter_paths, iter_dir_paths, iter_file_paths)
 
 expected_files = "file1.txt file2.txt other.txt".split()
@@ -291,6 +318,9 @@ class _BaseWalkTestCase(unittest.TestCase):
     def assertFilesEqual(self, dir_entry, expected):
         self.assertEqual(expected, dir_entry[2])
 
+    def walk_root(self):
+        return 'root'
+
 
 class _BaseNamedTestCase(unittest.TestCase):
     def walk(self):
@@ -330,6 +360,9 @@ class _BaseFileSystemWalkTestCase(_BaseWalkTestCase):
     def filtered_walk(self, *args, **kwds):
         return filtered_walk(self.root_folder, *args, **kwds)
 
+    def walk_root(self):
+        return self.root_folder
+
     def assertWalkEqual(self, expected, walk_iter):
         expected = [SortedWalkedDir(os.path.join(self.test_folder, folder[0]), folder[1], folder[2])
                     for folder in expected]
@@ -361,6 +394,39 @@ class _BaseFileSystemFWalkTestCase(_BaseFileSystemWalkTestCase):
         self.assertEqual(sorted(expected), sorted(result))
 
 
+@unittest.skipIf(not hasattr(os, "scandir"),
+                 "No os.scandir")
+class _BaseFileSystemScandirWalkTestCase(_BaseFileSystemWalkTestCase):
+
+    def walk(self, followlinks=False):
+        return scandir_walk(self.root_folder, followlinks=followlinks)
+
+    def filtered_walk(self, *args, **kwds):
+        return filtered_walk(scandir_walk(self.root_folder), *args, **kwds)
+
+
+@unittest.skipIf(not hasattr(os, "scandir"),
+                 "No os.scandir")
+class _BaseFileSystemParallelWalkTestCase(_BaseFileSystemWalkTestCase):
+
+    def walk(self, followlinks=False):
+        return parallel_walk(self.root_folder, workers=4, followlinks=followlinks)
+
+    def filtered_walk(self, *args, **kwds):
+        return filtered_walk(self.walk(), *args, **kwds)
+
+
+@unittest.skipIf(not hasattr(os, "scandir"),
+                 "No os.scandir")
+class _BaseFileSystemBreadthFirstWalkTestCase(_BaseFileSystemWalkTestCase):
+
+    def walk(self, followlinks=False):
+        return breadth_first_walk(self.root_folder, followlinks=followlinks)
+
+    def filtered_walk(self, *args, **kwds):
+        return filtered_walk(self.walk(), *args, **kwds)
+
+
 class NoFilesystemTestCase(_BaseWalkTestCase):
 
     # Sanity check on the test data generator
@@ -423,12 +489,97 @@ class NoFilesystemTestCase(_BaseWalkTestCase):
         for dir_entry in walk_iter:
             self.assertFilesEqual(dir_entry, ['file1.txt'])
 
+    def test_include_path_patterns(self):
+        # Subdirectories that can't contain a match are never visited
+        expected = [
+            ('root', ['subdir1'], []),
+            ('root/subdir1', [], expected_files),
+        ]
+        self.assertWalkEqual(expected, include_files(self.walk(), 'subdir1/*.txt'))
+        self.assertWalkEqual(expected, include_files(self.walk(), '/subdir1/*'))
+        walk_iter = include_files(self.walk(), '**/other/file1.txt')
+        for dir_entry in walk_iter:
+            if os.path.basename(dir_entry[0]) == 'other':
+                self.assertFilesEqual(dir_entry, ['file1.txt'])
+            else:
+                self.assertFilesEqual(dir_entry, [])
+        # Name patterns still apply everywhere, so nothing is pruned
+        walk_iter = include_files(self.walk(), 'other.txt', 'subdir2/**')
+        self.assertEqual(len(expected_tree), len(list(walk_iter)))
+        walk_iter = include_dirs(self.walk(), 'subdir1/subdir1')
+        self.assertWalkEqual(dir_filtered_tree, walk_iter)
+        walk_iter = include_dirs(self.walk(), 'sub*/subdir2')
+        self.assertEqual(5, len(list(walk_iter)))
+
+    def test_exclude_path_patterns(self):
+        walk_iter = exclude_dirs(self.walk(), 'subdir1/other', '**/subdir2')
+        dirpaths = [dir_entry[0] for dir_entry in walk_iter]
+        self.assertEqual(len(expected_tree) - 7, len(dirpaths))
+        for dirpath in dirpaths:
+            self.assertFalse(dirpath.endswith(os.path.join('subdir1', 'other')))
+            self.assertFalse(dirpath.endswith('subdir2'))
+        for dir_entry in exclude_files(self.walk(), '*/other/*.txt'):
+            relpath = os.path.relpath(dir_entry[0], self.walk_root())
+            parts = relpath.split(os.sep)
+            if len(parts) == 2 and parts[1] == 'other':
+                self.assertFilesEqual(dir_entry, [])
+            else:
+                self.assertFilesEqual(dir_entry, expected_files)
+
     def test_legacy_names(self):
         self.assertIs(iter_paths, all_paths)
         self.assertIs(iter_dir_paths, dir_paths)
         self.assertIs(iter_file_paths, file_paths)
 
 
+class PatternMatchingTestCase(unittest.TestCase):
+    # The filters compile patterns into fast paths, so check them against
+    # fnmatch itself for a representative mix of pattern kinds
+    names = ["file1.txt", "file2.txt", "other.txt", "setup.py", "README",
+             ".hidden", "archive.tar.gz", "a[b", "sub", "subdir1", ""]
+    patterns = ["README", "*.txt", "*.gz", "sub*", "file?.txt", "*[12]*",
+                "a[b", "*e*", "[!s]*", ".*", "", "*.tar.*"]
+
+    def fnmatch_filter(self, patterns):
+        return [name for name in self.names
+                     if any(fnmatch.fnmatch(name, p) for p in patterns)]
+
+    def check_patterns(self, patterns):
+        expected = self.fnmatch_filter(patterns)
+        walk_iter = include_files([("root", [], self.names[:])], *patterns)
+        self.assertEqual(expected, next(walk_iter)[2])
+        walk_iter = exclude_files([("root", [], self.names[:])], *patterns)
+        excluded = [name for name in self.names if name not in expected]
+        self.assertEqual(excluded, next(walk_iter)[2])
+
+    def test_single_patterns(self):
+        for pattern in self.patterns:
+            self.check_patterns([pattern])
+
+    def test_combined_patterns(self):
+        for i in range(len(self.patterns)):
+            self.check_patterns(self.patterns[i:])
+            self.check_patterns(self.patterns[:i])
+        self.check_patterns(["*"] + self.patterns)
+
+    def test_path_states_carried_forward(self):
+        # In a depth-first walk, each directory's pattern states are
+        # derived from its parent's by matching just its own name
+        steps = []
+        descend = walkdir._PathPatterns.descend
+        def _recording_descend(path_set, states, name):
+            steps.append(name)
+            return descend(path_set, states, name)
+        walkdir._PathPatterns.descend = _recording_descend
+        try:
+            dirpaths = [dir_entry[0] for dir_entry in
+                            exclude_files(fake_walk(), '*/other/*.txt')]
+        finally:
+            walkdir._PathPatterns.descend = descend
+        expected = [os.path.basename(dirpath) for dirpath in dirpaths[1:]]
+        self.assertEqual(expected, steps)
+
+
 class NamedNoFilesystemTestCase(_BaseNamedTestCase, NoFilesystemTestCase):
     pass
 
@@ -441,6 +592,247 @@ class FilesystemFWalkTestCase(_BaseFileSystemFWalkTestCase, NoFilesystemTestCase
     pass
 
 
+class FilesystemScandirWalkTestCase(_BaseFileSystemScandirWalkTestCase, NoFilesystemTestCase):
+    pass
+
+
+class ScandirWalkTestCase(_BaseFileSystemScandirWalkTestCase):
+
+    def test_bottom_up(self):
+        walk_iter = scandir_walk(self.root_folder, topdown=False)
+        self.assertWalkEqual(expected_tree, walk_iter)
+        dirpaths = [dir_entry[0] for dir_entry in
+                        scandir_walk(self.root_folder, topdown=False)]
+        self.assertEqual(self.root_folder, dirpaths[-1])
+
+    def test_names_carry_entries(self):
+        for dirpath, subdirs, files in self.walk():
+            for subdir in subdirs:
+                self.assertIsInstance(subdir, WalkEntry)
+                self.assertTrue(subdir.is_dir())
+                self.assertFalse(subdir.is_symlink())
+                self.assertEqual(os.path.join(dirpath, subdir), subdir.path)
+            for fname in files:
+                self.assertIsInstance(fname, WalkEntry)
+                self.assertTrue(fname.is_file())
+                self.assertEqual(len("walkdir"), fname.stat().st_size)
+                self.assertEqual(os.stat(fname.path).st_ino, fname.inode())
+
+    def test_subdir_paths_carry_entries(self):
+        dirpaths = [dir_entry[0] for dir_entry in self.walk()]
+        self.assertNotIsInstance(dirpaths[0], WalkEntry)
+        for dirpath in dirpaths[1:]:
+            self.assertIsInstance(dirpath, WalkEntry)
+            self.assertEqual(dirpath, dirpath.path)
+            self.assertTrue(dirpath.is_dir())
+
+    def test_entries_pickle_as_strings(self):
+        dir_entry = next(self.walk())
+        names = pickle.loads(pickle.dumps(dir_entry[2]))
+        self.assertEqual(sorted(expected_files), sorted(names))
+        self.assertEqual([str], list(set(type(name) for name in names)))
+
+    def test_onerror(self):
+        errors = []
+        missing = os.path.join(self.test_folder, "missing")
+        self.assertEqual([], list(scandir_walk(missing, onerror=errors.append)))
+        self.assertEqual(1, len(errors))
+        self.assertIsInstance(errors[0], OSError)
+
+
+class FilesystemParallelWalkTestCase(_BaseFileSystemParallelWalkTestCase, NoFilesystemTestCase):
+    pass
+
+
+class ParallelWalkTestCase(_BaseFileSystemParallelWalkTestCase):
+
+    def listed_dirs(self, walk_iter):
+        # Record every directory listing requested from the thread pool
+        listed = []
+        scan_dir = walkdir._scan_dir_in_worker
+        def _recording_scan(top, *args):
+            listed.append(top)
+            return scan_dir(top, *args)
+        walkdir._scan_dir_in_worker = _recording_scan
+        try:
+            result = list(walk_iter)
+        finally:
+            walkdir._scan_dir_in_worker = scan_dir
+        return result, sorted(listed)
+
+    def test_ordered(self):
+        expected = [dir_entry[0] for dir_entry in scandir_walk(self.root_folder)]
+        actual = [dir_entry[0] for dir_entry in self.walk()]
+        self.assertEqual(expected, actual)
+
+    def test_unordered(self):
+        walk_iter = parallel_walk(self.root_folder, workers=4, ordered=False)
+        self.assertWalkEqual(expected_tree, walk_iter)
+
+    def test_pruned_dirs_are_not_listed(self):
+        for ordered in (True, False):
+            walk_iter = parallel_walk(self.root_folder, ordered=ordered)
+            walk_iter = filtered_walk(walk_iter, included_dirs=['sub*'],
+                                      excluded_dirs=['*2'])
+            result, listed = self.listed_dirs(walk_iter)
+            self.assertWalkEqual(dir_filtered_tree, result)
+            expected = [os.path.join(self.test_folder, dir_entry[0])
+                            for dir_entry in dir_filtered_tree]
+            self.assertEqual(sorted(expected), listed)
+
+    def test_path_patterns_prevent_listing(self):
+        walk_iter = filtered_walk(self.walk(), included_files=['subdir2/*.txt'])
+        result, listed = self.listed_dirs(walk_iter)
+        self.assertEqual(2, len(result))
+        self.assertEqual(2, len(listed))
+
+    def test_depth_limit_prevents_listing(self):
+        walk_iter = filtered_walk(self.walk(), depth=1)
+        result, listed = self.listed_dirs(walk_iter)
+        self.assertWalkEqual(depth_1_tree, result)
+        self.assertEqual(len(depth_1_tree), len(listed))
+
+    def test_onerror(self):
+        errors = []
+        missing = os.path.join(self.test_folder, "missing")
+        walk_iter = parallel_walk(missing, onerror=errors.append)
+        self.assertEqual([], list(walk_iter))
+        self.assertEqual(1, len(errors))
+
+    def test_early_close(self):
+        threads = set(threading.enumerate())
+        listed = []
+        scan_dir = walkdir._scan_dir_in_worker
+        def _recording_scan(top, *args):
+            listed.append(top)
+            return scan_dir(top, *args)
+        walkdir._scan_dir_in_worker = _recording_scan
+        try:
+            walk_iter = self.walk()
+            next(walk_iter)
+            walk_iter.close()
+            # Subdirectories are only scheduled when the next triple is
+            # requested, and closing the walk shuts down the worker threads
+            self.assertEqual([self.root_folder], listed)
+            self.assertEqual(set(), set(threading.enumerate()) - threads)
+            self.assertEqual([], list(walk_iter))
+            self.assertEqual([self.root_folder], listed)
+        finally:
+            walkdir._scan_dir_in_worker = scan_dir
+
+    def test_bounded_prefetch(self):
+        wide = os.path.join(self.test_folder, "wide")
+        for i in range(30):
+            os.makedirs(os.path.join(wide, "dir%02d" % i, "subdir"))
+        window = walkdir._PREFETCH_PER_WORKER
+        try:
+            expected = [dir_entry[0] for dir_entry in scandir_walk(wide)]
+            for ordered in (True, False):
+                walk_iter = parallel_walk(wide, workers=1, ordered=ordered)
+                listed = self.listed_dirs(islice(walk_iter, 3))[1]
+                # Each triple lets one more listing into the window
+                self.assertLessEqual(len(listed), 3 + window)
+                walk_iter = parallel_walk(wide, workers=1, ordered=ordered)
+                actual = [dir_entry[0] for dir_entry in walk_iter]
+                if ordered:
+                    self.assertEqual(expected, actual)
+                else:
+                    self.assertEqual(sorted(expected), sorted(actual))
+        finally:
+            rmtree(wide)
+
+    def test_missing_support(self):
+        for name in ("_futures", "_scandir"):
+            saved = getattr(walkdir, name)
+            setattr(walkdir, name, None)
+            try:
+                self.assertRaises(RuntimeError, parallel_walk, self.root_folder)
+            finally:
+                setattr(walkdir, name, saved)
+
+
+class FilesystemBreadthFirstWalkTestCase(_BaseFileSystemBreadthFirstWalkTestCase, NoFilesystemTestCase):
+    pass
+
+
+class BreadthFirstWalkTestCase(_BaseFileSystemBreadthFirstWalkTestCase):
+
+    def test_breadth_first(self):
+        depths = [dir_entry.depth for dir_entry in self.walk()]
+        self.assertEqual(sorted(depths), depths)
+        for dir_entry in self.walk():
+            self.assertEqual(dir_entry.depth, dir_entry[0].count(os.sep) -
+                                              self.root_folder.count(os.sep))
+        # Each level is visited in the order its parents were visited
+        dirpaths = [dir_entry[0] for dir_entry in self.walk()]
+        parents = [os.path.dirname(dirpath) for dirpath in dirpaths[1:]]
+        self.assertEqual(parents, sorted(parents, key=dirpaths.index))
+
+    def test_frontier(self):
+        listed = []
+        scan_dir = walkdir._scan_dir
+        def _recording_scan(top, *args):
+            listed.append(top)
+            return scan_dir(top, *args)
+        walkdir._scan_dir = _recording_scan
+        try:
+            walk_iter = self.walk()
+            top, subdirs, files = next(walk_iter)
+            self.assertEqual([top], listed)
+            # Subdirectories are listed one at a time as the walk reaches
+            # them, and pruned ones are never listed
+            pruned = subdirs.pop()
+            dir_entry = next(walk_iter)
+            self.assertEqual([top, os.path.join(top, subdirs[0])], listed)
+            dir_entries = [dir_entry] + list(walk_iter)
+        finally:
+            walkdir._scan_dir = scan_dir
+        dirpaths = [dir_entry[0] for dir_entry in dir_entries]
+        self.assertEqual([top] + dirpaths, listed)
+        self.assertFalse([dirpath for dirpath in dirpaths
+                              if dirpath.startswith(os.path.join(top, pruned, ""))])
+        # The frontier holds names rather than directory entries, so the
+        # paths are rebuilt as plain strings
+        self.assertEqual(set([str]), set(type(dirpath) for dirpath in dirpaths))
+
+    def test_best_first(self):
+        top, subdirs, files = next(self.walk())
+        for i, subdir in enumerate(sorted(subdirs)):
+            mtime = 1000000 * (i + 1)
+            os.utime(os.path.join(top, subdir), (mtime, mtime))
+        newest_first = lambda path: -path.stat().st_mtime
+        walk_iter = best_first_walk(self.root_folder, newest_first)
+        dirpaths = [dir_entry[0] for dir_entry in walk_iter]
+        self.assertEqual(os.path.join(top, sorted(subdirs)[-1]), dirpaths[1])
+        self.assertEqual(len(expected_tree), len(dirpaths))
+        # Keys apply across depths, so a deep directory can come first
+        deepest_first = lambda path: -path.count(os.sep)
+        walk_iter = best_first_walk(self.root_folder, deepest_first)
+        depths = [dir_entry.depth for dir_entry in walk_iter]
+        self.assertNotEqual(sorted(depths), depths)
+
+    def test_pruned_dirs_are_not_listed(self):
+        walk_iter = filtered_walk(self.walk(), included_dirs=['sub*'],
+                                  excluded_dirs=['*2'])
+        self.assertWalkEqual(dir_filtered_tree, walk_iter)
+        walk_iter = filtered_walk(self.walk(), depth=1)
+        self.assertWalkEqual(depth_1_tree, walk_iter)
+
+    def test_paths(self):
+        self.assertEqual(sorted(all_paths(scandir_walk(self.root_folder))),
+                         sorted(all_paths(self.walk())))
+        relative = list(file_paths(self.walk(), relative=True))
+        self.assertEqual(sorted(file_paths(scandir_walk(self.root_folder),
+                                           relative=True)), sorted(relative))
+
+    def test_onerror(self):
+        errors = []
+        missing = os.path.join(self.test_folder, "missing")
+        walk_iter = breadth_first_walk(missing, onerror=errors.append)
+        self.assertEqual([], list(walk_iter))
+        self.assertEqual(1, len(errors))
+
+
 class FilteredWalkTestCase(_BaseWalkTestCase):
     # Basically repeat all the standalone cases via the convenience API
     def test_unfiltered(self):
@@ -496,6 +888,13 @@ class FilteredWalkTestCase(_BaseWalkTestCase):
         for dir_entry in walk_iter:
             self.assertFilesEqual(dir_entry, ['file1.txt'])
 
+    def test_path_patterns_with_min_depth(self):
+        # Path patterns are relative to the top of the walk even when the
+        # top directory itself is skipped
+        expected = [('root/subdir1', [], expected_files)]
+        walk_iter = self.filtered_walk(included_files=['subdir1/*'], min_depth=1)
+        self.assertWalkEqual(expected, walk_iter)
+
 
 class NamedFilteredWalkTestCase(_BaseNamedTestCase, FilteredWalkTestCase):
     pass
@@ -509,6 +908,18 @@ class FilesystemFilteredFWalkTestCase(_BaseFileSystemFWalkTestCase, FilteredWalk
     pass
 
 
+class FilesystemFilteredScandirWalkTestCase(_BaseFileSystemScandirWalkTestCase, FilteredWalkTestCase):
+    pass
+
+
+class FilesystemFilteredParallelWalkTestCase(_BaseFileSystemParallelWalkTestCase, FilteredWalkTestCase):
+    pass
+
+
+class FilesystemFilteredBreadthFirstWalkTestCase(_BaseFileSystemBreadthFirstWalkTestCase, FilteredWalkTestCase):
+    pass
+
+
 class PathIterationTestCase(_BaseWalkTestCase):
 
     def test_all_paths(self):
@@ -544,19 +955,1387 @@ class PathIterationTestCase(_BaseWalkTestCase):
                                    excluded_dirs=['*2'])
         self.assertPathsEqual(filtered_file_paths, file_paths(walk_iter))
 
+    def test_batched_paths(self):
+        flatteners = [(batched_all_paths, all_paths),
+                      (batched_dir_paths, dir_paths),
+                      (batched_file_paths, file_paths)]
+        for batched, flatten in flatteners:
+            for kwds in ({}, {"min_depth": 1}, {"depth": 0}):
+                expected = list(flatten(self.filtered_walk(**kwds)))
+                batches = list(batched(self.filtered_walk(**kwds), 4))
+                self.assertEqual(expected, list(chain(*batches)))
+                self.assertTrue(all(len(batch) == 4 for batch in batches[:-1]))
+                batches = list(batched(self.filtered_walk(**kwds), 2,
+                                       per_dir=True))
+                self.assertEqual(expected, list(chain(*batches)))
+                for batch in batches:
+                    self.assertTrue(0 < len(batch) <= 2)
+        batches = list(batched_file_paths(self.filtered_walk(), per_dir=True))
+        self.assertEqual([3] * len(expected_tree), [len(b) for b in batches])
+        self.assertRaises(ValueError, list,
+                          batched_file_paths(self.filtered_walk(), 0))
+
+
+    def test_path_options(self):
+        root = self.walk_root()
+        for flatten in (all_paths, dir_paths, file_paths):
+            for kwds in ({}, {"depth": 0}, {"excluded_dirs": ["other"]}):
+                expected = list(flatten(self.filtered_walk(**kwds)))
+                self.assertEqual([os.path.relpath(path, root) for path in expected],
+                                 list(flatten(self.filtered_walk(**kwds),
+                                              relative=True)))
+                pairs = list(flatten(self.filtered_walk(**kwds), pairs=True))
+                self.assertEqual(expected,
+                                 [os.path.join(*pair) for pair in pairs])
+                if not hasattr(os, "fsencode"):
+                    continue
+                self.assertEqual([os.fsencode(path) for path in expected],
+                                 list(flatten(self.filtered_walk(**kwds),
+                                              as_bytes=True)))
+                relative = list(flatten(self.filtered_walk(**kwds),
+                                        relative=True, pairs=True,
+                                        as_bytes=True))
+                self.assertEqual([os.fsencode(os.path.relpath(path, root))
+                                      for path in expected],
+                                 [os.path.join(*pair) for pair in relative])
+
+
+    def test_sorted_paths(self):
+        root = self.walk_root()
+        for flatten in (all_paths, dir_paths, file_paths):
+            # The roots produced by min_depth are only sorted by the walk
+            for kwds in ({}, {"min_depth": 1, "sorted": True}, {"depth": 1}):
+                paths = list(flatten(self.filtered_walk(**kwds), sorted=True))
+                self.assertEqual(sorted(paths, key=walkdir._path_key), paths)
+                self.assertEqual(sorted(flatten(self.filtered_walk(**kwds))),
+                                 sorted(paths))
+            paths = list(flatten(self.filtered_walk(), sorted=True))
+            relative = list(flatten(self.filtered_walk(), sorted=True,
+                                    relative=True))
+            self.assertEqual([os.path.relpath(path, root) for path in paths],
+                             relative)
+            batches = batched_all_paths(self.filtered_walk(), 4, sorted=True)
+            self.assertEqual(list(all_paths(self.filtered_walk(), sorted=True)),
+                             list(chain(*batches)))
+
 
 class NamedPathIterationTestCase(_BaseNamedTestCase, PathIterationTestCase):
     pass
 
 
 class FilesystemPathIterationTestCase(_BaseFileSystemWalkTestCase, PathIterationTestCase):
-    pass
+
+    @unittest.skipUnless(hasattr(os, "fsencode"), "Requires os.fsencode")
+    def test_bytes_root(self):
+        root = os.fsencode(self.root_folder)
+        for flatten in (all_paths, dir_paths, file_paths):
+            expected = [os.fsencode(path)
+                            for path in flatten(os.walk(self.root_folder))]
+            self.assertEqual(expected, list(flatten(os.walk(root))))
+            self.assertEqual(expected,
+                             list(flatten(os.walk(self.root_folder),
+                                          as_bytes=True)))
+            relative = list(flatten(os.walk(root), relative=True))
+            self.assertEqual([os.path.relpath(path, root) for path in expected],
+                             relative)
+        batches = batched_all_paths(os.walk(self.root_folder), 5, as_bytes=True)
+        self.assertEqual(list(all_paths(os.walk(root))), list(chain(*batches)))
 
 
 class FilesystemPathIterationFwalkTestCase(_BaseFileSystemFWalkTestCase, PathIterationTestCase):
     pass
 
 
+class FilesystemPathIterationScandirWalkTestCase(_BaseFileSystemScandirWalkTestCase, PathIterationTestCase):
+    pass
+
+
+def collect_async(async_iter):
+    # Drive the iterator step by step (rather than using "async for"), so
+    # this module still compiles on versions without the native syntax
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    results = []
+    try:
+        while True:
+            try:
+                results.append(loop.run_until_complete(async_iter.__anext__()))
+            except StopAsyncIteration:
+                return results
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+
+
+@unittest.skipIf(asyncio is None or not hasattr(os, "scandir"),
+                 "No asyncio or no os.scandir")
+class AsyncWalkTestCase(_BaseFileSystemWalkTestCase):
+
+    def async_walk(self, **kwds):
+        return async_filtered_walk(self.root_folder, batch_size=2, **kwds)
+
+    def test_unfiltered(self):
+        self.assertWalkEqual(expected_tree, collect_async(self.async_walk()))
+
+    def test_filters(self):
+        self.assertWalkEqual(depth_1_tree, collect_async(self.async_walk(depth=1)))
+        self.assertWalkEqual(min_depth_2_tree,
+                             collect_async(self.async_walk(min_depth=2)))
+        walk_iter = self.async_walk(included_dirs=['sub*'], excluded_dirs=['*2'])
+        self.assertWalkEqual(dir_filtered_tree, collect_async(walk_iter))
+        for dir_entry in collect_async(self.async_walk(included_files=['file*'],
+                                                       excluded_files=['*2*'])):
+            self.assertFilesEqual(dir_entry, ['file1.txt'])
+
+    def test_iterable_top(self):
+        walk_iter = async_filtered_walk(self.walk(), depth=0)
+        self.assertWalkEqual(depth_0_tree, collect_async(walk_iter))
+
+    def test_paths(self):
+        self.assertPathsEqual(expected_paths,
+                              collect_async(async_all_paths(self.async_walk())))
+        self.assertPathsEqual(expected_dir_paths,
+                              collect_async(async_dir_paths(self.async_walk())))
+        self.assertPathsEqual(expected_file_paths,
+                              collect_async(async_file_paths(self.async_walk())))
+        walk_iter = filtered_walk(self.root_folder, depth=0)
+        self.assertPathsEqual(depth_0_paths,
+                              collect_async(async_all_paths(walk_iter)))
+
+    def test_cache(self):
+        cache = DirCache()
+        for i in range(2):
+            walk_iter = self.async_walk(cache=cache)
+            self.assertWalkEqual(expected_tree, collect_async(walk_iter))
+        self.assertEqual(len(expected_tree), len(cache))
+
+    def test_cursor(self):
+        expected = [dir_entry[0] for dir_entry in scandir_walk(self.root_folder)]
+        cursor = WalkCursor(self.root_folder)
+        dirpaths = []
+        while not cursor.finished:
+            walk_iter = self.async_walk(cursor=cursor, max_dirs=2)
+            dirpaths.extend(dir_entry[0] for dir_entry in
+                                collect_async(walk_iter))
+        self.assertEqual(expected, dirpaths)
+
+    def test_concurrent_anext(self):
+        walk_iter = self.async_walk()
+        count = len(expected_tree) + 2
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            calls = asyncio.gather(*[walk_iter.__anext__() for i in range(count)],
+                                   return_exceptions=True)
+            results = loop.run_until_complete(calls)
+            loop.run_until_complete(walk_iter.aclose())
+        finally:
+            asyncio.set_event_loop(None)
+            loop.close()
+        self.assertWalkEqual(expected_tree, results[:-2])
+        for error in results[-2:]:
+            self.assertIsInstance(error, StopAsyncIteration)
+
+    def test_started_walk_is_rejected(self):
+        walk_iter = self.async_walk()
+        collect_async(walk_iter)
+        self.assertRaises(ValueError, async_all_paths, walk_iter)
+
+
+class DepthTestCase(_BaseFileSystemWalkTestCase):
+
+    def dirpaths(self, walk_iter):
+        return sorted(os.path.relpath(dir_entry[0], self.test_folder)
+                          for dir_entry in walk_iter)
+
+    def expected_dirpaths(self, tree):
+        return sorted(os.path.normpath(dir_entry[0]) for dir_entry in tree)
+
+    @unittest.skipIf(not hasattr(os, "scandir"),
+                     "No os.scandir")
+    def test_walk_triple_depths(self):
+        sources = [cached_walk(self.root_folder, DirCache()),
+                   scandir_walk(self.root_folder),
+                   parallel_walk(self.root_folder)]
+        for walk_iter in sources:
+            for dir_entry in walk_iter:
+                self.assertIsInstance(dir_entry, WalkTriple)
+                relpath = os.path.relpath(dir_entry[0], self.root_folder)
+                depth = 0 if relpath == os.curdir else relpath.count(os.sep) + 1
+                self.assertEqual(depth, dir_entry.depth)
+        dir_entry = next(cached_walk(self.root_folder, DirCache()))
+        copied = pickle.loads(pickle.dumps(dir_entry))
+        self.assertEqual(dir_entry, copied)
+        self.assertEqual(0, copied.depth)
+
+    def test_trailing_separator(self):
+        top = self.root_folder + os.sep
+        walk_iter = limit_depth(os.walk(top), 1)
+        self.assertEqual(self.expected_dirpaths(depth_1_tree),
+                         self.dirpaths(walk_iter))
+        walk_iter = min_depth(os.walk(top), 2)
+        self.assertEqual(self.expected_dirpaths(min_depth_2_tree),
+                         self.dirpaths(walk_iter))
+
+    def test_chained_roots(self):
+        roots = [os.path.join(self.root_folder, subdir)
+                     for subdir in ("subdir1", "other")]
+        walk_iter = chain(*[os.walk(root) for root in roots])
+        walk_iter = limit_depth(walk_iter, 0)
+        self.assertEqual(2, len(list(walk_iter)))
+        walk_iter = chain(*[os.walk(root) for root in roots])
+        walk_iter = min_depth(walk_iter, 1)
+        self.assertEqual(6, len(list(walk_iter)))
+
+    def test_deeper_triples_are_skipped(self):
+        # An underlying iterator that ignores changes to the subdirectory list
+        walk_iter = limit_depth(list(os.walk(self.root_folder)), 1)
+        self.assertWalkEqual(depth_1_tree, walk_iter)
+
+    def test_subtree_limits(self):
+        walk_iter = limit_depth(os.walk(self.root_folder), None, {"subdir1": 0})
+        self.assertEqual(len(expected_tree) - 3, len(list(walk_iter)))
+        walk_iter = limit_depth(os.walk(self.root_folder), 1,
+                                {"subdir2": None, "other/": 0})
+        expected = [dir_entry[0] for dir_entry in expected_tree
+                        if dir_entry[0].count("/") < 2 or
+                           dir_entry[0].startswith("root/subdir2/")]
+        self.assertEqual(self.expected_dirpaths([(d,) for d in expected]),
+                         self.dirpaths(walk_iter))
+        walk_iter = self.filtered_walk(depth=0,
+                                       subtree_depths={"subdir1/other": None})
+        expected = ["root", "root/subdir1", "root/subdir1/other"]
+        self.assertEqual(self.expected_dirpaths([(d,) for d in expected]),
+                         self.dirpaths(walk_iter))
+        self.assertRaises(ValueError, list,
+                          limit_depth(self.walk(), None, {"subdir1": -1}))
+
+    def test_subtree_roots(self):
+        expected = [os.path.join(self.root_folder, subdir)
+                        for subdir in ("subdir1", "subdir2", "other")]
+        walk_iter = subtree_roots(os.walk(self.root_folder), 1)
+        self.assertEqual(sorted(expected), sorted(walk_iter))
+        walk_iter = subtree_roots(os.walk(self.root_folder), 0)
+        self.assertEqual([self.root_folder], list(walk_iter))
+        walk_iter = subtree_roots(os.walk(self.root_folder), 2)
+        self.assertEqual(self.expected_dirpaths(min_depth_2_tree),
+                         sorted(os.path.relpath(path, self.test_folder)
+                                    for path in walk_iter))
+        self.assertRaises(ValueError, list, subtree_roots(self.walk(), -1))
+
+    @unittest.skipUnless(hasattr(os, "scandir"), "Requires os.scandir")
+    def test_subtree_roots_skip_listing(self):
+        listed = []
+        scan_dir = walkdir._scan_dir
+        def _recording_scan(top, onerror, subdirs_only=False):
+            listed.append(top)
+            return scan_dir(top, onerror, subdirs_only)
+        walkdir._scan_dir = _recording_scan
+        try:
+            walk_iter = scandir_walk(self.root_folder, min_file_depth=2)
+            roots = list(subtree_roots(walk_iter, 2))
+        finally:
+            walkdir._scan_dir = scan_dir
+        self.assertEqual(9, len(roots))
+        self.assertEqual(4, len(listed))
+        self.assertFalse(set(roots) & set(listed))
+
+    @unittest.skipUnless(hasattr(os, "scandir"), "Requires os.scandir")
+    def test_min_file_depth(self):
+        sources = [scandir_walk(self.root_folder, min_file_depth=2),
+                   parallel_walk(self.root_folder, min_file_depth=2)]
+        for walk_iter in sources:
+            for dir_entry in walk_iter:
+                if dir_entry.depth < 2:
+                    self.assertEqual([], dir_entry[2])
+                else:
+                    self.assertEqual(3, len(dir_entry[2]))
+        for workers in (None, 2):
+            walk_iter = self.filtered_walk(min_depth=2, workers=workers)
+            self.assertWalkEqual(min_depth_2_tree, walk_iter)
+
+
+@unittest.skipIf(walkdir._futures is None,
+                 "No concurrent.futures")
+class ShardedWalkTestCase(_BaseFileSystemWalkTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(ShardedWalkTestCase, cls).setUpClass()
+        ignore_path = os.path.join(cls.root_folder, "subdir1", ".gitignore")
+        with open(ignore_path, "w") as f:
+            f.write("other.txt\nsubdir2/\n")
+
+    def normalised(self, walk_iter):
+        return sorted((dir_entry[0], sorted(dir_entry[1]), sorted(dir_entry[2]))
+                          for dir_entry in walk_iter)
+
+    def assertShardsEqual(self, **kwds):
+        expected = self.normalised(self.filtered_walk(**kwds))
+        for split_depth in (1, 2):
+            for handoff_dirs in (None, 1):
+                walk_iter = sharded_walk(self.root_folder, split_depth,
+                                         processes=2, handoff_dirs=handoff_dirs,
+                                         **kwds)
+                self.assertEqual(expected, self.normalised(walk_iter))
+
+    def test_matches_filtered_walk(self):
+        self.assertShardsEqual()
+        self.assertShardsEqual(depth=1)
+        self.assertShardsEqual(min_depth=1)
+        self.assertShardsEqual(min_depth=2, excluded_files=["file1*"])
+        self.assertShardsEqual(included_files=["subdir1/*/*.txt"])
+        self.assertShardsEqual(excluded_dirs=["subdir2"], ignore_files=[".gitignore"])
+        self.assertShardsEqual(depth=0, subtree_depths={"other": None})
+
+    def test_triples(self):
+        walk_iter = sharded_walk(self.root_folder, processes=2)
+        for dir_entry in walk_iter:
+            self.assertIsInstance(dir_entry, WalkTriple)
+            relpath = os.path.relpath(dir_entry[0], self.root_folder)
+            depth = 0 if relpath == os.curdir else relpath.count(os.sep) + 1
+            self.assertEqual(depth, dir_entry.depth)
+
+    def test_paths(self):
+        flatteners = {"files": file_paths, "dirs": dir_paths, "all": all_paths}
+        for paths, flatten in flatteners.items():
+            for kwds in ({}, {"min_depth": 1}, {"depth": 1}):
+                expected = sorted(flatten(self.filtered_walk(**kwds)))
+                walk_iter = sharded_walk(self.root_folder, processes=2,
+                                         handoff_dirs=1, paths=paths, **kwds)
+                self.assertEqual(expected, sorted(walk_iter))
+
+    def test_invalid_arguments(self):
+        for kwds in ({"split_depth": 0}, {"paths": "links"}, {"workers": 2},
+                     {"cache": DirCache()}, {"stats": WalkStats()},
+                     {"dedup": True}, {"cursor": WalkCursor(self.root_folder)},
+                     {"max_dirs": 10}, {"max_files": 10}, {"timeout": 1.0}):
+            self.assertRaises(ValueError, sharded_walk, self.root_folder,
+                              **kwds)
+        if bytes is not str:
+            self.assertRaises(TypeError, sharded_walk,
+                              self.root_folder.encode("ascii"))
+
+    def test_missing_support(self):
+        saved = walkdir._futures
+        walkdir._futures = None
+        try:
+            self.assertRaises(RuntimeError, sharded_walk, self.root_folder)
+        finally:
+            walkdir._futures = saved
+
+
+@unittest.skipUnless(hasattr(os, "fsencode"), "Requires os.fsencode")
+class BytesWalkTestCase(_BaseFileSystemWalkTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(BytesWalkTestCase, cls).setUpClass()
+        cls.bytes_root = os.fsencode(cls.root_folder)
+        with open(os.path.join(cls.root_folder, "subdir2", ".gitignore"), "wb") as f:
+            f.write(b"file1.txt\n\xff*\n")
+        for subdir in (b"subdir1", b"subdir2"):
+            path = os.path.join(cls.bytes_root, subdir, b"\xff.bin")
+            with open(path, "wb") as f:
+                f.write(b"walkdir")
+        os.symlink(cls.bytes_root, os.path.join(cls.bytes_root, b"other", b"loop"))
+
+    def normalised(self, walk_iter):
+        return sorted((dir_entry[0], sorted(dir_entry[1]), sorted(dir_entry[2]))
+                          for dir_entry in walk_iter)
+
+    def encoded(self, walk_iter):
+        return self.normalised((os.fsencode(dir_entry[0]),
+                                [os.fsencode(name) for name in dir_entry[1]],
+                                [os.fsencode(name) for name in dir_entry[2]])
+                                   for dir_entry in walk_iter)
+
+    def assertBytesWalkEqual(self, **kwds):
+        expected = self.encoded(filtered_walk(self.root_folder, **kwds))
+        actual = filtered_walk(self.bytes_root, **kwds)
+        self.assertEqual(expected, self.normalised(actual))
+        for dir_entry in self.normalised(filtered_walk(self.bytes_root, **kwds)):
+            self.assertIsInstance(dir_entry[0], bytes)
+
+    def test_filtered_walk(self):
+        self.assertBytesWalkEqual()
+        self.assertBytesWalkEqual(included_files=["*.txt"], excluded_dirs=["other"])
+        self.assertBytesWalkEqual(included_files=["subdir1/*/*.txt"])
+        self.assertBytesWalkEqual(excluded_files=["subdir2/*"], included_dirs=["sub*"])
+        self.assertBytesWalkEqual(depth=1, min_depth=1)
+        self.assertBytesWalkEqual(depth=0, subtree_depths={"subdir1": None})
+        self.assertBytesWalkEqual(ignore_files=[".gitignore"])
+        self.assertBytesWalkEqual(workers=2, excluded_files=["*.txt"])
+
+    def test_byte_patterns(self):
+        walk_iter = filtered_walk(self.bytes_root, included_files=[b"\xff*"],
+                                  excluded_dirs=[b"subdir2"])
+        paths = list(file_paths(walk_iter, relative=True))
+        self.assertEqual([os.path.join(b"subdir1", b"\xff.bin")], paths)
+        walk_iter = filtered_walk(self.bytes_root, included_files=[b"*.bin"],
+                                  ignore_files=[".gitignore"])
+        self.assertEqual(1, len(list(file_paths(walk_iter))))
+        walk_iter = limit_depth(os.walk(self.bytes_root), 0, {b"other": 0})
+        self.assertEqual(2, len(list(walk_iter)))
+
+    def test_entry_names(self):
+        dir_entry = next(scandir_walk(self.bytes_root))
+        for name in dir_entry[1]:
+            self.assertIsInstance(name, BytesWalkEntry)
+            self.assertTrue(name.is_dir())
+            self.assertEqual(os.path.join(self.bytes_root, name), name.path)
+            copied = pickle.loads(pickle.dumps(name))
+            self.assertIs(type(copied), bytes)
+            self.assertEqual(name, copied)
+        cache = DirCache()
+        self.assertEqual(self.normalised(scandir_walk(self.bytes_root)),
+                         self.normalised(cached_walk(self.bytes_root, cache)))
+
+    def test_symlink_loops(self):
+        loops = []
+        def onloop(dirpath):
+            loops.append(dirpath)
+            return False
+        walk_iter = handle_symlink_loops(os.walk(self.bytes_root, followlinks=True),
+                                         onloop)
+        self.assertEqual(len(expected_tree), len(list(walk_iter)))
+        self.assertEqual([os.path.join(self.bytes_root, b"other", b"loop")], loops)
+
+
+class SortedWalkTestCase(_BaseFileSystemWalkTestCase):
+
+    def test_filtered_walk(self):
+        for workers in (None, 2):
+            if workers is not None and (walkdir._scandir is None or
+                                        walkdir._futures is None):
+                continue
+            walk_iter = self.filtered_walk(sorted=True, workers=workers)
+            dirpaths = []
+            for dir_entry in walk_iter:
+                self.assertEqual(sorted(dir_entry[1]), dir_entry[1])
+                self.assertEqual(sorted(dir_entry[2]), dir_entry[2])
+                dirpaths.append(dir_entry[0])
+            self.assertEqual(sorted(dirpaths, key=walkdir._path_key), dirpaths)
+            self.assertEqual(len(expected_tree), len(dirpaths))
+
+    def test_sort_walk(self):
+        def reversed_walk():
+            for dir_entry in os.walk(self.root_folder):
+                dir_entry[1].reverse()
+                dir_entry[2].reverse()
+                listed.append(dir_entry)
+                yield dir_entry
+        listed = []
+        dirpaths = []
+        for dir_entry in sort_walk(reversed_walk()):
+            # The lists are sorted in place, so the walk descends in order
+            self.assertIs(listed[-1][1], dir_entry[1])
+            self.assertIs(listed[-1][2], dir_entry[2])
+            self.assertEqual(sorted(dir_entry[1]), dir_entry[1])
+            self.assertEqual(sorted(dir_entry[2]), dir_entry[2])
+            dirpaths.append(dir_entry[0])
+        self.assertEqual(sorted(dirpaths, key=walkdir._path_key), dirpaths)
+        self.assertEqual(len(expected_tree), len(dirpaths))
+
+    def test_merge_sorted_paths(self):
+        roots = [os.path.join(self.root_folder, subdir)
+                     for subdir in ("subdir2", "other", "subdir1")]
+        path_iters = [all_paths(filtered_walk(root), sorted=True)
+                          for root in roots]
+        merged = list(merge_sorted_paths(*path_iters))
+        self.assertEqual(sorted(merged, key=walkdir._path_key), merged)
+        self.assertEqual(sum(len(list(all_paths(filtered_walk(root))))
+                                 for root in roots), len(merged))
+        path_iters = [file_paths(filtered_walk(root), sorted=True, relative=True)
+                          for root in roots]
+        merged = list(merge_sorted_paths(*path_iters))
+        expected = sorted(file_paths(filtered_walk(roots[0]), relative=True),
+                          key=walkdir._path_key)
+        self.assertEqual([path for path in expected for root in roots], merged)
+        if hasattr(os, "fsencode"):
+            path_iters = [file_paths(filtered_walk(root), sorted=True,
+                                     as_bytes=True) for root in roots]
+            merged = list(merge_sorted_paths(*path_iters))
+            self.assertEqual(sorted(merged, key=walkdir._path_key), merged)
+
+
+class StatTestCase(_BaseFileSystemWalkTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(StatTestCase, cls).setUpClass()
+        # A directory with enough files to be stat-ed in batches
+        cls.big_folder = os.path.join(cls.root_folder, "big")
+        os.mkdir(cls.big_folder)
+        for i in range(50):
+            with open(os.path.join(cls.big_folder, "file%d" % i), "w") as f:
+                f.write("x" * i)
+        os.utime(os.path.join(cls.big_folder, "file0"), (0, 0))
+
+    def stat_paths(self, walk_iter):
+        return dict(file_paths(walk_iter, with_stat=True))
+
+    def test_attach_stat(self):
+        for workers in (0, 4):
+            walk_iter = attach_stat(os.walk(self.root_folder), workers=workers)
+            for dirpath, subdirs, files in walk_iter:
+                for name in files:
+                    self.assertIsInstance(name, WalkEntry)
+                    st = os.stat(os.path.join(dirpath, name))
+                    self.assertEqual(st.st_size, name.stat().st_size)
+                    self.assertTrue(name.is_file())
+                    self.assertFalse(name.is_dir())
+
+    def test_attach_stat_errors(self):
+        errors = []
+        walk_iter = [(self.root_folder, [], ["missing", "file1.txt"])]
+        walk_iter = attach_stat(walk_iter, onerror=errors.append)
+        self.assertFilesEqual(next(walk_iter), ["file1.txt"])
+        self.assertEqual(1, len(errors))
+
+    def test_filter_stat(self):
+        walk_iter = filter_stat(attach_stat(os.walk(self.big_folder)),
+                                min_size=10, max_size=19)
+        self.assertFilesEqual(next(walk_iter),
+                              ["file%d" % i for i in range(10, 20)])
+        walk_iter = filter_stat(os.walk(self.big_folder), max_mtime=1)
+        self.assertFilesEqual(next(walk_iter), ["file0"])
+        walk_iter = filter_stat(os.walk(self.big_folder), min_mtime=1,
+                                predicate=lambda st: st.st_size < 3)
+        self.assertFilesEqual(next(walk_iter), ["file1", "file2"])
+        walk_iter = filter_stat(os.walk(self.big_folder), file_types=["dir"])
+        self.assertFilesEqual(next(walk_iter), [])
+        if hasattr(os, "getuid"):
+            walk_iter = filter_stat(os.walk(self.big_folder), uids=[os.getuid()])
+            self.assertEqual(50, len(next(walk_iter)[2]))
+
+    def test_unknown_file_type(self):
+        walk_iter = filter_stat(os.walk(self.big_folder), file_types=["door"])
+        self.assertRaises(ValueError, next, walk_iter)
+
+    def test_paths_with_stat(self):
+        paths = self.stat_paths(self.filtered_walk())
+        self.assertEqual(sorted(file_paths(self.filtered_walk())), sorted(paths))
+        for path, st in paths.items():
+            self.assertEqual(os.stat(path).st_size, st.st_size)
+        paths = dict(dir_paths(self.filtered_walk(), with_stat=True))
+        self.assertEqual(sorted(dir_paths(self.filtered_walk())), sorted(paths))
+        for path, st in paths.items():
+            self.assertEqual(os.stat(path).st_ino, st.st_ino)
+        paths = dict(all_paths(os.walk(self.root_folder), with_stat=True))
+        self.assertEqual(sorted(all_paths(os.walk(self.root_folder))),
+                         sorted(paths))
+
+    def test_top_files(self):
+        big_file = lambda i: os.path.join(self.big_folder, "file%d" % i)
+        largest = top_files(attach_stat(os.walk(self.root_folder)), 3)
+        self.assertEqual([big_file(49), big_file(48), big_file(47)],
+                         [path for path, st in largest])
+        self.assertEqual([49, 48, 47], [st.st_size for path, st in largest])
+        oldest = top_files(os.walk(self.big_folder), 1, key="mtime",
+                           smallest=True)
+        self.assertEqual([big_file(0)], [path for path, st in oldest])
+        walk_iter = [(self.big_folder, [], ["missing", "file1", "file2"])]
+        smallest = top_files(walk_iter, 5, key=lambda st: st.st_size,
+                             smallest=True)
+        self.assertEqual([big_file(1), big_file(2)],
+                         [path for path, st in smallest])
+        self.assertRaises(ValueError, top_files, os.walk(self.big_folder), 1,
+                          key="inode")
+
+    def test_sample_files(self):
+        all_files = sorted(file_paths(os.walk(self.root_folder)))
+        sample = sample_files(os.walk(self.root_folder), 10)
+        self.assertEqual(10, len(set(sample)))
+        self.assertTrue(set(sample) <= set(all_files))
+        sample = sample_files(os.walk(self.root_folder), 1000)
+        self.assertEqual(all_files, sorted(sample))
+        samples = [sample_files(os.walk(self.root_folder), 5,
+                                random=random.Random(42)) for i in range(2)]
+        self.assertEqual(samples[0], samples[1])
+        sample = sample_files(attach_stat(os.walk(self.big_folder)), 5,
+                              with_stat=True)
+        for path, st in sample:
+            self.assertEqual(os.stat(path).st_size, st.st_size)
+        self.assertRaises(ValueError, sample_files, os.walk(self.big_folder), 0)
+
+    def test_filtered_walk(self):
+        walk_iter = self.filtered_walk(stat_filter={"min_size": 48})
+        paths = self.stat_paths(walk_iter)
+        expected = [os.path.join(self.big_folder, "file48"),
+                    os.path.join(self.big_folder, "file49")]
+        self.assertEqual(expected, sorted(paths))
+
+
+class DuplicatesTestCase(_BaseFileSystemWalkTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(DuplicatesTestCase, cls).setUpClass()
+        # Large files that only differ in their last byte or in the middle
+        cls.dup_folder = os.path.join(cls.root_folder, "dups")
+        os.mkdir(cls.dup_folder)
+        content = b"".join(b"%04d" % i for i in range(1000))
+        variants = {"big1": content, "big2": content,
+                    "last": content[:-1] + b"!",
+                    "middle": content[:2000] + b"!" + content[2001:]}
+        for name, data in variants.items():
+            with open(os.path.join(cls.dup_folder, name), "wb") as f:
+                f.write(data)
+
+    def dup_path(self, name):
+        return os.path.join(self.dup_folder, name)
+
+    def test_find_duplicates(self):
+        small_files = sorted(file_paths(self.filtered_walk(excluded_dirs=["dups"])))
+        for workers in (0, 4):
+            stats = DuplicateStats()
+            groups = list(find_duplicates(self.walk(), edge_size=16,
+                                          workers=workers, stats=stats))
+            self.assertEqual(2, len(groups))
+            self.assertEqual([self.dup_path("big1"), self.dup_path("big2")],
+                             sorted(groups[0]))
+            self.assertEqual(small_files, sorted(groups[1]))
+            self.assertEqual(len(small_files) + 4, stats.files)
+            self.assertEqual(stats.files, stats.candidates)
+            self.assertEqual(stats.files, stats.partial_hashes)
+            self.assertEqual(3, stats.full_hashes)
+            self.assertEqual(len(small_files) + 2, stats.duplicates)
+            self.assertEqual(3 * 4000 + 4 * 32 + 7 * len(small_files),
+                             stats.bytes_hashed)
+            self.assertGreaterEqual(stats.gigabytes_per_second, 0)
+        # Without the partial hashes, every large file is hashed in full
+        stats = DuplicateStats()
+        groups = list(find_duplicates(self.walk(), edge_size=0, min_size=8,
+                                      stats=stats))
+        self.assertEqual([[self.dup_path("big1"), self.dup_path("big2")]],
+                         [sorted(group) for group in groups])
+        self.assertEqual(4, stats.full_hashes)
+
+    @unittest.skipUnless(hasattr(os, "link"), "Requires hard links")
+    def test_hard_links(self):
+        folder = mkdtemp()
+        try:
+            path = os.path.join(folder, "file")
+            with open(path, "w") as f:
+                f.write("walkdir")
+            os.link(path, os.path.join(folder, "link"))
+            self.assertEqual([], list(find_duplicates(os.walk(folder))))
+        finally:
+            rmtree(folder)
+
+    def test_errors(self):
+        errors = []
+        # Borrow the details of a file that isn't part of the walk
+        st = os.stat(self.dup_path("last"))
+        missing = os.path.join(self.dup_folder, "missing")
+        entry = walkdir._StatEntry(missing, st, True)
+        walk_iter = [(self.dup_folder, [],
+                      ["big1", WalkEntry("missing", entry), "big2"])]
+        groups = list(find_duplicates(walk_iter, onerror=errors.append))
+        self.assertEqual([[self.dup_path("big1"), self.dup_path("big2")]],
+                         groups)
+        self.assertEqual(1, len(errors))
+
+
+class SearchFilesTestCase(_BaseFileSystemWalkTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(SearchFilesTestCase, cls).setUpClass()
+        cls.search_folder = os.path.join(cls.root_folder, "search")
+        os.mkdir(cls.search_folder)
+        cls.text = b"".join(b"line %d: key=%d\n" % (i, i * 7) for i in range(2000))
+        with open(os.path.join(cls.search_folder, "text"), "wb") as f:
+            f.write(cls.text)
+        with open(os.path.join(cls.search_folder, "binary"), "wb") as f:
+            f.write(b"\0key=14\n")
+
+    def search_walk(self):
+        return os.walk(self.search_folder)
+
+    def test_search_files(self):
+        matches = list(search_files(self.walk(), re.compile(b"walk")))
+        expected = sorted(file_paths(self.filtered_walk(excluded_dirs=["search"])))
+        self.assertEqual(expected, sorted(path for path, offset, data in matches))
+        for path, offset, data in matches:
+            self.assertEqual(0, offset)
+            self.assertEqual(b"walk", data)
+
+    def test_chunk_boundaries(self):
+        patterns = [re.compile(b"(?<=key=)\\d+"), re.compile(b"^line 1\\d*", re.M)]
+        expected = [(start, data) for start, i, data in
+                        sorted((m.start(), i, m.group())
+                                   for i, pattern in enumerate(patterns)
+                                   for m in pattern.finditer(self.text))]
+        options = [{}, {"mmap_size": 1}, {"workers": 0},
+                   {"chunk_size": 100, "overlap": 20},
+                   {"chunk_size": 4096, "overlap": 32, "workers": 0}]
+        for kwds in options:
+            matches = search_files(self.search_walk(), patterns, **kwds)
+            found = [(offset, data) for path, offset, data in matches]
+            self.assertEqual(expected, found)
+        self.assertRaises(ValueError, next,
+                          search_files(self.search_walk(), patterns,
+                                       chunk_size=100, overlap=100))
+
+    def test_binary_files(self):
+        pattern = re.compile(b"key=14\n")
+        matches = search_files(self.search_walk(), pattern)
+        self.assertEqual(["text"], [os.path.basename(path)
+                                        for path, offset, data in matches])
+        matches = search_files(self.search_walk(), pattern, skip_binary=False)
+        self.assertEqual(["binary", "text"],
+                         sorted(os.path.basename(path)
+                                    for path, offset, data in matches))
+
+    def test_max_count(self):
+        patterns = [re.compile(b"key"), re.compile(b"line")]
+        for kwds in ({}, {"mmap_size": 1}, {"chunk_size": 100, "overlap": 10}):
+            matches = list(search_files(self.search_walk(), patterns,
+                                        max_count=3, **kwds))
+            self.assertEqual([0, 0, 1], [self.text[:offset].count(b"\n")
+                                             for path, offset, data in matches])
+            self.assertEqual([b"line", b"key", b"line"],
+                             [data for path, offset, data in matches])
+            matches = search_files(self.search_walk(), patterns, max_count=0,
+                                   **kwds)
+            self.assertEqual([], list(matches))
+        # Each pattern stops searching after the first few matches
+        starts = [0, 0]
+        found = walkdir._block_matches(self.text, 0, patterns, starts, 0,
+                                       True, 3)
+        self.assertEqual(3, len(found))
+        self.assertLess(max(starts), self.text.index(b"line 3"))
+
+    @unittest.skipIf(bytes is str, "str patterns are bytes patterns")
+    def test_str_patterns(self):
+        for pattern in ("key", re.compile("key"), [re.compile(b"key"), "key"]):
+            self.assertRaises(TypeError, next,
+                              search_files(self.search_walk(), pattern))
+
+    def test_stop_early(self):
+        matches = search_files(self.walk(), re.compile(b"walk"), workers=2)
+        next(matches)
+        matches.close()
+
+    def test_errors(self):
+        errors = []
+        st = os.stat(os.path.join(self.search_folder, "text"))
+        entry = walkdir._StatEntry(os.path.join(self.search_folder, "missing"),
+                                   st, True)
+        walk_iter = [(self.search_folder, [], [WalkEntry("missing", entry)])]
+        matches = search_files(walk_iter, re.compile(b"key"),
+                               onerror=errors.append)
+        self.assertEqual([], list(matches))
+        self.assertEqual(1, len(errors))
+
+
+class DiskUsageTestCase(_BaseFileSystemWalkTestCase):
+
+    def check_usage(self, usage, walk_iter):
+        # Directories must be reported after all of their subdirectories
+        reported = set()
+        for dirpath, totals in usage:
+            for subdir in walk_iter[dirpath]:
+                self.assertIn(subdir, reported)
+            reported.add(dirpath)
+        self.assertEqual(set(walk_iter), reported)
+
+    def test_disk_usage(self):
+        subdirs = dict((dirpath, [os.path.join(dirpath, subdir)
+                                      for subdir in dir_subdirs])
+                           for dirpath, dir_subdirs, files in self.walk())
+        file_count = len(list(file_paths(self.walk())))
+        # As for du, the directories themselves are included
+        dir_size = sum(os.stat(dirpath).st_size for dirpath in subdirs)
+        for topdown in (True, False):
+            walk_iter = os.walk(self.root_folder, topdown=topdown)
+            usage = list(disk_usage(walk_iter, topdown=topdown))
+            self.check_usage(usage, subdirs)
+            totals = dict(usage)
+            root = totals[self.root_folder]
+            self.assertIsInstance(root, DiskUsage)
+            self.assertEqual(7 * file_count + dir_size, root.size)
+            self.assertGreaterEqual(root.allocated, 0)
+            self.assertEqual(file_count, root.files)
+            self.assertEqual(len(subdirs) - 1, root.dirs)
+            subdir = os.path.join(self.root_folder, "subdir1")
+            expected = [path for path in file_paths(os.walk(subdir))]
+            self.assertEqual(len(expected), totals[subdir].files)
+        walk_iter = attach_stat(scandir_walk(self.root_folder),
+                                follow_symlinks=False)
+        self.assertEqual(totals, dict(disk_usage(walk_iter)))
+        walk_iter = scandir_walk(self.root_folder, topdown=False)
+        self.assertEqual(totals, dict(disk_usage(walk_iter, topdown=False)))
+
+    def test_bottom_up_roots(self):
+        # Each root's totals are only rolled up into directories below it
+        roots = [os.path.join(self.root_folder, subdir)
+                     for subdir in ("subdir1", "subdir2")]
+        walk_iter = chain(*[os.walk(root, topdown=False) for root in roots])
+        totals = dict(disk_usage(walk_iter, topdown=False))
+        for root in roots:
+            expected = dict(disk_usage(os.walk(root, topdown=False),
+                                       topdown=False))
+            self.assertEqual(expected[root], totals[root])
+        # Once the walk has left the parent of a root, it's forgotten
+        elsewhere = os.path.join(self.test_folder, "elsewhere")
+        walk_iter = chain(os.walk(roots[0], topdown=False),
+                          [(elsewhere, [], []), (self.root_folder, [], [])])
+        totals = dict(disk_usage(walk_iter, topdown=False))
+        self.assertEqual(0, totals[self.root_folder].files)
+
+    def test_multiple_roots(self):
+        walk_iter = self.filtered_walk(min_depth=1)
+        top, subdirs, root_files = next(self.walk())
+        roots = [os.path.join(top, subdir) for subdir in subdirs]
+        totals = dict(disk_usage(walk_iter))
+        self.assertNotIn(top, totals)
+        root_files = len(root_files)
+        self.assertEqual(len(list(file_paths(self.walk()))) - root_files,
+                         sum(totals[root].files for root in roots))
+
+    @unittest.skipUnless(hasattr(os, "link"), "Requires hard links")
+    def test_hard_links(self):
+        folder = mkdtemp()
+        try:
+            os.mkdir(os.path.join(folder, "subdir"))
+            path = os.path.join(folder, "file")
+            with open(path, "w") as f:
+                f.write("walkdir")
+            os.link(path, os.path.join(folder, "subdir", "link"))
+            totals = dict(disk_usage(os.walk(folder)))
+            dir_size = (os.stat(folder).st_size +
+                        os.stat(os.path.join(folder, "subdir")).st_size)
+            self.assertEqual(DiskUsage(7 + dir_size, totals[folder].allocated,
+                                       1, 1),
+                             totals[folder])
+        finally:
+            rmtree(folder)
+
+
+@unittest.skipIf(not hasattr(os, "scandir"),
+                 "No os.scandir")
+class WalkCursorTestCase(_BaseFileSystemWalkTestCase):
+
+    def test_limit_walk(self):
+        walk_iter = limit_walk(self.walk(), max_dirs=2)
+        self.assertEqual(2, len(list(walk_iter)))
+        walk_iter = limit_walk(self.walk(), max_files=1)
+        dir_entries = list(walk_iter)
+        self.assertEqual(1, len(dir_entries))
+        self.assertEqual(sorted(expected_files), sorted(dir_entries[0][2]))
+        self.assertEqual([], list(limit_walk(self.walk(), timeout=0)))
+        self.assertWalkEqual(expected_tree, limit_walk(self.walk(), timeout=60))
+
+    def test_no_read_ahead(self):
+        listed = []
+        scan_dir = walkdir._scan_dir
+        def _recording_scan(top, *args):
+            listed.append(top)
+            return scan_dir(top, *args)
+        walkdir._scan_dir = _recording_scan
+        try:
+            dir_entries = list(limit_walk(scandir_walk(self.root_folder),
+                                          max_dirs=2))
+            self.assertEqual([dir_entry[0] for dir_entry in dir_entries],
+                             listed)
+            # A cursor finishes the last directory without listing another
+            del listed[:]
+            cursor = WalkCursor(self.root_folder)
+            dir_entries = list(limit_walk(cursor.walk(), max_dirs=2,
+                                          cursor=cursor))
+            self.assertEqual([dir_entry[0] for dir_entry in dir_entries],
+                             listed)
+            self.assertEqual(2, cursor.dirs)
+        finally:
+            walkdir._scan_dir = scan_dir
+
+    def test_resume(self):
+        expected = [dir_entry[0] for dir_entry in scandir_walk(self.root_folder)]
+        cursor = WalkCursor(self.root_folder)
+        dirpaths = []
+        filename = os.path.join(self.test_folder, "cursor")
+        self.addCleanup(os.remove, filename)
+        while not cursor.finished:
+            walk_iter = limit_walk(cursor.walk(), max_dirs=2, cursor=cursor)
+            dirpaths.extend(dir_entry[0] for dir_entry in walk_iter)
+            cursor.save(filename)
+            cursor = WalkCursor.load(filename)
+            cursor = pickle.loads(pickle.dumps(cursor))
+        self.assertEqual(expected, dirpaths)
+        self.assertEqual(len(expected), cursor.dirs)
+        self.assertEqual(0, len(cursor))
+        self.assertEqual([], list(cursor.walk()))
+
+    def test_finished_dirs_are_not_listed(self):
+        cursor = WalkCursor(self.root_folder)
+        listed = []
+        scan_dir = walkdir._scan_dir
+        def _recording_scan(top, *args):
+            listed.append(top)
+            return scan_dir(top, *args)
+        walkdir._scan_dir = _recording_scan
+        try:
+            while not cursor.finished:
+                list(limit_walk(cursor.walk(), max_dirs=3, cursor=cursor))
+            self.assertEqual(sorted(set(listed)), sorted(listed))
+            self.assertEqual(len(expected_tree), len(listed))
+            # Without stopping the cursor, the last directory of each
+            # abandoned walk is walked again
+            cursor = WalkCursor(self.root_folder)
+            del listed[:]
+            dirpaths = []
+            while not cursor.finished:
+                walk_iter = cursor.walk()
+                dirpaths.extend(dir_entry[0] for dir_entry in
+                                    islice(walk_iter, 3))
+                walk_iter.close()
+        finally:
+            walkdir._scan_dir = scan_dir
+        self.assertEqual(listed, dirpaths)
+        self.assertEqual(len(expected_tree), len(set(listed)))
+        self.assertGreater(len(listed), len(expected_tree))
+
+    def test_filtered_walk(self):
+        options = [{}, {"depth": 1}, {"excluded_dirs": ["subdir2"]},
+                   {"included_files": ["*.txt"], "min_depth": 1}]
+        for kwds in options:
+            expected = list(file_paths(self.filtered_walk(**kwds)))
+            cursor = WalkCursor(self.root_folder)
+            paths = []
+            while not cursor.finished:
+                walk_iter = self.filtered_walk(cursor=cursor, max_files=2,
+                                               **kwds)
+                paths.extend(file_paths(walk_iter))
+            self.assertEqual(expected, paths)
+        cursor = WalkCursor(self.root_folder)
+        walk_iter = filtered_walk(self.root_folder, cursor=cursor, max_dirs=1)
+        self.assertEqual(1, len(list(walk_iter)))
+        self.assertEqual(1, cursor.dirs)
+        self.assertRaises(ValueError, list,
+                          filtered_walk(self.test_folder, cursor=cursor))
+        self.assertRaises(ValueError, list,
+                          filtered_walk(self.walk(), cursor=cursor))
+
+    def test_options_needing_ancestors(self):
+        # These options would lose the context of the directories above
+        # the one the walk resumes from
+        options = [{"ignore_files": [".gitignore"]},
+                   {"included_files": ["subdir1/*.txt"]},
+                   {"included_files": ["subdir1/**/*.txt"]},
+                   {"excluded_files": ["*.txt", "subdir1/*"]},
+                   {"included_dirs": ["subdir1/other"]},
+                   {"excluded_dirs": ["**/subdir2"]},
+                   {"followlinks": True},
+                   {"followlinks": True, "dedup": True},
+                   {"subtree_depths": {"subdir1": 0}}]
+        for kwds in options:
+            cursor = WalkCursor(self.root_folder)
+            walk_iter = filtered_walk(self.root_folder, cursor=cursor,
+                                      max_dirs=1, **kwds)
+            self.assertRaises(ValueError, next, walk_iter)
+            self.assertEqual(0, cursor.dirs)
+        # Name patterns don't depend on the directories above
+        cursor = WalkCursor(self.root_folder)
+        walk_iter = filtered_walk(self.root_folder, cursor=cursor,
+                                  included_dirs=["sub*"],
+                                  excluded_files=["*2*"])
+        self.assertWalkEqual(list(self.filtered_walk(included_dirs=["sub*"],
+                                                     excluded_files=["*2*"])),
+                             walk_iter)
+
+
+class WalkStatsTestCase(_BaseFileSystemWalkTestCase):
+
+    def test_stage_counters(self):
+        stats = WalkStats()
+        walk_iter = self.filtered_walk(excluded_dirs=['other'], min_depth=1,
+                                       excluded_files=['*2*'], stats=stats)
+        self.assertEqual(6, len(list(walk_iter)))
+        names = [stage.name for stage in stats.stages]
+        self.assertEqual(["walk", "exclude_dirs", "exclude_files", "min_depth"],
+                         names)
+        walk, dirs, files, depth = stats.stages
+        self.assertEqual(7, walk.dirs)
+        self.assertEqual(7, walk.syscalls)
+        self.assertEqual(7, dirs.dirs)
+        self.assertEqual(3, dirs.pruned)
+        # The top directory's files aren't listed, since min_depth skips it
+        self.assertEqual(6, files.pruned)
+        self.assertEqual(6, depth.dirs)
+        self.assertEqual(0, depth.pruned)
+        self.assertEqual(walk.items - dirs.pruned, dirs.items)
+        self.assertEqual(dirs.items - files.pruned, files.items)
+        for stage in stats.stages:
+            self.assertGreaterEqual(stage.wall_time, 0)
+            # Rates are based on each stage's own time
+            if stage.wall_time > 0:
+                self.assertAlmostEqual(stage.dirs / stage.wall_time,
+                                       stage.dirs_per_second)
+                self.assertAlmostEqual(stage.items / stage.wall_time,
+                                       stage.items_per_second)
+        self.assertGreaterEqual(stats.elapsed, stats.consumer_time)
+
+    def test_progress(self):
+        reports = []
+        def progress(stats):
+            reports.append(stats.stages[0].dirs)
+        stats = WalkStats(progress=progress, interval=0)
+        self.assertWalkEqual(expected_tree, self.filtered_walk(stats=stats))
+        self.assertEqual(list(range(1, len(expected_tree) + 1)) +
+                         [len(expected_tree)], reports)
+
+    def test_iterable_top(self):
+        stats = WalkStats()
+        walk_iter = filtered_walk(self.walk(), depth=0, stats=stats)
+        self.assertWalkEqual(depth_0_tree, walk_iter)
+        self.assertEqual(0, stats.stages[0].syscalls)
+        self.assertEqual(3, stats.stages[1].pruned)
+
+
+class VisitedDirsTestCase(unittest.TestCase):
+
+    def test_exact(self):
+        visited = VisitedDirs()
+        visited.add((1, 2))
+        visited.add((2, 1))
+        self.assertIn((1, 2), visited)
+        self.assertIn((2, 1), visited)
+        self.assertNotIn((1, 1), visited)
+        self.assertTrue(visited.exact)
+        self.assertEqual(2, len(visited))
+        self.assertGreater(visited.nbytes, 0)
+
+    def test_memory_cap(self):
+        visited = VisitedDirs(max_bytes=4096)
+        for ino in range(1000):
+            visited.add((7, ino))
+        self.assertFalse(visited.exact)
+        self.assertEqual(4096, visited.nbytes)
+        self.assertEqual(1000, len(visited))
+        for ino in range(1000):
+            self.assertIn((7, ino), visited)
+        false_positives = sum(1 for ino in range(1000, 2000)
+                                  if (7, ino) in visited)
+        self.assertLess(false_positives, 50)
+
+    def test_invalid_memory_cap(self):
+        self.assertRaises(ValueError, VisitedDirs, max_bytes=0)
+        self.assertRaises(ValueError, VisitedDirs, max_bytes=-1)
+
+
+class IgnoreFileTestCase(unittest.TestCase):
+
+    ignore_files = {
+        ".gitignore": "# Build output\n*.log\nbuild/\n!keep.log\n/top.txt\n"
+                      "docs/**/*.tmp\n",
+        "src/.gitignore": "*.c\n!main.c\n\n",
+        "other/.ignore": "*\n",
+    }
+    files = ["a.log", "keep.log", "top.txt", "build/out.txt",
+             "src/top.txt", "src/build", "src/main.c", "src/util.c",
+             "src/sub/main.c", "src/sub/util.c", "src/sub/debug.log",
+             "docs/c.tmp", "docs/a/b/c.tmp", "docs/a/b/c.txt",
+             "other/file.txt"]
+
+    def setUp(self):
+        self.test_folder = mkdtemp()
+        contents = dict.fromkeys(self.files, "walkdir")
+        contents.update(self.ignore_files)
+        for name, text in contents.items():
+            path = os.path.join(self.test_folder, *name.split("/"))
+            parent = os.path.dirname(path)
+            if not os.path.isdir(parent):
+                os.makedirs(parent)
+            with open(path, "w") as f:
+                f.write(text)
+
+    def tearDown(self):
+        rmtree(self.test_folder)
+
+    def relpaths(self, paths):
+        return sorted(os.path.relpath(path, self.test_folder).replace(os.sep, "/")
+                          for path in paths)
+
+    def test_gitignore(self):
+        walk_iter = filtered_walk(self.test_folder, ignore_files=[".gitignore"])
+        expected = [".gitignore", "keep.log", "src/.gitignore", "src/build",
+                    "src/main.c", "src/sub/main.c", "src/top.txt",
+                    "docs/a/b/c.txt", "other/.ignore", "other/file.txt"]
+        self.assertEqual(sorted(expected), self.relpaths(file_paths(walk_iter)))
+
+    def test_multiple_ignore_files(self):
+        walk_iter = filtered_walk(self.test_folder,
+                                  ignore_files=[".gitignore", ".ignore"])
+        paths = self.relpaths(file_paths(walk_iter))
+        self.assertFalse([path for path in paths if path.startswith("other/")])
+        self.assertIn("src/main.c", paths)
+
+    def test_ignored_dirs_are_pruned(self):
+        walk_iter = exclude_ignored(os.walk(self.test_folder), ".gitignore")
+        dirpaths = self.relpaths(dir_entry[0] for dir_entry in walk_iter)
+        self.assertNotIn("build", dirpaths)
+        self.assertIn("src/sub", dirpaths)
+
+    def test_breadth_first(self):
+        # The rules for the directories in between are recovered when a
+        # breadth-first walk moves to a different subtree
+        expected = self.relpaths(file_paths(exclude_ignored(
+                       os.walk(self.test_folder), ".gitignore")))
+        walk_iter = exclude_ignored(breadth_first_walk(self.test_folder),
+                                    ".gitignore")
+        self.assertEqual(expected, self.relpaths(file_paths(walk_iter)))
+        self.assertIn("src/sub/main.c", expected)
+        self.assertNotIn("src/sub/util.c", expected)
+
+    def test_trailing_double_star(self):
+        # Like git, "docs/**" ignores everything in docs, but not docs itself
+        with open(os.path.join(self.test_folder, ".gitignore"), "w") as f:
+            f.write("docs/**\n")
+        walk_iter = exclude_ignored(os.walk(self.test_folder), ".gitignore")
+        dirpaths = []
+        for dirpath, subdirs, files in walk_iter:
+            dirpaths.append(dirpath)
+            if os.path.basename(dirpath) == "docs":
+                self.assertEqual([], subdirs + files)
+        dirpaths = self.relpaths(dirpaths)
+        self.assertIn("docs", dirpaths)
+        self.assertNotIn("docs/a", dirpaths)
+
+    def test_no_ignore_files(self):
+        walk_iter = exclude_ignored(os.walk(self.test_folder))
+        paths = self.relpaths(file_paths(walk_iter))
+        self.assertEqual(len(self.files) + len(self.ignore_files), len(paths))
+
+
+@unittest.skipIf(not hasattr(os, "scandir"),
+                 "No os.scandir")
+class DirCacheTestCase(_BaseFileSystemWalkTestCase):
+    # The tests modify the tree, so each test gets a fresh copy
+
+    @classmethod
+    def setUpClass(cls):
+        pass
+
+    @classmethod
+    def tearDownClass(cls):
+        pass
+
+    def setUp(self):
+        super(DirCacheTestCase, self).setUpClass()
+        self.cache = DirCache()
+
+    def tearDown(self):
+        super(DirCacheTestCase, self).tearDownClass()
+
+    def age_tree(self):
+        # Freshly modified directories are deliberately not trusted, so
+        # backdate them (by a different amount each time)
+        self.timestamp = getattr(self, "timestamp", 0) + 1
+        for dirpath, _, _ in os.walk(self.root_folder):
+            os.utime(dirpath, (self.timestamp, self.timestamp))
+
+    def listed_dirs(self, walk_iter):
+        listed = []
+        scan_dir = walkdir._scan_dir
+        def _recording_scan(top, onerror):
+            listed.append(top)
+            return scan_dir(top, onerror)
+        walkdir._scan_dir = _recording_scan
+        try:
+            result = list(walk_iter)
+        finally:
+            walkdir._scan_dir = scan_dir
+        return result, listed
+
+    def test_cached_walk(self):
+        self.age_tree()
+        result, listed = self.listed_dirs(cached_walk(self.root_folder, self.cache))
+        self.assertWalkEqual(expected_tree, result)
+        self.assertEqual(len(expected_tree), len(listed))
+        self.assertEqual(len(expected_tree), len(self.cache))
+        result, listed = self.listed_dirs(cached_walk(self.root_folder, self.cache))
+        self.assertWalkEqual(expected_tree, result)
+        self.assertEqual([], listed)
+
+    def test_missing_support(self):
+        saved = walkdir._scandir
+        walkdir._scandir = None
+        try:
+            self.assertRaises(RuntimeError, cached_walk, self.root_folder,
+                              self.cache)
+            self.assertRaises(RuntimeError, list,
+                              filtered_walk(self.root_folder, cache=self.cache))
+        finally:
+            walkdir._scandir = saved
+
+    def test_plain_names(self):
+        # Listed and cached directories produce the same types of names
+        self.age_tree()
+        for i in range(2):
+            for dirpath, subdirs, files in cached_walk(self.root_folder, self.cache):
+                self.assertEqual(set([str]),
+                                 set(type(name) for name in subdirs + files))
+
+    def test_recent_changes_are_relisted(self):
+        list(cached_walk(self.root_folder, self.cache))
+        _, listed = self.listed_dirs(cached_walk(self.root_folder, self.cache))
+        self.assertEqual(len(expected_tree), len(listed))
+
+    def test_filtered_walk(self):
+        self.age_tree()
+        list(self.filtered_walk(cache=self.cache))
+        walk_iter = self.filtered_walk(cache=self.cache, included_dirs=['sub*'],
+                                       excluded_dirs=['*2'])
+        result, listed = self.listed_dirs(walk_iter)
+        self.assertWalkEqual(dir_filtered_tree, result)
+        self.assertEqual([], listed)
+
+    def test_changes(self):
+        self.age_tree()
+        changes = list(cache_changes(self.root_folder, self.cache))
+        self.assertEqual(len(expected_tree), len(changes))
+        self.assertEqual([], list(cache_changes(self.root_folder, self.cache)))
+        subdir1 = os.path.join(self.root_folder, "subdir1")
+        with open(os.path.join(subdir1, "new.txt"), "w"):
+            pass
+        os.remove(os.path.join(subdir1, "file1.txt"))
+        other = os.path.join(subdir1, "other")
+        os.remove(os.path.join(other, "file1.txt"))
+        os.mkdir(os.path.join(other, "file1.txt"))
+        self.age_tree()
+        changes = list(cache_changes(self.root_folder, self.cache))
+        self.assertEqual([(subdir1, ["new.txt"], ["file1.txt"], []),
+                          (other, [], [], ["file1.txt"])], changes)
+
+    def test_removed_subtrees_are_discarded(self):
+        self.age_tree()
+        list(cached_walk(self.root_folder, self.cache))
+        subdir2 = os.path.join(self.root_folder, "subdir2")
+        rmtree(subdir2)
+        changes = list(cache_changes(self.root_folder, self.cache))
+        self.assertEqual([(self.root_folder, [], ["subdir2"], [])], changes)
+        self.assertEqual(len(expected_tree) - 4, len(self.cache))
+        self.assertNotIn(subdir2, self.cache)
+
+    def test_invalidate(self):
+        self.age_tree()
+        list(cached_walk(self.root_folder, self.cache))
+        subdir1 = os.path.join(self.root_folder, "subdir1")
+        self.cache.invalidate(subdir1)
+        self.assertEqual(len(expected_tree) - 4, len(self.cache))
+        _, listed = self.listed_dirs(cached_walk(self.root_folder, self.cache))
+        self.assertEqual(4, len(listed))
+        self.assertTrue(all(path.startswith(subdir1) for path in listed))
+
+    def test_save_and_load(self):
+        self.age_tree()
+        list(cached_walk(self.root_folder, self.cache))
+        filename = os.path.join(self.test_folder, "cache")
+        self.cache.save(filename)
+        cache = DirCache.load(filename)
+        self.assertEqual(len(self.cache), len(cache))
+        result, listed = self.listed_dirs(cached_walk(self.root_folder, cache))
+        self.assertWalkEqual(expected_tree, result)
+        self.assertEqual([], listed)
+        with open(filename, "wb") as f:
+            f.write(b"not a cache")
+        self.assertRaises(ValueError, DirCache.load, filename)
+
+
+def component_order(paths):
+    return sorted(paths, key=lambda path: path.split(os.sep))
+
+
+class SnapshotOrderTestCase(_BaseWalkTestCase):
+
+    def test_entry_order(self):
+        expected = component_order(path[len("root/"):]
+                                       for path in expected_paths[1:])
+        entries = list(snapshot_entries(self.walk()))
+        self.assertEqual(expected, [entry.path for entry in entries])
+        for entry in entries:
+            self.assertEqual(not entry.path.endswith(".txt"), entry.is_dir)
+            self.assertIsNone(entry.size)
+
+    def test_filtered_entry_order(self):
+        walk_iter = self.filtered_walk(depth=0, included_files=['file*'])
+        paths = [entry.path for entry in snapshot_entries(walk_iter)]
+        self.assertEqual(['file1.txt', 'file2.txt', 'other', 'subdir1',
+                          'subdir2'], paths)
+
+    def test_diff_walks(self):
+        walk_iter = self.filtered_walk(included_files=['file*'],
+                                       excluded_dirs=['other'])
+        diff = list(diff_snapshots(snapshot_entries(self.walk()),
+                                   snapshot_entries(walk_iter)))
+        self.assertEqual(set(["removed"]), set(d.status for d in diff))
+        def _kept(path):
+            parts = path.split(os.sep)
+            if parts[-1].endswith(".txt"):
+                return "other" not in parts[:-1] and parts[-1].startswith("file")
+            return "other" not in parts
+        paths = [path[len("root/"):] for path in expected_paths[1:]]
+        expected = component_order(p for p in paths if not _kept(p))
+        self.assertEqual(expected, [d.path for d in diff])
+
+
+class SnapshotTestCase(_BaseFileSystemWalkTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        pass
+
+    @classmethod
+    def tearDownClass(cls):
+        pass
+
+    def setUp(self):
+        super(SnapshotTestCase, self).setUpClass()
+        self.snapshot = os.path.join(self.test_folder, "snapshot")
+
+    def tearDown(self):
+        super(SnapshotTestCase, self).tearDownClass()
+
+    def test_round_trip(self):
+        for stat in (False, True):
+            entries = list(snapshot_entries(self.filtered_walk(), stat))
+            count = write_snapshot(self.filtered_walk(), self.snapshot, stat)
+            self.assertEqual(len(expected_paths) - 1, count)
+            self.assertEqual(entries, list(read_snapshot(self.snapshot)))
+        path = os.path.join(self.root_folder, "subdir1", "file1.txt")
+        entry = [entry for entry in entries
+                     if entry.path == os.path.join("subdir1", "file1.txt")][0]
+        self.assertEqual(len("walkdir"), entry.size)
+        self.assertEqual(os.stat(path).st_ino, entry.ino)
+
+    def test_diff_live_walk(self):
+        write_snapshot(self.filtered_walk(), self.snapshot, stat=True)
+        self.assertEqual([], list(diff_snapshots(self.snapshot, self.snapshot)))
+        subdir1 = os.path.join(self.root_folder, "subdir1")
+        os.remove(os.path.join(subdir1, "file1.txt"))
+        with open(os.path.join(subdir1, "file2.txt"), "a") as f:
+            f.write("changed")
+        os.remove(os.path.join(subdir1, "other.txt"))
+        os.mkdir(os.path.join(subdir1, "other.txt"))
+        with open(os.path.join(subdir1, "other.txt", "new.txt"), "w"):
+            pass
+        live = snapshot_entries(self.filtered_walk(), stat=True)
+        diff = [(d.status, d.path) for d in diff_snapshots(self.snapshot, live)]
+        self.assertEqual([("removed", os.path.join("subdir1", "file1.txt")),
+                          ("changed", os.path.join("subdir1", "file2.txt")),
+                          ("changed", os.path.join("subdir1", "other.txt")),
+                          ("added", os.path.join("subdir1", "other.txt", "new.txt"))],
+                         diff)
+
+    def test_invalid_snapshot(self):
+        with open(self.snapshot, "wb") as f:
+            f.write(b"not a snapshot")
+        self.assertRaises(ValueError, list, read_snapshot(self.snapshot))
+
+
 class SymlinkTestCase(_BaseFileSystemWalkTestCase):
 
     @classmethod
@@ -618,6 +2397,107 @@ class SymlinkLoopTestCase(_BaseFileSystemWalkTestCase):
                              handle_symlink_loops(self.walk(followlinks=True)))
 
 
+    def make_link_tree(self, links):
+        # Sibling directories linked to each other outside the walked tree
+        folder = mkdtemp()
+        self.addCleanup(rmtree, folder)
+        for name in "top b c".split():
+            os.mkdir(os.path.join(folder, name))
+        for link_name, source in links:
+            os.symlink(os.path.join(folder, source),
+                       os.path.join(folder, link_name))
+        self.root_folder = os.path.join(folder, "top")
+        return folder
+
+    def test_loop_through_sibling_links(self):
+        folder = self.make_link_tree([("top/l", "b"), ("b/l2", "c"), ("c/l3", "b")])
+        loop_list = []
+        walk_iter = handle_symlink_loops(self.walk(followlinks=True),
+                                         onloop=loop_list.append)
+        dirpaths = [dir_entry[0] for dir_entry in walk_iter]
+        loop = os.path.join(folder, "top", "l", "l2", "l3")
+        self.assertEqual([loop], loop_list)
+        self.assertEqual(3, len(dirpaths))
+
+    def test_visited(self):
+        self.make_link_tree([("top/x", "b"), ("top/y", "b")])
+        loop_list = []
+        walk_iter = handle_symlink_loops(self.walk(followlinks=True),
+                                         onloop=loop_list.append)
+        self.assertEqual(3, len(list(walk_iter)))
+        self.assertEqual([], loop_list)
+        visited = set()
+        walk_iter = handle_symlink_loops(self.walk(followlinks=True),
+                                         onloop=loop_list.append,
+                                         visited=visited)
+        self.assertEqual(2, len(list(walk_iter)))
+        self.assertEqual(1, len(loop_list))
+        self.assertEqual(2, len(visited))
+
+    def test_onrepeat(self):
+        self.make_link_tree([("top/x", "b"), ("top/y", "b"),
+                             ("b/up", "top")])
+        loop_list = []
+        repeat_list = []
+        walk_iter = handle_symlink_loops(self.walk(followlinks=True),
+                                         onloop=loop_list.append,
+                                         visited=VisitedDirs(),
+                                         onrepeat=repeat_list.append)
+        self.assertEqual(2, len(list(walk_iter)))
+        self.assertEqual(1, len(loop_list))
+        self.assertEqual(1, len(repeat_list))
+
+    def test_default_messages(self):
+        self.make_link_tree([("top/x", "b"), ("top/y", "b"), ("b/up", "top")])
+        messages = []
+        class _Stderr(object):
+            write = messages.append
+            def flush(self):
+                pass
+        stderr = walkdir.sys.stderr
+        walkdir.sys.stderr = _Stderr()
+        try:
+            walk_iter = handle_symlink_loops(self.walk(followlinks=True),
+                                             visited=VisitedDirs())
+            self.assertEqual(2, len(list(walk_iter)))
+        finally:
+            walkdir.sys.stderr = stderr
+        self.assertEqual(2, len(messages))
+        self.assertEqual(1, len([msg for msg in messages
+                                     if "refers to a parent directory" in msg]))
+        self.assertEqual(1, len([msg for msg in messages
+                                     if "already been walked" in msg]))
+
+    def test_filtered_walk_dedup(self):
+        self.make_link_tree([("top/x", "b"), ("top/y", "b")])
+        visited = VisitedDirs()
+        walk_iter = filtered_walk(self.root_folder, followlinks=True,
+                                  dedup=visited)
+        self.assertEqual(2, len(list(walk_iter)))
+        self.assertEqual(2, len(visited))
+        walk_iter = filtered_walk(self.root_folder, followlinks=True)
+        self.assertEqual(3, len(list(walk_iter)))
+
+
+class ScandirSymlinkTestCase(_BaseFileSystemScandirWalkTestCase, SymlinkTestCase):
+
+    def filtered_walk(self, *args, **kwds):
+        walk_iter = self.walk(followlinks=kwds.get("followlinks", False))
+        return filtered_walk(walk_iter, *args, **kwds)
+
+
+class ScandirSymlinkLoopTestCase(_BaseFileSystemScandirWalkTestCase, SymlinkLoopTestCase):
+    pass
+
+
+class ParallelSymlinkLoopTestCase(_BaseFileSystemParallelWalkTestCase, SymlinkLoopTestCase):
+    pass
+
+
+class BreadthFirstSymlinkLoopTestCase(_BaseFileSystemBreadthFirstWalkTestCase, SymlinkLoopTestCase):
+    pass
+
+
 
 
 if __name__ == "__main__":
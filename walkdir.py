@@ -1,9 +1,24 @@
 # -*- coding: utf-8 -*-
 """walkdir - iterative tools for working with os.walk() and similar interfaces
 """
+import collections
+import contextlib
 import fnmatch
+import hashlib
+import heapq
+import itertools
+import marshal
+import math
+import mmap
+import operator
 import os.path
+import random as _random
+import re
+import stat as _stat
+import struct
 import sys
+import threading
+import time
 
 # Should be compatible with 2.7 and 3.2+
 try:
@@ -11,201 +26,1877 @@ try:
 except NameError:
     _str_base = str
 
+# os.fsencode and os.fsdecode are 3.2+
+try:
+    _fsencode = os.fsencode
+except AttributeError:
+    def _fsencode(path):
+        if isinstance(path, bytes):
+            return path
+        return path.encode(sys.getfilesystemencoding())
+
+try:
+    _fsdecode = os.fsdecode
+except AttributeError:
+    def _fsdecode(path):
+        if isinstance(path, bytes):
+            return path.decode(sys.getfilesystemencoding())
+        return path
+
+_bytes_sep = os.sep.encode("ascii")
+_bytes_altsep = os.altsep and os.altsep.encode("ascii")
+
+# os.scandir is 3.5+, but the scandir backport offers the same API
+try:
+    from os import scandir as _scandir
+except ImportError:
+    try:
+        from scandir import scandir as _scandir
+    except ImportError:
+        _scandir = None
+
+# concurrent.futures is 3.2+, but the futures backport offers the same API
+try:
+    from concurrent import futures as _futures
+except ImportError:
+    _futures = None
+
+# time.perf_counter and time.process_time are 3.3+
+try:
+    _wall_time = time.perf_counter
+    _cpu_time = time.process_time
+except AttributeError:
+    _wall_time = time.time
+    _cpu_time = time.clock
+
+# asyncio is 3.4+ (and "async for" is 3.5+)
+try:
+    import asyncio as _asyncio
+except ImportError:
+    _asyncio = None
+
+# Walking directories with cached directory entries
+
+class _EntryName(object):
+    """The directory entry queries shared by the cached entry name types"""
+    __slots__ = ()
+
+    @property
+    def path(self):
+        """The full path to the entry"""
+        return self.entry.path
+
+    def inode(self):
+        """Return the inode number of the entry"""
+        return self.entry.inode()
+
+    def is_dir(self, follow_symlinks=True):
+        """Return True if the entry is a directory (or a link to one)"""
+        return self.entry.is_dir(follow_symlinks=follow_symlinks)
+
+    def is_file(self, follow_symlinks=True):
+        """Return True if the entry is a file (or a link to one)"""
+        return self.entry.is_file(follow_symlinks=follow_symlinks)
+
+    def is_symlink(self):
+        """Return True if the entry is a symbolic link"""
+        return self.entry.is_symlink()
+
+    def stat(self, follow_symlinks=True):
+        """Return the (cached) stat result for the entry"""
+        return self.entry.stat(follow_symlinks=follow_symlinks)
+
+class WalkEntry(_EntryName, str):
+    """A name produced by :func:`scandir_walk` that remembers its directory entry
+
+    Instances behave like ordinary strings (so they work unchanged with the
+    filtering functions and with :func:`os.path.join`), but also provide the
+    query methods of the underlying :class:`os.DirEntry`. File type and inode
+    queries are answered from the directory listing itself, and
+    :meth:`stat` results are cached, so consumers can ask "is this a
+    directory?" or "how big is it?" without making additional system calls
+    for information the operating system already supplied.
+
+    The ``entry`` attribute refers to the underlying :class:`os.DirEntry`
+    (or, for names produced by :func:`attach_stat`, an object offering the
+    same query methods based on an already fetched stat result). Pickling
+    or copying an instance produces a plain string.
+    """
+    def __new__(cls, name, entry):
+        self = str.__new__(cls, name)
+        self.entry = entry
+        return self
+
+    def __reduce__(self):
+        return str, (str(self),)
+
+class BytesWalkEntry(_EntryName, bytes):
+    """The :class:`bytes` equivalent of :class:`WalkEntry`
+
+    Produced instead of :class:`WalkEntry` when walking a :class:`bytes`
+    path, and offers the same query methods. Pickling or copying an
+    instance produces a plain :class:`bytes` object.
+    """
+    def __new__(cls, name, entry):
+        self = bytes.__new__(cls, name)
+        self.entry = entry
+        return self
+
+    def __reduce__(self):
+        return bytes, (bytes(self),)
+
+# On Python 2, bytes is str, so names always produce WalkEntry instances
+_ENTRY_NAME_TYPES = {bytes: BytesWalkEntry, str: WalkEntry}
+
+def _entry_name(name, entry):
+    """Create a name of the same type as *name* that remembers *entry*"""
+    return _ENTRY_NAME_TYPES.get(type(name), WalkEntry)(name, entry)
+
+def _plain_name(name):
+    """Convert a name to a plain string (or bytes), dropping any cached entry"""
+    if isinstance(name, bytes) and bytes is not str:
+        return bytes(name)
+    return str(name)
+
+def _path_sep(path):
+    """Get the separator to use with a path of the same type as *path*"""
+    if isinstance(path, bytes) and bytes is not str:
+        return _bytes_sep
+    return os.sep
+
+def _is_symlink(path):
+    """Check for a symlink, using cached directory entry data if available"""
+    if isinstance(path, _EntryName):
+        return path.is_symlink()
+    return os.path.islink(path)
+
+class WalkTriple(tuple):
+    """A ``dirpath, subdirs, files`` triple that also records its depth
+
+    Produced by :func:`scandir_walk`, :func:`parallel_walk` and
+    :func:`cached_walk`. The ``depth`` attribute gives the number of levels
+    between *dirpath* and the top of the walk (so the top directory itself
+    has a depth of zero), which allows :func:`limit_depth` and
+    :func:`min_depth` to check depths without examining the paths.
+    """
+    def __new__(cls, dirpath, subdirs, files, depth):
+        self = tuple.__new__(cls, (dirpath, subdirs, files))
+        self.depth = depth
+        return self
+
+    def __reduce__(self):
+        return WalkTriple, tuple(self) + (self.depth,)
+
+def _lstat_or_stat(path, follow_symlinks):
+    if follow_symlinks:
+        return os.stat(path)
+    return os.lstat(path)
+
+def _name_stat(dirpath, name, follow_symlinks=True):
+    """Get the stat result for a name, reusing any cached result"""
+    if isinstance(name, _EntryName):
+        return name.stat(follow_symlinks=follow_symlinks)
+    return _lstat_or_stat(os.path.join(dirpath, name), follow_symlinks)
+
+class _StatEntry(object):
+    """Directory entry details derived from a separately fetched stat result"""
+    def __init__(self, path, st, follow_symlinks):
+        self.path = path
+        self._stat = {follow_symlinks: st}
+
+    def inode(self):
+        return self.stat(follow_symlinks=False).st_ino
+
+    def is_dir(self, follow_symlinks=True):
+        return _stat.S_ISDIR(self.stat(follow_symlinks).st_mode)
+
+    def is_file(self, follow_symlinks=True):
+        return _stat.S_ISREG(self.stat(follow_symlinks).st_mode)
+
+    def is_symlink(self):
+        return _stat.S_ISLNK(self.stat(follow_symlinks=False).st_mode)
+
+    def stat(self, follow_symlinks=True):
+        try:
+            return self._stat[follow_symlinks]
+        except KeyError:
+            pass
+        st = self._stat[follow_symlinks] = _lstat_or_stat(self.path,
+                                                          follow_symlinks)
+        return st
+
+def _scan_dir(top, onerror, subdirs_only=False):
+    """Split the contents of *top* into lists of subdirectories and files
+
+    If *subdirs_only* is true, the file list is left empty.
+
+    Returns ``None`` (after passing the exception to *onerror*) if the
+    directory can't be listed.
+    """
+    subdirs = []
+    files = []
+    try:
+        scandir_it = _scandir(top)
+    except OSError as error:
+        if onerror is not None:
+            onerror(error)
+        return None
+    try:
+        for entry in scandir_it:
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            if is_dir:
+                subdirs.append(_entry_name(entry.name, entry))
+            elif not subdirs_only:
+                files.append(_entry_name(entry.name, entry))
+    except OSError as error:
+        if onerror is not None:
+            onerror(error)
+        return None
+    finally:
+        close = getattr(scandir_it, "close", None)
+        if close is not None:
+            close()
+    return subdirs, files
+
+def _subdir_path(dirpath, subdir):
+    """Get the path to a subdirectory, keeping its cached directory entry"""
+    if isinstance(subdir, _EntryName):
+        return _entry_name(subdir.path, subdir.entry)
+    return os.path.join(dirpath, subdir)
+
+def _dir_prefix(dirpath):
+    """Get the prefix used to join names to *dirpath*"""
+    if isinstance(dirpath, bytes):
+        sep, altsep = _bytes_sep, _bytes_altsep
+    else:
+        sep, altsep = os.sep, os.altsep
+    if not dirpath or dirpath.endswith(sep) or (altsep and dirpath.endswith(altsep)):
+        return dirpath
+    return dirpath + sep
+
+def scandir_walk(top, topdown=True, onerror=None, followlinks=False,
+                 min_file_depth=0):
+    """A native :func:`os.walk` equivalent built directly on :func:`os.scandir`
+
+    Accepts the same arguments as :func:`os.walk` and produces the same
+    ``dirpath, subdirs, files`` triples, but the names in the subdirectory
+    and file lists are :class:`WalkEntry` instances that retain the cached
+    directory entry data (file type, inode and stat results) rather than
+    discarding it. Subdirectory paths are likewise produced as
+    :class:`WalkEntry` instances, so later stages (such as
+    :func:`handle_symlink_loops`) can check whether they were reached via
+    a symlink without going back to the filesystem.
+
+    As with :func:`os.walk`, names may be removed from the subdirectory
+    lists in a top-down walk to avoid descending into those directories.
+    The triples are produced as :class:`WalkTriple` instances.
+
+    Directories less than *min_file_depth* levels below *top* are reported
+    with empty file lists, which saves some work when only the files
+    further down the tree are of interest (see :func:`min_depth`).
+
+    Requires :func:`os.scandir` (or the ``scandir`` backport on older
+    versions of Python).
+    """
+    return _scandir_walk(top, topdown, onerror, followlinks, 0, min_file_depth)
+
+def _scandir_walk(top, topdown, onerror, followlinks, depth, min_file_depth):
+    listing = _scan_dir(top, onerror, depth < min_file_depth)
+    if listing is None:
+        return
+    subdirs, files = listing
+    if topdown:
+        yield WalkTriple(top, subdirs, files, depth)
+    for subdir in subdirs:
+        new_path = _subdir_path(top, subdir)
+        # Names added to the list by the caller won't have cached entries
+        if followlinks or not _is_symlink(new_path):
+            for dir_entry in _scandir_walk(new_path, topdown, onerror,
+                                           followlinks, depth + 1,
+                                           min_file_depth):
+                yield dir_entry
+    if not topdown:
+        yield WalkTriple(top, subdirs, files, depth)
+
+def _scan_dir_in_worker(top, subdirs_only=False):
+    # Errors are collected and reported from the consuming thread
+    errors = []
+    return _scan_dir(top, errors.append, subdirs_only), errors
+
+_PREFETCH_PER_WORKER = 4
+
+def parallel_walk(top, workers=8, ordered=True, onerror=None, followlinks=False,
+                  min_file_depth=0):
+    """A top-down :func:`scandir_walk` that lists directories from a thread pool
+
+    Produces the same ``dirpath, subdirs, files`` triples as
+    :func:`scandir_walk`, but directory listings are requested from a pool of
+    *workers* threads, so that several listings can be waiting on the
+    filesystem at once (this mostly helps on network filesystems, where each
+    listing is dominated by round-trip latency).
+
+    Listings for the subdirectories of a directory are only scheduled once
+    the consumer asks for the next triple, and hence *after* any downstream
+    filters (such as :func:`include_dirs`, :func:`exclude_dirs`,
+    :func:`limit_depth` and :func:`handle_symlink_loops`) have pruned the
+    subdirectory list. Pruned directories are never listed.
+
+    If *ordered* is true (the default), triples are produced in the same
+    deterministic top-down order as :func:`scandir_walk` and the directory
+    listings are prefetched. Otherwise, triples are produced as soon as the
+    listings complete. Either way, no more than a few listings per worker
+    are requested ahead of the consumer.
+
+    *onerror* and *followlinks* have the same meaning as they do for
+    :func:`os.walk`. *onerror* is always called from the consuming thread.
+    *min_file_depth* has the same meaning as it does for
+    :func:`scandir_walk`.
+
+    Requires :func:`os.scandir` and :mod:`concurrent.futures` (or the
+    ``scandir`` and ``futures`` backports on older versions of Python).
+    """
+    if _scandir is None or _futures is None:
+        msg = ("Parallel walks require os.scandir and concurrent.futures "
+               "(or the scandir and futures backports)")
+        raise RuntimeError(msg)
+    return _parallel_walk(top, workers, ordered, onerror, followlinks,
+                          min_file_depth)
+
+def _parallel_walk(top, workers, ordered, onerror, followlinks, min_file_depth):
+    executor = _futures.ThreadPoolExecutor(max_workers=workers)
+    def _schedule(dirpath, depth):
+        return executor.submit(_scan_dir_in_worker, dirpath,
+                               depth < min_file_depth)
+    def _subdir_paths(dirpath, subdirs):
+        for subdir in subdirs:
+            new_path = _subdir_path(dirpath, subdir)
+            if followlinks or not _is_symlink(new_path):
+                yield new_path
+    def _get_listing(future):
+        listing, errors = future.result()
+        if onerror is not None:
+            for error in errors:
+                onerror(error)
+        return listing
+    # At most *window* listings are requested ahead of the consumer. The rest
+    # of the frontier is kept as unscheduled ``[dirpath, depth, future]``
+    # entries (with no future), which are only scheduled as the window drains
+    window = _PREFETCH_PER_WORKER * workers
+    pending = {}
+    def _request(entry):
+        entry[2] = _schedule(entry[0], entry[1])
+        pending[entry[2]] = entry
+    if ordered:
+        # A depth first stack, with listings requested for the entries the
+        # walk will reach next. Entries below the stack top never move, so
+        # listings that fall outside the window can be withdrawn by position
+        stack = [[top, 0, None, 0]]
+        def _prefetch():
+            low = len(stack) - window
+            for future, entry in list(pending.items()):
+                if entry[3] < low and future.cancel():
+                    entry[2] = None
+                    del pending[future]
+            for entry in reversed(stack[max(low, 0):]):
+                if len(pending) >= window:
+                    break
+                if entry[2] is None:
+                    _request(entry)
+        def _next_entry():
+            _prefetch()
+            entry = stack.pop()
+            if entry[2] is None:
+                # Listings outside the window may already be running
+                _request(entry)
+            del pending[entry[2]]
+            return entry
+        def _add_entries(entries):
+            for entry in reversed(entries):
+                entry.append(len(stack))
+                stack.append(entry)
+        has_entries = stack.__len__
+    else:
+        waiting = collections.deque([[top, 0, None]])
+        def _next_entry():
+            while waiting and len(pending) < window:
+                _request(waiting.popleft())
+            done, _ = _futures.wait(pending,
+                                    return_when=_futures.FIRST_COMPLETED)
+            return pending.pop(next(iter(done)))
+        _add_entries = waiting.extend
+        def has_entries():
+            return waiting or pending
+    try:
+        while has_entries():
+            dirpath, depth, future = _next_entry()[:3]
+            listing = _get_listing(future)
+            if listing is None:
+                continue
+            subdirs, files = listing
+            yield WalkTriple(dirpath, subdirs, files, depth)
+            _add_entries([[new_path, depth + 1, None] for new_path
+                                in _subdir_paths(dirpath, subdirs)])
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+def _frontier_walk(top, onerror, followlinks, min_file_depth, key):
+    """Walk directories in the order they come out of a frontier of subdirectories
+
+    The frontier is a FIFO queue, or a heap ordered by *key* if given.
+    Rather than full paths, it holds ``parent index, name`` pairs, where
+    the index refers to a table of the directories with subdirectories
+    still waiting in the frontier (each entry is removed once all of its
+    subdirectories have been visited).
+    """
+    # Maps parent indices to [dirpath, depth, subdirectories in frontier]
+    parents = {}
+    frontier = collections.deque() if key is None else []
+    next_index = 0
+    counter = itertools.count()
+    dirpath = top
+    depth = 0
+    while True:
+        listing = _scan_dir(dirpath, onerror, depth < min_file_depth)
+        if listing is not None:
+            subdirs, files = listing
+            yield WalkTriple(dirpath, subdirs, files, depth)
+            # Only subdirectories that survived any downstream filtering
+            # are added to the frontier
+            scheduled = 0
+            for subdir in subdirs:
+                new_path = _subdir_path(dirpath, subdir)
+                # Names added to the list by the caller won't have cached entries
+                if not followlinks and _is_symlink(new_path):
+                    continue
+                name = _plain_name(subdir)
+                if key is None:
+                    frontier.append((next_index, name))
+                else:
+                    heapq.heappush(frontier, (key(new_path), next(counter),
+                                              next_index, name))
+                scheduled += 1
+            if scheduled:
+                parents[next_index] = [_plain_name(dirpath), depth, scheduled]
+                next_index += 1
+        if not frontier:
+            return
+        if key is None:
+            index, name = frontier.popleft()
+        else:
+            index, name = heapq.heappop(frontier)[2:]
+        parent = parents[index]
+        parent[2] -= 1
+        if not parent[2]:
+            del parents[index]
+        dirpath = os.path.join(parent[0], name)
+        depth = parent[1] + 1
+
+def breadth_first_walk(top, onerror=None, followlinks=False, min_file_depth=0):
+    """A breadth-first equivalent of :func:`scandir_walk`
+
+    Produces the same ``dirpath, subdirs, files`` triples (as
+    :class:`WalkTriple` instances), but visits every directory at one
+    depth before any directory at the next depth, so shallow matches are
+    found first, and a walk that is stopped early (or limited with
+    :func:`limit_depth`) has covered the top levels of the tree fully.
+
+    As in a top-down walk, names may be removed from the subdirectory
+    lists to avoid descending into those directories. Subdirectories are
+    only added to the frontier of directories still to be visited once the
+    consumer asks for the next triple (after any downstream filters have
+    pruned the list). The frontier holds each subdirectory as a name and
+    the index of its parent in a table of parent paths, so a wide level
+    doesn't need a full path for every directory waiting to be visited
+    (subdirectory paths are produced as plain strings, without the cached
+    directory entries :func:`scandir_walk` retains).
+
+    *onerror*, *followlinks* and *min_file_depth* have the same meaning as
+    they do for :func:`scandir_walk`. The flattening iterators and the
+    filters that require a top-down traversal all support breadth-first
+    walks (although the *sorted* option of the flattening iterators doesn't).
+
+    Requires :func:`os.scandir` (or the ``scandir`` backport on older
+    versions of Python).
+    """
+    return _frontier_walk(top, onerror, followlinks, min_file_depth, None)
+
+def best_first_walk(top, key, onerror=None, followlinks=False,
+                    min_file_depth=0):
+    """A :func:`breadth_first_walk` that visits directories in order of priority
+
+    *key* is called with the path to each subdirectory when it is added to
+    the frontier, and the directory with the lowest key (as for
+    :func:`sorted`) is visited next, regardless of its depth. Directories
+    with equal keys are visited in the order they were found. The paths
+    passed to *key* are :class:`WalkEntry` instances, so stat results are
+    cached. For example, to visit the most recently modified directories
+    first::
+
+        walk_iter = best_first_walk(top, lambda path: -path.stat().st_mtime)
+
+    The other arguments have the same meaning as they do for
+    :func:`breadth_first_walk`, and the frontier is stored the same way
+    (with the key for each subdirectory).
+    """
+    return _frontier_walk(top, onerror, followlinks, min_file_depth, key)
+
+# Incremental walks based on a cache of directory listings
+
+DirChanges = collections.namedtuple("DirChanges", "dirpath added removed changed")
+
+def _mtime_ns(st):
+    mtime_ns = getattr(st, "st_mtime_ns", None)
+    if mtime_ns is None:
+        mtime_ns = int(st.st_mtime * 1000000000)
+    return mtime_ns
+
+class DirCache(object):
+    """A cache of directory listings, validated by directory mtime and inode
+
+    Used with :func:`cached_walk` (or the *cache* option of
+    :func:`filtered_walk`), this allows repeated walks of a largely unchanged
+    tree to skip listing any directory whose modification time, inode and
+    device number are unchanged since the previous walk. Each directory still
+    needs a single :func:`os.stat` call to check its validity.
+
+    A directory's modification time only changes when entries are added,
+    removed or renamed, so the cache tracks the *names* in each directory,
+    not changes to the contents of the files themselves. Directories modified
+    within the last :attr:`racy_window` seconds before they were listed are
+    always listed again on the next walk, since further changes may not have
+    altered the recorded modification time.
+
+    Caches can be saved to disk with :meth:`save` and read back with
+    :meth:`load`. The file format uses :mod:`marshal`, so it is compact and
+    quick to load, but only readable by the Python version that wrote it.
+    """
+    racy_window = 2.0
+    _header = "walkdir-dircache-1-py{0}.{1}\n".format(*sys.version_info)
+
+    def __init__(self):
+        # Maps directory paths to (mtime_ns, ino, dev, subdirs, files, links)
+        self._dirs = {}
+
+    def __len__(self):
+        return len(self._dirs)
+
+    def __contains__(self, dirpath):
+        return dirpath in self._dirs
+
+    def invalidate(self, dirpath):
+        """Discard the cached listings for *dirpath* and all its subdirectories"""
+        pending = [dirpath]
+        while pending:
+            dirpath = pending.pop()
+            cached = self._dirs.pop(dirpath, None)
+            if cached is not None:
+                pending.extend(os.path.join(dirpath, subdir)
+                                   for subdir in cached[3])
+
+    def clear(self):
+        """Discard all cached listings"""
+        self._dirs.clear()
+
+    def save(self, filename):
+        """Write the cache to *filename*"""
+        with open(filename, "wb") as f:
+            f.write(self._header.encode("ascii"))
+            marshal.dump(self._dirs, f)
+
+    @classmethod
+    def load(cls, filename):
+        """Read a cache previously written by :meth:`save`
+
+        Raises :exc:`ValueError` if the file was not written by :meth:`save`
+        on this version of Python.
+        """
+        self = cls()
+        header = self._header.encode("ascii")
+        with open(filename, "rb") as f:
+            if f.read(len(header)) != header:
+                msg = "{0!r} is not a compatible directory cache"
+                raise ValueError(msg.format(filename))
+            self._dirs = marshal.load(f)
+        return self
+
+    def _refresh(self, dirpath, onerror, onchange):
+        """Get the listing for *dirpath*, only listing it if it has changed
+
+        Returns ``None`` if the directory can't be read.
+        """
+        try:
+            st = os.stat(dirpath)
+        except OSError as error:
+            self.invalidate(dirpath)
+            if onerror is not None:
+                onerror(error)
+            return None
+        mtime_ns = _mtime_ns(st)
+        cached = self._dirs.get(dirpath)
+        if cached is not None and cached[:3] == (mtime_ns, st.st_ino, st.st_dev):
+            return list(cached[3]), list(cached[4]), cached[5]
+        listed_ns = int(time.time() * 1000000000)
+        listing = _scan_dir(dirpath, onerror)
+        if listing is None:
+            self.invalidate(dirpath)
+            return None
+        subdirs, files = listing
+        links = tuple(_plain_name(subdir) for subdir in subdirs
+                          if subdir.is_symlink())
+        if listed_ns - mtime_ns < self.racy_window * 1000000000:
+            mtime_ns = None
+        record = (mtime_ns, st.st_ino, st.st_dev,
+                  tuple(_plain_name(subdir) for subdir in subdirs),
+                  tuple(_plain_name(fname) for fname in files), links)
+        self._dirs[dirpath] = record
+        if cached is not None:
+            old_subdirs = set(cached[3])
+            for subdir in old_subdirs.difference(record[3]):
+                self.invalidate(os.path.join(dirpath, subdir))
+        if onchange is not None:
+            changes = self._diff(dirpath, cached, record)
+            if changes is not None:
+                onchange(changes)
+        # Names are produced without their directory entries either way
+        return list(record[3]), list(record[4]), links
+
+    @staticmethod
+    def _diff(dirpath, cached, record):
+        """Compare old and new listings, returning ``None`` if unchanged"""
+        if cached is None:
+            cached = (None, None, None, (), (), ())
+        old_subdirs, old_files = set(cached[3]), set(cached[4])
+        new_subdirs, new_files = set(record[3]), set(record[4])
+        old_names = old_subdirs | old_files
+        new_names = new_subdirs | new_files
+        added = sorted(new_names - old_names)
+        removed = sorted(old_names - new_names)
+        changed = sorted((old_subdirs & new_files) | (old_files & new_subdirs))
+        if added or removed or changed:
+            return DirChanges(dirpath, added, removed, changed)
+        return None
+
+def cached_walk(top, cache, onerror=None, followlinks=False, onchange=None):
+    """A top-down walk that uses a :class:`DirCache` to avoid relisting directories
+
+    Produces the same ``dirpath, subdirs, files`` triples as a top-down
+    :func:`os.walk` (as :class:`WalkTriple` instances). Directories that are
+    unchanged since they were last recorded in *cache* are served from the
+    cache rather than being listed, and the cache is updated with the
+    listings of any new or changed directories.
+
+    If *onchange* is given, it is called with a ``DirChanges(dirpath, added,
+    removed, changed)`` named tuple for every directory whose listing
+    differs from the cached one. *added* and *removed* are sorted lists of
+    names, while *changed* lists the names that switched between being
+    files and being subdirectories. Directories that were not previously
+    cached report all of their entries as added.
+
+    The names in the subdirectory and file lists are always plain strings
+    (or :class:`bytes`), whether or not the directory was listed, since the
+    cache doesn't keep the directory entries that :func:`scandir_walk`
+    attaches to names.
+
+    *onerror* and *followlinks* have the same meaning as they do for
+    :func:`os.walk`.
+
+    Requires :func:`os.scandir` (or the ``scandir`` backport on older
+    versions of Python).
+    """
+    if _scandir is None:
+        msg = "Cached walks require os.scandir (or the scandir backport)"
+        raise RuntimeError(msg)
+    return _cached_walk(top, cache, onerror, followlinks, onchange, 0)
+
+def _cached_walk(top, cache, onerror, followlinks, onchange, depth):
+    listing = cache._refresh(top, onerror, onchange)
+    if listing is None:
+        return
+    subdirs, files, links = listing
+    yield WalkTriple(top, subdirs, files, depth)
+    for subdir in subdirs:
+        if followlinks or subdir not in links:
+            new_path = os.path.join(top, subdir)
+            for dir_entry in _cached_walk(new_path, cache, onerror,
+                                          followlinks, onchange, depth + 1):
+                yield dir_entry
+
+def cache_changes(top, cache, onerror=None, followlinks=False):
+    """Iterate over the changes to the directory listings recorded in *cache*
+
+    Walks *top* with :func:`cached_walk`, producing a ``DirChanges(dirpath,
+    added, removed, changed)`` named tuple for every directory whose listing
+    has changed since *cache* was last updated (see :func:`cached_walk`).
+    Unchanged directories are not listed.
+    """
+    changes = collections.deque()
+    walk_iter = cached_walk(top, cache, onerror, followlinks, changes.append)
+    for _ in walk_iter:
+        while changes:
+            yield changes.popleft()
+
+# Pattern compilation
+
+_GLOB_CHARS = frozenset("*?[")
+
+def _is_literal(pattern):
+    return not _GLOB_CHARS.intersection(pattern)
+
+def _pattern_text(pattern):
+    """Get the text of a pattern and a function to convert text back
+
+    Byte patterns are decoded as latin-1 (so every byte maps to a single
+    character), which lets them be parsed and translated like text, and
+    then encoded again so the results can be used with byte names directly.
+    """
+    if isinstance(pattern, bytes) and bytes is not str:
+        return pattern.decode("latin-1"), _encode_latin1
+    return pattern, _unchanged
+
+def _encode_latin1(text):
+    return text.encode("latin-1")
+
+def _unchanged(text):
+    return text
+
+def _group_by_length(fragments):
+    """Map fragment lengths to the set of fragments of that length"""
+    groups = {}
+    for fragment in fragments:
+        groups.setdefault(len(fragment), set()).add(fragment)
+    return sorted(groups.items())
+
+def _single_category_match(literals, suffixes, prefixes, regex_match):
+    """Get a specialised matcher if only one kind of pattern is in use"""
+    if literals and not (suffixes or prefixes or regex_match):
+        return literals.__contains__
+    if regex_match is not None and not (literals or suffixes or prefixes):
+        return regex_match
+    if len(suffixes) == 1 and not (literals or prefixes or regex_match):
+        length, group = suffixes[0]
+        return lambda name: name[-length:] in group
+    if len(prefixes) == 1 and not (literals or suffixes or regex_match):
+        length, group = prefixes[0]
+        return lambda name: name[:length] in group
+    return None
+
+def _compile_patterns(patterns):
+    """Compile a collection of :mod:`fnmatch` patterns into one predicate
+
+    Rather than checking every pattern in turn, the patterns are sorted into
+    literal names, ``*suffix`` patterns and ``prefix*`` patterns (which are
+    checked with set lookups), with everything else combined into a single
+    regular expression. Names are normalised with :func:`os.path.normcase`
+    (as :func:`fnmatch.fnmatch` does) only when that is not a no-op.
+    """
+    normcase = os.path.normcase
+    if normcase("A/") == "A/":
+        normcase = None
+    else:
+        patterns = [normcase(pattern) for pattern in patterns]
+    # Patterns must all have the same type as the names they will match
+    convert = _unchanged
+    if patterns:
+        convert = _pattern_text(patterns[0])[1]
+        patterns = [_pattern_text(pattern)[0] for pattern in patterns]
+    literals = set()
+    suffixes = set()
+    prefixes = set()
+    others = []
+    for pattern in patterns:
+        if pattern == "*":
+            return lambda name: True
+        if _is_literal(pattern):
+            literals.add(pattern)
+        elif pattern[0] == "*" and _is_literal(pattern[1:]):
+            suffixes.add(pattern[1:])
+        elif pattern[-1] == "*" and _is_literal(pattern[:-1]):
+            prefixes.add(pattern[:-1])
+        else:
+            others.append(fnmatch.translate(pattern))
+    literals = set(convert(literal) for literal in literals)
+    suffixes = _group_by_length(convert(suffix) for suffix in suffixes)
+    prefixes = _group_by_length(convert(prefix) for prefix in prefixes)
+    regex_match = None
+    if others:
+        regex_match = re.compile(convert("|".join(others))).match
+    if normcase is None:
+        # The common cases get a matcher with no per-name overhead
+        match = _single_category_match(literals, suffixes, prefixes,
+                                       regex_match)
+        if match is not None:
+            return match
+    def _match(name):
+        if normcase is not None:
+            name = normcase(name)
+        if name in literals:
+            return True
+        for length, group in suffixes:
+            if name[-length:] in group:
+                return True
+        for length, group in prefixes:
+            if name[:length] in group:
+                return True
+        return regex_match is not None and regex_match(name) is not None
+    return _match
+
+# Matching path patterns
+
+def _split_patterns(patterns):
+    """Separate patterns for names from patterns for relative paths"""
+    name_patterns = []
+    path_patterns = []
+    for pattern in patterns:
+        text = _pattern_text(pattern)[0]
+        if "/" in text or os.sep in text:
+            path_patterns.append(pattern)
+        else:
+            name_patterns.append(pattern)
+    return name_patterns, path_patterns
+
+def _any_name(name):
+    return True
+
+class _PathPatterns(object):
+    """Match relative paths against a collection of path patterns
+
+    Path patterns are matched against the path relative to the root of the
+    walk, one path component at a time, with ``**`` matching zero or more
+    complete path components (as in ``.gitignore`` files, a trailing
+    ``**`` matches one or more, so ``foo/**`` doesn't match ``foo``
+    itself). Any other
+    component is an :mod:`fnmatch` pattern for a single name.
+
+    Matching is done incrementally: :meth:`root_states` gives the states
+    for the root of the walk, and :meth:`descend` advances a directory's
+    states to one of its subdirectories. The states record how far each
+    pattern has progressed, and are used to check the names in that
+    directory.
+    """
+    def __init__(self, patterns):
+        self._patterns = []
+        for pattern in patterns:
+            pattern, convert = _pattern_text(pattern)
+            if os.sep != "/":
+                pattern = pattern.replace(os.sep, "/")
+            parts = []
+            for part in pattern.split("/"):
+                if not part or (part == "**" and parts and parts[-1] is None):
+                    continue
+                if part == "**":
+                    parts.append(None)
+                else:
+                    parts.append(_compile_patterns([convert(part)]))
+            if parts and parts[-1] is None:
+                # A trailing "**" only matches what's inside a directory
+                parts.insert(-1, _any_name)
+            self._patterns.append(parts)
+        self._initial_states = [self._closure(parts, [0])
+                                    for parts in self._patterns]
+
+    @staticmethod
+    def _closure(parts, states):
+        # "**" may match zero components, so the next state is also active
+        result = set()
+        for i in states:
+            result.add(i)
+            while i < len(parts) and parts[i] is None:
+                i += 1
+                result.add(i)
+        return result
+
+    def _step(self, parts, states, name):
+        new_states = []
+        for i in states:
+            if i < len(parts):
+                part = parts[i]
+                if part is None:
+                    new_states.append(i)
+                elif part(name):
+                    new_states.append(i + 1)
+        return self._closure(parts, new_states)
+
+    def root_states(self):
+        """Get the pattern states for the root of the walk"""
+        return list(self._initial_states)
+
+    def descend(self, dir_states, name):
+        """Get the pattern states for subdirectory *name*"""
+        return [self._step(parts, states, name) if states else states
+                    for parts, states in zip(self._patterns, dir_states)]
+
+    def matches(self, dir_states, name):
+        """Check if *name* in the given directory matches any pattern"""
+        for parts, states in zip(self._patterns, dir_states):
+            if states and len(parts) in self._step(parts, states, name):
+                return True
+        return False
+
+    def can_descend(self, dir_states, name):
+        """Check if paths below subdirectory *name* could match any pattern"""
+        for parts, states in zip(self._patterns, dir_states):
+            if states:
+                for i in self._step(parts, states, name):
+                    if i < len(parts):
+                        return True
+        return False
+
+def _path_states(walk_iter, path_set):
+    """Pair each directory in a top-down walk with its path pattern states
+
+    The patterns are matched relative to the first directory produced by
+    the walk (or the most recent directory that is not below that one).
+    Each directory's states are carried forward from those of the nearest
+    directory leading to it (its parent, in a depth-first walk), so only
+    the names in between need to be matched.
+    """
+    if path_set is None:
+        for dir_entry in walk_iter:
+            yield dir_entry, None
+        return
+    # Holds (prefix, states) pairs for the directories leading to the
+    # current one
+    stack = []
+    for dir_entry in walk_iter:
+        dirpath = dir_entry[0]
+        while stack and not dirpath.startswith(stack[-1][0]):
+            stack.pop()
+        if stack:
+            prefix, states = stack[-1]
+            for name in dirpath[len(prefix):].split(_path_sep(dirpath)):
+                if name:
+                    states = path_set.descend(states, name)
+        else:
+            states = path_set.root_states()
+        stack.append((_dir_prefix(dirpath), states))
+        yield dir_entry, states
+
 # Filtering for inclusion
 
-def _make_include_filter(patterns):
-    """Create a filtering function from a collection of inclusion patterns"""
+def _subtree_pattern(pattern):
+    """Extend a path pattern to match everything below the paths it matches"""
+    text, convert = _pattern_text(pattern)
+    return convert(text.rstrip("/") + "/**")
+
+def _make_include_filter(patterns, dirs=False):
+    """Create a filtering function from a collection of inclusion patterns
+
+    Returns the filtering function along with the :class:`_PathPatterns`
+    instance needed to calculate the path pattern states it expects as its
+    second argument (``None`` if there are no path patterns). Directories
+    are included if they match a path pattern, are inside a directory that
+    matches, or could contain a path that matches.
+    """
     # Trivial case: exclude everything
     if not patterns:
-        def _filter(names):
+        def _filter(names, states):
             return names[0:0]
-        return _filter
-    # Use fnmatch.filter if it's applicable
-    if len(patterns) == 1:
-        def _filter(names):
-            return fnmatch.filter(names, patterns[0])
-        return _filter
+        return _filter, None
+    name_patterns, path_patterns = _split_patterns(patterns)
+    if name_patterns:
+        should_include = _compile_patterns(name_patterns)
+    else:
+        should_include = lambda name: False
+    if not path_patterns:
+        def _filter(names, states):
+            return [name for name in names if should_include(name)]
+        return _filter, None
     # Handle the general case for inclusion
-    def _should_include(name):
-        return any(fnmatch.fnmatch(name, pattern)
-                        for pattern in patterns)
-    def _filter(names):
-        for name in names:
-            if _should_include(name):
-                yield name
-    return _filter
-    
+    if dirs:
+        path_set = _PathPatterns([_subtree_pattern(p) for p in path_patterns])
+        path_match = path_set.can_descend
+    else:
+        path_set = _PathPatterns(path_patterns)
+        path_match = path_set.matches
+    def _filter(names, states):
+        return [name for name in names
+                    if should_include(name) or path_match(states, name)]
+    return _filter, path_set
+
 def include_dirs(walk_iter, *include_filters):
     """Use :func:`fnmatch.fnmatch` patterns to select directories of interest
     
-    Inclusion filters are passed directly as arguments.
+    Inclusion filters are passed directly as arguments. Filters containing
+    a path separator are matched against paths relative to the top of the
+    walk (with ``**`` matching any number of subdirectories) rather than
+    against subdirectory names, and also include the parent directories
+    needed to reach the matching directories.
 
     This filter works by modifying the subdirectory lists produced by the
     underlying iterator, and hence requires a top-down/breadth-first
     traversal of the directory hierarchy.
     """
-    filter_subdirs = _make_include_filter(include_filters)
-    for dir_entry in walk_iter:
+    filter_subdirs, path_set = _make_include_filter(include_filters, dirs=True)
+    for dir_entry, states in _path_states(walk_iter, path_set):
         subdirs = dir_entry[1]
-        subdirs[:] = filter_subdirs(subdirs)
+        subdirs[:] = filter_subdirs(subdirs, states)
         yield dir_entry
 
 def include_files(walk_iter, *include_filters):
     """Use :func:`fnmatch.fnmatch` patterns to select files of interest
     
-    Inclusion filters are passed directly as arguments
+    Inclusion filters are passed directly as arguments. Filters containing
+    a path separator are matched against paths relative to the top of the
+    walk (with ``**`` matching any number of subdirectories) rather than
+    against file names.
 
-    This filter does not modify the subdirectory lists produced by the
-    underlying iterator, and hence supports both top-down/breadth-first
-    and bottom-up/depth-first traversal of the directory hierarchy.
+    Unless there are path patterns, this filter does not modify the
+    subdirectory lists produced by the underlying iterator, and hence
+    supports both top-down/breadth-first and bottom-up/depth-first
+    traversal of the directory hierarchy. Path patterns are matched
+    relative to the first directory the walk produces, so they require a
+    top-down/breadth-first traversal.
+
+    When *all* of the filters are path patterns, subdirectories which
+    cannot contain any matching files are also removed from the
+    subdirectory lists, so the walk never lists them at all.
     """
-    filter_files = _make_include_filter(include_filters)
-    for dir_entry in walk_iter:
+    filter_files, path_set = _make_include_filter(include_filters)
+    prune = path_set is not None and not _split_patterns(include_filters)[0]
+    for dir_entry, states in _path_states(walk_iter, path_set):
+        if prune:
+            subdirs = dir_entry[1]
+            subdirs[:] = [subdir for subdir in subdirs
+                              if path_set.can_descend(states, subdir)]
         files = dir_entry[2]
-        files[:] = filter_files(files)
+        files[:] = filter_files(files, states)
         yield dir_entry
 
 # Filtering for exclusion
 
 def _make_exclude_filter(patterns):
-    """Create a filtering function from a collection of exclusion patterns"""
+    """Create a filtering function from a collection of exclusion patterns
+
+    Returns the filtering function along with the :class:`_PathPatterns`
+    instance needed to calculate the path pattern states it expects as its
+    second argument (``None`` if there are no path patterns).
+    """
     # Trivial case: include everything
     if not patterns:
-        def _filter(names):
+        def _filter(names, states):
             return names
-        return _filter
+        return _filter, None
+    name_patterns, path_patterns = _split_patterns(patterns)
+    if name_patterns:
+        should_exclude = _compile_patterns(name_patterns)
+    else:
+        should_exclude = lambda name: False
+    if not path_patterns:
+        def _filter(names, states):
+            return [name for name in names if not should_exclude(name)]
+        return _filter, None
     # Handle the general case for exclusion
-    def _should_exclude(name):
-        return any(fnmatch.fnmatch(name, pattern)
-                        for pattern in patterns)
-    def _filter(names):
-        for name in names:
-            if not _should_exclude(name):
-                yield name
-    return _filter
+    path_set = _PathPatterns(path_patterns)
+    path_match = path_set.matches
+    def _filter(names, states):
+        return [name for name in names
+                    if not (should_exclude(name) or path_match(states, name))]
+    return _filter, path_set
 
 def exclude_dirs(walk_iter, *exclude_filters):
     """Use :func:`fnmatch.fnmatch` patterns to skip irrelevant directories
     
-    Exclusion filters are passed directly as arguments
+    Exclusion filters are passed directly as arguments. Filters containing
+    a path separator are matched against paths relative to the top of the
+    walk (with ``**`` matching any number of subdirectories) rather than
+    against subdirectory names.
 
     This filter works by modifying the subdirectory lists produced by the
     underlying iterator, and hence requires a top-down/breadth-first
     traversal of the directory hierarchy.
     """
-    filter_subdirs = _make_exclude_filter(exclude_filters)
-    for dir_entry in walk_iter:
+    filter_subdirs, path_set = _make_exclude_filter(exclude_filters)
+    for dir_entry, states in _path_states(walk_iter, path_set):
         subdirs = dir_entry[1]
-        subdirs[:] = filter_subdirs(subdirs)
+        subdirs[:] = filter_subdirs(subdirs, states)
         yield dir_entry
 
 def exclude_files(walk_iter, *exclude_filters):
     """Use :func:`fnmatch.fnmatch` patterns to skip irrelevant files
     
-    Exclusion filters are passed directly as arguments
+    Exclusion filters are passed directly as arguments. Filters containing
+    a path separator are matched against paths relative to the top of the
+    walk (with ``**`` matching any number of subdirectories) rather than
+    against file names.
 
     This filter does not modify the subdirectory lists produced by the
     underlying iterator, and hence supports both top-down/breadth-first
-    and bottom-up/depth-first traversal of the directory hierarchy.
+    and bottom-up/depth-first traversal of the directory hierarchy. The
+    exception is that path patterns are matched relative to the first
+    directory the walk produces, so they require a top-down/breadth-first
+    traversal.
     """
-    filter_files = _make_exclude_filter(exclude_filters)
-    for dir_entry in walk_iter:
+    filter_files, path_set = _make_exclude_filter(exclude_filters)
+    for dir_entry, states in _path_states(walk_iter, path_set):
         files = dir_entry[2]
-        files[:] = filter_files(files)
+        files[:] = filter_files(files, states)
         yield dir_entry
 
 
-# Depth limiting
+# Honouring ignore files
 
-def limit_depth(walk_iter, depth):
-    """Limit the depth of recursion into subdirectories.
-    
-    A *depth* of 0 limits the walk to the top level directory, a *depth* of 1
-    includes subdirectories, etc.
+def _parse_ignore_line(line):
+    """Convert a line from an ignore file to a ``negate, dir_only, pattern``
+    triple (or ``None`` for blank lines and comments)"""
+    if not line.endswith("\\ "):
+        line = line.rstrip(" ")
+    line = line.replace("\\ ", " ")
+    if not line or line.startswith("#"):
+        return None
+    negate = line.startswith("!")
+    if negate or line.startswith("\\!") or line.startswith("\\#"):
+        line = line[1:]
+    dir_only = line.endswith("/")
+    line = line.rstrip("/")
+    if not line:
+        return None
+    return negate, dir_only, line
+
+def _compile_ignore_rules(lines, convert=_unchanged):
+    """Compile the lines of an ignore file into a sequence of rules
+
+    Each rule is a ``negate, dir_only, name_pattern, path_set`` tuple.
+    Patterns without a slash (other than a trailing one) match names at any
+    depth, so they only need *name_pattern*. Other patterns are anchored to
+    the directory containing the ignore file and use *path_set* instead.
+
+    The patterns are passed through *convert* after parsing (to produce
+    byte patterns from lines decoded with :func:`_pattern_text`).
+    """
+    rules = []
+    for line in lines:
+        parsed = _parse_ignore_line(line)
+        if parsed is None:
+            continue
+        negate, dir_only, text = parsed
+        pattern = convert(text)
+        if "/" in text:
+            path_set = _PathPatterns([convert(text.lstrip("/"))])
+            rules.append((negate, dir_only, None, path_set))
+        else:
+            rules.append((negate, dir_only, pattern, None))
+    return tuple(rules)
+
+class _IgnoreRules(object):
+    """The combined rules from the ignore files that apply to a directory
+
+    Consecutive rules with the same sense are merged into a single run, so
+    each name only needs to be checked against a couple of compiled
+    matchers rather than against every pattern. Runs are checked from the
+    last one backwards, since (as for ``git``) the last matching rule wins.
+
+    The states of the anchored path patterns vary from directory to
+    directory, so they're kept separately (see :meth:`extend_states` and
+    :meth:`descend`).
+    """
+    def __init__(self, rules):
+        self.rules = rules
+        self.path_sets = []
+        self.runs = []
+        for negate, run in itertools.groupby(rules, lambda rule: rule[0]):
+            names = []
+            file_names = []
+            paths = []
+            for _, dir_only, name_pattern, path_set in run:
+                if path_set is not None:
+                    paths.append((len(self.path_sets), dir_only, path_set))
+                    self.path_sets.append(path_set)
+                    continue
+                names.append(name_pattern)
+                if not dir_only:
+                    file_names.append(name_pattern)
+            file_match = _compile_patterns(file_names) if file_names else None
+            dir_match = _compile_patterns(names) if names else None
+            self.runs.append((negate, file_match, dir_match, tuple(paths)))
+        self.runs.reverse()
+
+    def extend_states(self, states):
+        """Add initial states for path patterns from the last ignore file"""
+        states = list(states)
+        for path_set in self.path_sets[len(states):]:
+            states.append(path_set.root_states())
+        return states
+
+    def descend(self, states, name):
+        """Get the path pattern states for subdirectory *name*"""
+        return [path_set.descend(path_states, name) if any(path_states)
+                    else path_states
+                        for path_set, path_states in zip(self.path_sets, states)]
+
+    def _run_match(self, states, run, is_dir):
+        """Get a matching function for a run of rules (if any can match)"""
+        negate, file_match, dir_match, paths = run
+        match = dir_match if is_dir else file_match
+        live_paths = [(path_set, states[index])
+                          for index, dir_only, path_set in paths
+                              if (is_dir or not dir_only) and any(states[index])]
+        if not live_paths:
+            return match
+        def _match(name):
+            if match is not None and match(name):
+                return True
+            for path_set, path_states in live_paths:
+                if path_set.matches(path_states, name):
+                    return True
+            return False
+        return _match
+
+    def filter_names(self, states, names, is_dir):
+        """Remove the ignored names from a directory with the given states"""
+        ignored = set()
+        remaining = names
+        for run in self.runs:
+            match = self._run_match(states, run, is_dir)
+            if match is None:
+                continue
+            matched = [name for name in remaining if match(name)]
+            if not matched:
+                continue
+            if not run[0]:
+                ignored.update(matched)
+            if len(matched) == len(remaining):
+                break
+            # Only the last matching rule counts, so earlier runs can only
+            # affect names that haven't been matched yet
+            matched = set(matched)
+            remaining = [name for name in remaining if name not in matched]
+        if not ignored:
+            return names
+        return [name for name in names if name not in ignored]
+
+def _read_ignore_file(path, compiled):
+    """Read and compile an ignore file, reusing the rules for identical files
+
+    Ignore files are decoded in the same way as file names, and those found
+    by walking a :class:`bytes` path are read as bytes, producing byte
+    patterns that match the undecoded names.
+    """
+    try:
+        if bytes is str:
+            with open(path) as f:
+                text, convert = f.read(), _unchanged
+            lines = text.splitlines()
+        elif isinstance(path, bytes):
+            with open(path, "rb") as f:
+                text, convert = _pattern_text(f.read())
+            # str.splitlines would also split on other latin-1 characters
+            lines = text.replace("\r\n", "\n").split("\n")
+        else:
+            # Decode the patterns the same way as the names they match
+            with open(path, encoding=sys.getfilesystemencoding(),
+                      errors="surrogateescape") as f:
+                text, convert = f.read(), _unchanged
+            lines = text.splitlines()
+    except EnvironmentError:
+        return ()
+    try:
+        return compiled[text]
+    except KeyError:
+        pass
+    rules = compiled[text] = _compile_ignore_rules(lines, convert)
+    return rules
 
-    Path depth is calculated by counting directory separators, using the
-    depth of the first path produced by the underlying iterator as a
-    reference point.
+def exclude_ignored(walk_iter, *ignore_names):
+    """Skip files and directories listed in ``.gitignore`` style ignore files
+
+    The names of the ignore files to honour (e.g. ``".gitignore"``) are
+    passed directly as arguments. Ignore files are read as the walk reaches
+    the directory containing them, and their patterns then apply to that
+    directory and everything below it, using the same rules as ``git``:
+
+        - blank lines and lines starting with ``#`` are skipped
+        - a leading ``!`` re-includes names excluded by an earlier pattern
+        - a trailing ``/`` means the pattern only matches directories
+        - a pattern with any other ``/`` is matched against the path relative
+          to the directory containing the ignore file (with ``**`` matching
+          any number of nested directories), while other patterns match
+          names at any depth
+
+    Each ignore file is compiled once, and the compiled patterns are handed
+    down to subdirectories as the walk descends, so memory use is
+    proportional to the depth of the walk. Ignored directories are removed
+    from the subdirectory lists, so they are never listed. In a
+    breadth-first walk (such as :func:`breadth_first_walk`), the ignore
+    files in the directories between the top of the walk and each
+    directory are opened again (the compiled patterns are reused).
 
     This filter works by modifying the subdirectory lists produced by the
     underlying iterator, and hence requires a top-down/breadth-first
     traversal of the directory hierarchy.
     """
-    if depth < 0:
-        msg = "Depth limit less than 0 ({!r} provided)"
-        raise ValueError(msg.format(depth))
-    sep=os.sep
-    for dir_entry in walk_iter:
-        yield dir_entry
-        top = dir_entry[0]
-        subdirs = dir_entry[1]
-        initial_depth = top.count(sep)
-        if depth == 0:
-            subdirs[:] = []
-        break
+    if not ignore_names:
+        for dir_entry in walk_iter:
+            yield dir_entry
+        return
+    compiled = {}
+    combined = {}
+    def _add_ignore_files(dirpath, files, ignore_rules, states):
+        # If the directory's files aren't known, any ignore files are
+        # simply opened (missing ones have no rules)
+        for ignore_name in ignore_names:
+            if files is not None and ignore_name not in files:
+                continue
+            ignore_path = os.path.join(dirpath, ignore_name)
+            rules = _read_ignore_file(ignore_path, compiled)
+            if not rules:
+                continue
+            # Directories sharing the same ignore files share the same rules
+            key = (ignore_rules, rules)
+            try:
+                ignore_rules = combined[key]
+            except KeyError:
+                parent_rules = () if ignore_rules is None else ignore_rules.rules
+                ignore_rules = combined[key] = _IgnoreRules(parent_rules + rules)
+            states = ignore_rules.extend_states(states)
+        return ignore_rules, states
+    # Holds (prefix, ignore_rules, states) for the directories leading to
+    # the current one
+    stack = []
     for dir_entry in walk_iter:
-        dirpath = dir_entry[0]
-        subdirs = dir_entry[1]
-        current_depth = dirpath.count(sep) - initial_depth
+        dirpath, subdirs, files = dir_entry[0:3]
+        if isinstance(dirpath, bytes) and not isinstance(ignore_names[0], bytes):
+            ignore_names = [_fsencode(name) for name in ignore_names]
+        while stack and not dirpath.startswith(stack[-1][0]):
+            stack.pop()
+        ignore_rules, states = None, ()
+        if stack:
+            prefix, ignore_rules, states = stack[-1]
+            sep = _path_sep(dirpath)
+            names = [name for name in dirpath[len(prefix):].split(sep) if name]
+            for i, name in enumerate(names):
+                if ignore_rules is not None:
+                    states = ignore_rules.descend(states, name)
+                if i == len(names) - 1:
+                    break
+                # A breadth-first walk moves between subtrees without
+                # visiting the directories in between again
+                prefix += name + sep
+                ignore_rules, states = _add_ignore_files(prefix, None,
+                                                         ignore_rules, states)
+                stack.append((prefix, ignore_rules, states))
+        ignore_rules, states = _add_ignore_files(dirpath, files,
+                                                 ignore_rules, states)
+        stack.append((_dir_prefix(dirpath), ignore_rules, states))
+        if ignore_rules is not None:
+            subdirs[:] = ignore_rules.filter_names(states, subdirs, True)
+            files[:] = ignore_rules.filter_names(states, files, False)
         yield dir_entry
-        if current_depth >= depth:
-            subdirs[:] = []
 
-def min_depth(walk_iter, depth):
-    """Only process subdirectories beyond a minimum depth
-    
-    A *depth* of 1 omits the top level directory, a *depth* of 2
-    starts with subdirectories 2 levels down, etc.
+# Filtering on file metadata
 
-    Path depth is calculated by counting directory separators, using the
-    depth of the first path produced by the underlying iterator as a
-    reference point.
-    
-    .. note:: Since this filter *doesn't yield* higher level directories, any
-      subsequent directory filtering that relies on updating the subdirectory
-      list will have no effect at the minimum depth. Accordingly, this filter
-      should only be applied *after* any directory filtering operations.
+def _stat_names(dirpath, names, follow_symlinks):
+    # Errors are collected and reported from the consuming thread
+    results = []
+    for name in names:
+        try:
+            st = _name_stat(dirpath, name, follow_symlinks)
+        except OSError as error:
+            results.append((name, error))
+        else:
+            results.append((name, st))
+    return results
 
-    .. note:: The result of using this filter is effectively the same as
-      chaining multiple independent :func:`os.walk` iterators using
-      :func:`itertools.chain`. For example, given the following directory tree::
+def attach_stat(walk_iter, workers=8, follow_symlinks=True, onerror=None):
+    """Fetch the stat results for the files in each directory
 
-        >>> tree test
-        test
-        ├── file1.txt
-        ├── file2.txt
-        ├── test2
-        │   ├── file1.txt
-        │   ├── file2.txt
-        │   └── test3
-        └── test4
-            ├── file1.txt
-            └── test5
+    The names in each file list are replaced with :class:`WalkEntry`
+    instances that answer :meth:`WalkEntry.stat` (and the file type queries)
+    from the fetched data, so later pipeline stages such as
+    :func:`filter_stat`, and the flattening iterators (with *with_stat* set),
+    don't need to make any further system calls. Names that are already
+    :class:`WalkEntry` instances keep their cached directory entries.
 
-      Then ``min_depth(os.walk("test"), depth=1)`` will produce the same output
-      as ``itertools.chain(os.walk("test/test2"), os.walk("test/test4")).``
+    Large file lists are split into batches that are stat-ed concurrently
+    by a pool of *workers* threads (this mostly helps on network
+    filesystems, where each call is dominated by round-trip latency).
+    Setting *workers* to ``0`` (or ``None``) fetches the results in the
+    current thread instead.
 
-    This filter works by modifying the subdirectory lists produced by the
-    underlying iterator, and hence requires a top-down/breadth-first
-    traversal of the directory hierarchy.
+    *follow_symlinks* determines whether the results describe symlinks or
+    their targets. Files that can't be stat-ed (for example, because they
+    were deleted after the directory was listed) are removed from the file
+    lists, after passing the exception to *onerror* (if given).
+
+    This filter does not modify the subdirectory lists produced by the
+    underlying iterator, and hence supports both top-down/breadth-first
+    and bottom-up/depth-first traversal of the directory hierarchy.
     """
-    if depth < 1:
-        msg = "Minimium depth less than 1 ({!r} provided)"
-        raise ValueError(msg.format(depth))
-    sep=os.sep
-    for dir_entry in walk_iter:
-        initial_depth = dir_entry[0].count(sep)
-        break
-    for dir_entry in walk_iter:
-        dirpath = dir_entry[0]
-        current_depth = dirpath.count(sep) - initial_depth
-        if current_depth >= depth:
+    executor = None
+    if workers and _futures is not None:
+        executor = _futures.ThreadPoolExecutor(workers)
+    min_batch = 16
+    try:
+        for dir_entry in walk_iter:
+            dirpath = dir_entry[0]
+            files = dir_entry[2]
+            count = len(files)
+            if executor is None or count <= min_batch:
+                results = _stat_names(dirpath, files, follow_symlinks)
+            else:
+                batch_size = max(min_batch, -(-count // workers))
+                batches = [executor.submit(_stat_names, dirpath,
+                                           files[i:i+batch_size],
+                                           follow_symlinks)
+                               for i in range(0, count, batch_size)]
+                results = []
+                for batch in batches:
+                    results.extend(batch.result())
+            stat_files = []
+            for name, st in results:
+                if isinstance(st, OSError):
+                    if onerror is not None:
+                        onerror(st)
+                    continue
+                if not isinstance(name, _EntryName):
+                    path = os.path.join(dirpath, name)
+                    name = _entry_name(name, _StatEntry(path, st, follow_symlinks))
+                stat_files.append(name)
+            files[:] = stat_files
             yield dir_entry
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=False)
 
-# Symlink loop handling
+_FILE_TYPES = {
+    "file": _stat.S_IFREG,
+    "dir": _stat.S_IFDIR,
+    "symlink": _stat.S_IFLNK,
+    "fifo": _stat.S_IFIFO,
+    "socket": _stat.S_IFSOCK,
+    "char": _stat.S_IFCHR,
+    "block": _stat.S_IFBLK,
+}
 
-def handle_symlink_loops(walk_iter, onloop=None):
-    """Handle symlink loops when following symlinks during a walk
+def _make_stat_filter(min_size, max_size, min_mtime, max_mtime,
+                      uids, file_types, predicate):
+    """Create a predicate for stat results from the :func:`filter_stat` limits"""
+    checks = []
+    if min_size is not None:
+        checks.append(lambda st: st.st_size >= min_size)
+    if max_size is not None:
+        checks.append(lambda st: st.st_size <= max_size)
+    if min_mtime is not None:
+        checks.append(lambda st: st.st_mtime >= min_mtime)
+    if max_mtime is not None:
+        checks.append(lambda st: st.st_mtime <= max_mtime)
+    if uids is not None:
+        uids = frozenset(uids)
+        checks.append(lambda st: st.st_uid in uids)
+    if file_types is not None:
+        try:
+            modes = frozenset(_FILE_TYPES[file_type] for file_type in file_types)
+        except KeyError as exc:
+            msg = "Unknown file type {0!r} (expected one of {1})"
+            raise ValueError(msg.format(exc.args[0],
+                                        ", ".join(sorted(_FILE_TYPES))))
+        checks.append(lambda st: _stat.S_IFMT(st.st_mode) in modes)
+    if predicate is not None:
+        checks.append(predicate)
+    if len(checks) == 1:
+        return checks[0]
+    def _check(st):
+        for check in checks:
+            if not check(st):
+                return False
+        return True
+    return _check
+
+def filter_stat(walk_iter, min_size=None, max_size=None, min_mtime=None,
+                max_mtime=None, uids=None, file_types=None, predicate=None,
+                follow_symlinks=True):
+    """Use file metadata to select files of interest
+
+    Only files matching all of the given criteria are kept:
+
+        - *min_size* and *max_size* give inclusive limits on the file size
+        - *min_mtime* and *max_mtime* give inclusive limits on the last
+          modification time (as a timestamp, like :func:`time.time`)
+        - *uids* is a collection of acceptable owner user IDs
+        - *file_types* is a collection of acceptable file types, out of
+          ``"file"``, ``"dir"``, ``"symlink"``, ``"fifo"``, ``"socket"``,
+          ``"char"`` and ``"block"``
+        - *predicate* is called with the stat result and returns whether or
+          not to keep the file
+
+    For example, files larger than 1 MiB modified in the last week::
+
+        week_ago = time.time() - 7 * 24 * 60 * 60
+        walk_iter = filter_stat(attach_stat(walk_iter),
+                                min_size=2**20, min_mtime=week_ago)
+
+    Stat results are taken from :class:`WalkEntry` names where possible
+    (such as those produced by :func:`attach_stat`), and otherwise fetched
+    with :func:`os.stat` (or :func:`os.lstat` if *follow_symlinks* is
+    false). Files that can't be stat-ed are skipped.
+
+    This filter does not modify the subdirectory lists produced by the
+    underlying iterator, and hence supports both top-down/breadth-first
+    and bottom-up/depth-first traversal of the directory hierarchy.
+    """
+    should_keep = _make_stat_filter(min_size, max_size, min_mtime, max_mtime,
+                                    uids, file_types, predicate)
+    for dir_entry in walk_iter:
+        dirpath = dir_entry[0]
+        files = dir_entry[2]
+        kept = []
+        for name in files:
+            try:
+                st = _name_stat(dirpath, name, follow_symlinks)
+            except OSError:
+                continue
+            if should_keep(st):
+                kept.append(name)
+        files[:] = kept
+        yield dir_entry
+
+# Depth limiting
+
+def _stack_depth(stack, dirpath):
+    """Calculate the depth of a directory in a top-down walk
+
+    *stack* holds ``prefix, depth`` pairs for the directories leading to the
+    previous directory, and is updated for *dirpath*. Directories that
+    aren't inside any of those directories are treated as new roots.
+    """
+    while stack and not dirpath.startswith(stack[-1][0]):
+        stack.pop()
+    if stack:
+        prefix, parent_depth = stack[-1]
+        # Allow for levels skipped by earlier filters
+        depth = parent_depth + 1 + dirpath.count(_path_sep(dirpath), len(prefix))
+    else:
+        depth = 0
+    stack.append((_dir_prefix(dirpath), depth))
+    return depth
+
+def _check_depth_limit(depth, description="Depth limit"):
+    if depth is not None and depth < 0:
+        msg = "{0} less than 0 ({1!r} provided)"
+        raise ValueError(msg.format(description, depth))
+
+def limit_depth(walk_iter, depth, subtrees=None):
+    """Limit the depth of recursion into subdirectories.
+    
+    A *depth* of 0 limits the walk to the top level directory, a *depth* of 1
+    includes subdirectories, etc. A *depth* of ``None`` doesn't limit the
+    depth (which is mostly useful in combination with *subtrees*).
+
+    *subtrees* optionally maps paths relative to the top of the walk to
+    separate depth limits for those subtrees, measured from the named
+    directory (for example, ``limit_depth(walk_iter, None, {"vendor": 2})``
+    only descends two levels below the top level ``vendor`` directory,
+    while the rest of the tree is walked in full). The most deeply nested
+    matching subtree determines the limit, and the directories leading to
+    a subtree are walked even if they're below the depth limit that would
+    otherwise apply (although only the subdirectories leading to the
+    subtree are kept).
+
+    Depths are taken from the ``depth`` attribute of :class:`WalkTriple`
+    instances where available. Otherwise, they're calculated from the
+    directories seen so far, with the first directory (and any later
+    directory that isn't inside a previous one) being at depth zero.
+
+    This filter works by modifying the subdirectory lists produced by the
+    underlying iterator, and hence requires a top-down/breadth-first
+    traversal of the directory hierarchy. Subdirectories below the depth
+    limit are still reported for the last included level, but are removed
+    before the underlying iterator gets the chance to list them. Any
+    directories that are produced below the depth limit anyway are skipped.
+    """
+    _check_depth_limit(depth)
+    if subtrees:
+        for dir_entry in _limit_subtree_depths(walk_iter, depth, subtrees):
+            yield dir_entry
+        return
+    if depth is None:
+        for dir_entry in walk_iter:
+            yield dir_entry
+        return
+    stack = []
+    for dir_entry in walk_iter:
+        current_depth = getattr(dir_entry, "depth", None)
+        if current_depth is None:
+            current_depth = _stack_depth(stack, dir_entry[0])
+        if current_depth > depth:
+            continue
+        yield dir_entry
+        if current_depth >= depth:
+            dir_entry[1][:] = []
+
+def _subtree_limits(subtrees, dirpath):
+    """Map the components of each subtree path to its depth limit
+
+    The components are converted to the same type as *dirpath*.
+    """
+    as_bytes = isinstance(dirpath, bytes) and bytes is not str
+    limits = {}
+    for path, limit in subtrees.items():
+        _check_depth_limit(limit, "Depth limit for {0!r}".format(path))
+        text, convert = _pattern_text(path)
+        if os.sep != "/":
+            text = text.replace(os.sep, "/")
+        parts = [convert(part) for part in text.split("/") if part]
+        if as_bytes and convert is _unchanged:
+            parts = [_fsencode(part) for part in parts]
+        limits[tuple(parts)] = limit
+    return limits
+
+def _limit_subtree_depths(walk_iter, depth, subtrees):
+    """Implement :func:`limit_depth` with depth limits for subtrees"""
+    limits = leads = None
+    # Holds (prefix, depth, limit, parts) for the directories leading to
+    # the current one, where limit is the deepest level to be walked
+    stack = []
+    for dir_entry in walk_iter:
+        dirpath = dir_entry[0]
+        if limits is None:
+            limits = _subtree_limits(subtrees, dirpath)
+            # Directories leading to a subtree are walked even beyond the limit
+            leads = set(parts[:i] for parts in limits
+                                  for i in range(len(parts)))
+            sep = _path_sep(dirpath)
+        while stack and not dirpath.startswith(stack[-1][0]):
+            stack.pop()
+        if stack:
+            prefix, current_depth, limit, parts = stack[-1]
+            names = [name for name in dirpath[len(prefix):].split(sep) if name]
+        else:
+            current_depth, limit, parts = 0, depth, ()
+            names = []
+        for name in names:
+            current_depth += 1
+            parts += (name,)
+            if parts in limits:
+                subtree_limit = limits[parts]
+                if subtree_limit is None:
+                    limit = None
+                else:
+                    limit = current_depth + subtree_limit
+        if limit is not None and current_depth > limit and parts not in leads:
+            continue
+        stack.append((_dir_prefix(dirpath), current_depth, limit, parts))
+        yield dir_entry
+        if limit is not None and current_depth >= limit:
+            subdirs = dir_entry[1]
+            subdirs[:] = [subdir for subdir in subdirs
+                              if parts + (subdir,) in limits or
+                                 parts + (subdir,) in leads]
+
+def min_depth(walk_iter, depth):
+    """Only process subdirectories beyond a minimum depth
+    
+    A *depth* of 1 omits the top level directory, a *depth* of 2
+    starts with subdirectories 2 levels down, etc.
+
+    Depths are determined in the same way as they are for
+    :func:`limit_depth`.
+    
+    .. note:: Since this filter *doesn't yield* higher level directories, any
+      subsequent directory filtering that relies on updating the subdirectory
+      list will have no effect at the minimum depth. Accordingly, this filter
+      should only be applied *after* any directory filtering operations.
+
+    .. note:: The result of using this filter is effectively the same as
+      chaining multiple independent :func:`os.walk` iterators using
+      :func:`itertools.chain`. For example, given the following directory tree::
+
+        >>> tree test
+        test
+        ├── file1.txt
+        ├── file2.txt
+        ├── test2
+        │   ├── file1.txt
+        │   ├── file2.txt
+        │   └── test3
+        └── test4
+            ├── file1.txt
+            └── test5
+
+      Then ``min_depth(os.walk("test"), depth=1)`` will produce the same output
+      as ``itertools.chain(os.walk("test/test2"), os.walk("test/test4")).``
+
+    This filter works by modifying the subdirectory lists produced by the
+    underlying iterator, and hence requires a top-down/breadth-first
+    traversal of the directory hierarchy.
+    """
+    if depth < 1:
+        msg = "Minimium depth less than 1 ({!r} provided)"
+        raise ValueError(msg.format(depth))
+    stack = []
+    for dir_entry in walk_iter:
+        current_depth = getattr(dir_entry, "depth", None)
+        if current_depth is None:
+            current_depth = _stack_depth(stack, dir_entry[0])
+        if current_depth >= depth:
+            yield dir_entry
+
+def subtree_roots(walk_iter, depth, followlinks=False):
+    """Iterate over the paths of the directories at a given depth
+
+    Produces the path of every directory *depth* levels below the top of
+    the underlying walk, without the underlying iterator listing those
+    directories (or anything below them). Combined with a source that
+    skips building file lists (such as :func:`scandir_walk` with
+    *min_file_depth* set), this finds the starting points for the walks
+    that :func:`min_depth` would produce with as little work as possible,
+    so the subtrees can then be walked separately (for example, in
+    parallel from a process or thread pool)::
+
+        roots = subtree_roots(scandir_walk(top, min_file_depth=2), 2)
+        with ThreadPoolExecutor() as pool:
+            counts = pool.map(lambda root: len(list(file_paths(
+                                  filtered_walk(root)))), roots)
+
+    Subdirectories that are symlinks are skipped unless *followlinks* is
+    true. Depths are determined in the same way as they are for
+    :func:`limit_depth`, and a *depth* of 0 just produces the top directory.
+
+    This iterator works by modifying the subdirectory lists produced by the
+    underlying iterator, and hence requires a top-down/breadth-first
+    traversal of the directory hierarchy.
+    """
+    _check_depth_limit(depth)
+    stack = []
+    for dir_entry in walk_iter:
+        dirpath = dir_entry[0]
+        subdirs = dir_entry[1]
+        current_depth = getattr(dir_entry, "depth", None)
+        if current_depth is None:
+            current_depth = _stack_depth(stack, dirpath)
+        if depth == 0:
+            if current_depth == 0:
+                yield dirpath
+            subdirs[:] = []
+            continue
+        if current_depth == depth - 1:
+            for subdir in subdirs:
+                path = _subdir_path(dirpath, subdir)
+                if followlinks or not _is_symlink(path):
+                    yield path
+            subdirs[:] = []
+
+# Symlink loop handling
+
+def _dir_identity(dirpath):
+    """Get the ``(st_dev, st_ino)`` of a directory and whether it's a symlink
+
+    Only needs a single system call for directories that aren't symlinks.
+    """
+    if isinstance(dirpath, _EntryName):
+        is_link = dirpath.is_symlink()
+        st = dirpath.stat()
+        if st.st_ino:
+            return (st.st_dev, st.st_ino), is_link
+        # Cached stat results on Windows don't include the inode number
+        return _dir_identity(str(dirpath))[0], is_link
+    st = os.lstat(dirpath)
+    is_link = _stat.S_ISLNK(st.st_mode)
+    if is_link:
+        st = os.stat(dirpath)
+    return (st.st_dev, st.st_ino), is_link
+
+class VisitedDirs(object):
+    """A compact record of the directories visited during a walk
+
+    Directories are identified by their ``(st_dev, st_ino)`` pairs, which
+    are stored as single integers in a set. If *max_bytes* is given and
+    the estimated memory use of the set would exceed it, the set is
+    replaced by a Bloom filter using *max_bytes* bytes, so memory use stays
+    capped no matter how many directories are visited. Once that happens,
+    directories that haven't been visited may occasionally be reported as
+    visited (the false positive rate grows as more directories are added).
+
+    Instances can be passed as the *visited* argument to
+    :func:`handle_symlink_loops` or as the *dedup* argument to
+    :func:`filtered_walk`.
+    """
+    # Rough per-entry cost of a set of large integers (the integer object
+    # plus the set's hash table slot)
+    _entry_bytes = sys.getsizeof(2**80) + 24
+
+    def __init__(self, max_bytes=None):
+        if max_bytes is not None and max_bytes <= 0:
+            msg = "Maximum size must be greater than 0 ({0!r} provided)"
+            raise ValueError(msg.format(max_bytes))
+        self.max_bytes = max_bytes
+        self._keys = set()
+        self._bits = None
+        self._hashes = 0
+        self._count = 0
+
+    @staticmethod
+    def _key(identity):
+        dev, ino = identity
+        return (dev << 64) | ino
+
+    @property
+    def exact(self):
+        """Whether membership tests are still exact (no Bloom filter)"""
+        return self._bits is None
+
+    @property
+    def nbytes(self):
+        """The (estimated) number of bytes used to record the directories"""
+        if self._bits is not None:
+            return len(self._bits)
+        return sys.getsizeof(self._keys) + len(self._keys) * self._entry_bytes
+
+    def __len__(self):
+        """The number of directories added (including any repeats added
+        after switching to a Bloom filter)"""
+        return self._count
+
+    def _bit_indices(self, key):
+        # Double hashing gives the indices for all the hash functions
+        size = len(self._bits) * 8
+        h1 = hash(key) % size
+        h2 = (hash((key, size)) % size) | 1
+        return [(h1 + i * h2) % size for i in range(self._hashes)]
+
+    def _to_bloom_filter(self):
+        size = self.max_bytes * 8
+        # Choose the number of hashes assuming the walk is halfway done
+        expected = max(1, 2 * len(self._keys))
+        self._hashes = min(16, max(1, int(round(size / expected * 0.693))))
+        self._bits = bytearray(self.max_bytes)
+        keys = self._keys
+        self._keys = set()
+        for key in keys:
+            self._set_bits(key)
+
+    def _set_bits(self, key):
+        bits = self._bits
+        for index in self._bit_indices(key):
+            bits[index >> 3] |= 1 << (index & 7)
+
+    def add(self, identity):
+        """Record a directory's ``(st_dev, st_ino)`` pair"""
+        key = self._key(identity)
+        self._count += 1
+        if self._bits is not None:
+            self._set_bits(key)
+            return
+        self._keys.add(key)
+        if self.max_bytes is not None and self.nbytes > self.max_bytes:
+            self._to_bloom_filter()
+
+    def __contains__(self, identity):
+        key = self._key(identity)
+        bits = self._bits
+        if bits is None:
+            return key in self._keys
+        for index in self._bit_indices(key):
+            if not bits[index >> 3] & (1 << (index & 7)):
+                return False
+        return True
+
+def handle_symlink_loops(walk_iter, onloop=None, visited=None, onrepeat=None):
+    """Handle symlink loops when following symlinks during a walk
     
     By default, prints a warning and then skips processing
     the directory a second time.
@@ -215,52 +1906,515 @@ def handle_symlink_loops(walk_iter, onloop=None):
     from this callback will mean that the directory is still processed,
     otherwise it will be skipped.
 
+    Loops are detected by tracking the device and inode numbers of the
+    directories between the top of the walk and the current directory, so
+    every symlink that refers back to one of those directories is detected
+    (including loops formed by several symlinks), using a single
+    :func:`os.stat` call per directory (two for symlinks). Memory use is
+    proportional to the depth of the walk. In a breadth-first walk (such as
+    :func:`breadth_first_walk`), the directories between the top of the
+    walk and a symlink are stat-ed again when the symlink is checked.
+
+    If *visited* is given (usually as a :class:`VisitedDirs` instance, but
+    any container supporting ``add`` and ``in`` will do), it is used to
+    record the device and inode numbers of every directory visited, and
+    directories that have already been visited (for example, because more
+    than one symlink refers to them) are treated as repeats. Repeats are
+    passed to the *onrepeat* callback (or to *onloop* if only that is
+    given), and are skipped unless the callback returns a true value. By
+    default, a warning is printed and the repeat is skipped.
+
     This filter skips processing subdirectories by modifying the subdirectory
     lists produced by the underlying iterator, and hence requires a
     top-down/breadth-first traversal of the directory hierarchy.
     """
+    if onrepeat is None:
+        if onloop is None:
+            def onrepeat(dirpath):
+                msg = "Directory {0!r} has already been walked, skipping\n"
+                sys.stderr.write(msg.format(dirpath))
+                sys.stderr.flush()
+        else:
+            onrepeat = onloop
     if onloop is None:
         def onloop(dirpath):
             msg = "Symlink {0!r} refers to a parent directory, skipping\n"
             sys.stderr.write(msg.format(dirpath))
             sys.stderr.flush()
-    sep=os.sep
-    for dir_entry in walk_iter:
-        yield dir_entry
-        top = dir_entry[0]
-        real_top = os.path.abspath(os.path.realpath(top))
-        break
+    # Ancestors are kept as [prefix, identity] pairs, while the identities
+    # are counted separately (onloop may allow a loop to be walked again)
+    ancestors = []
+    active = collections.defaultdict(int)
     for dir_entry in walk_iter:
         dirpath = dir_entry[0]
-        subdirs = dir_entry[1]
-        if os.path.islink(dirpath):
+        while ancestors and not dirpath.startswith(ancestors[-1][0]):
+            identity = ancestors.pop()[1]
+            if identity is None:
+                continue
+            active[identity] -= 1
+            if not active[identity]:
+                del active[identity]
+        if ancestors:
+            # A breadth-first walk moves between subtrees without visiting
+            # the directories in between again, so those are only added
+            # as placeholders, and looked up if a symlink needs checking
+            sep = _path_sep(dirpath)
+            prefix = ancestors[-1][0]
+            for name in dirpath[len(prefix):].split(sep)[:-1]:
+                if name:
+                    prefix += name + sep
+                    ancestors.append([prefix, None])
+        try:
+            identity, is_link = _dir_identity(dirpath)
+        except OSError:
+            yield dir_entry
+            continue
+        if is_link:
+            for ancestor in ancestors:
+                if ancestor[1] is None:
+                    try:
+                        ancestor[1] = _dir_identity(ancestor[0])[0]
+                    except OSError:
+                        continue
+                    active[ancestor[1]] += 1
+        if is_link and identity in active:
             # We just descended into a directory via a symbolic link
-            # Check if we're referring to a directory that is
-            # a parent of our nominal directory
-            relative = os.path.relpath(dirpath, top)
-            nominal_path = os.path.join(real_top, relative)
-            real_path = os.path.abspath(os.path.realpath(dirpath))
-            path_fragments = zip(nominal_path.split(sep), real_path.split(sep))
-            for nominal, real in path_fragments:
-                if nominal != real:
-                    break
-            else:
-                if not onloop(dirpath):
-                    subdirs[:] = []
-                    continue
+            # that refers to a parent of our nominal directory
+            if not onloop(dirpath):
+                dir_entry[1][:] = []
+                continue
+        elif visited is not None and identity in visited:
+            # We already walked this directory by a different path
+            if not onrepeat(dirpath):
+                dir_entry[1][:] = []
+                continue
+        ancestors.append([_dir_prefix(dirpath), identity])
+        active[identity] += 1
+        if visited is not None:
+            visited.add(identity)
+        yield dir_entry
+
+def _skip_repeat(dirpath):
+    return False
+
+# Instrumentation of iterator pipelines
+
+class StageStats(object):
+    """Counters for a single stage of an instrumented walk pipeline
+
+    The counters are:
+
+        - ``name``: the name of the pipeline stage
+        - ``dirs``: the number of directories produced by the stage
+        - ``items``: the number of file and subdirectory names in the
+          directories produced by the stage
+        - ``pruned``: the number of files and subdirectories the stage
+          removed from the lists produced by the previous stage
+        - ``syscalls``: an estimate of the number of system calls made by
+          the stage (directory listings, stat calls and symlink checks)
+        - ``wall_time`` and ``cpu_time``: the time spent in this stage,
+          excluding the time spent in earlier stages. CPU time is for the
+          whole process, so it includes any worker threads
+        - ``dirs_per_second`` and ``items_per_second``: the rates at which
+          the stage produced directories and names, based on the stage's
+          own wall time
+
+    """
+    def __init__(self, name, upstream):
+        self.name = name
+        self.dirs = 0
+        self.items = 0
+        self.syscalls = 0
+        self._upstream = upstream
+        self._pruned_before_yield = 0
+        self._pruned_after_yield = 0
+        self._wall_time = 0.0
+        self._cpu_time = 0.0
+        self._last = None
+        self._last_count = 0
+
+    @property
+    def pruned(self):
+        # Entries removed after a triple has been produced (such as those
+        # removed by limit_depth) are removed while the next triple is
+        # requested, so those counts include the upstream stages
+        pruned = self._pruned_before_yield + self._pruned_after_yield
+        if self._upstream is None:
+            return pruned
+        return pruned - self._upstream._pruned_after_yield
+
+    @property
+    def wall_time(self):
+        if self._upstream is None:
+            return self._wall_time
+        return self._wall_time - self._upstream._wall_time
+
+    @property
+    def cpu_time(self):
+        if self._upstream is None:
+            return self._cpu_time
+        return self._cpu_time - self._upstream._cpu_time
+
+    def _rate(self, count):
+        wall_time = self.wall_time
+        if wall_time <= 0:
+            return 0.0
+        return count / wall_time
+
+    @property
+    def dirs_per_second(self):
+        """Directories produced per second of the stage's own wall time"""
+        return self._rate(self.dirs)
+
+    @property
+    def items_per_second(self):
+        """Names produced per second of the stage's own wall time"""
+        return self._rate(self.items)
+
+    def __repr__(self):
+        msg = ("<StageStats {0}: dirs={1} items={2} pruned={3} syscalls={4} "
+               "wall_time={5:.6f} cpu_time={6:.6f}>")
+        return msg.format(self.name, self.dirs, self.items, self.pruned,
+                          self.syscalls, self.wall_time, self.cpu_time)
+
+def _count_listings(dir_entry):
+    return 1
+
+def _count_stat_calls(dir_entry):
+    return len(dir_entry[2])
+
+def _count_identity_checks(dir_entry):
+    # Symlinks need a second call to look up their target
+    dirpath = dir_entry[0]
+    if isinstance(dirpath, _EntryName) and dirpath.is_symlink():
+        return 2
+    return 1
+
+def _count_ignore_files(ignore_names):
+    def _count(dir_entry):
+        files = dir_entry[2]
+        return sum(1 for name in ignore_names if name in files)
+    return _count
+
+class WalkStats(object):
+    """Per-stage counters for a walk pipeline built by :func:`filtered_walk`
+
+    Passing an instance as the *stats* argument to :func:`filtered_walk`
+    wraps each stage of the pipeline it builds to count directories, pruned
+    entries and (estimated) system calls, and to time each stage. The
+    results are available from :attr:`stages` (a list of
+    :class:`StageStats` in pipeline order, starting with the walk itself)
+    while the walk is running, as well as once it has finished.
+
+    :attr:`consumer_time` is the wall time spent by the code consuming the
+    walk, and :attr:`elapsed` is the total wall time since the walk started.
+
+    If *progress* is given, it is called with the stats object at most
+    once every *interval* seconds while the walk is running, and once more
+    when it finishes.
+
+    When no stats object is given, :func:`filtered_walk` doesn't wrap the
+    pipeline stages at all, so the instrumentation has no overhead.
+    """
+    def __init__(self, progress=None, interval=1.0):
+        self.progress = progress
+        self.interval = interval
+        self.stages = []
+        self.consumer_time = 0.0
+        self.elapsed = 0.0
+
+    def _wrap(self, walk_iter, name, count_syscalls=None):
+        upstream = self.stages[-1] if self.stages else None
+        stage = StageStats(name, upstream)
+        self.stages.append(stage)
+        return self._measure_stage(iter(walk_iter), stage, count_syscalls)
+
+    @staticmethod
+    def _measure_stage(walk_iter, stage, count_syscalls):
+        upstream = stage._upstream
+        last = None
+        while True:
+            if last is not None:
+                last_count = len(last[1]) + len(last[2])
+            start_wall = _wall_time()
+            start_cpu = _cpu_time()
+            try:
+                dir_entry = next(walk_iter)
+            except StopIteration:
+                dir_entry = None
+            # Times are cumulative, since they include the upstream stages
+            stage._wall_time += _wall_time() - start_wall
+            stage._cpu_time += _cpu_time() - start_cpu
+            if last is not None:
+                stage._pruned_after_yield += (last_count - len(last[1]) -
+                                              len(last[2]))
+            if dir_entry is None:
+                break
+            last = dir_entry
+            stage.dirs += 1
+            count = len(dir_entry[1]) + len(dir_entry[2])
+            if upstream is not None and upstream._last is dir_entry:
+                stage._pruned_before_yield += upstream._last_count - count
+            stage.items += count
+            stage._last = dir_entry
+            stage._last_count = count
+            if count_syscalls is not None:
+                stage.syscalls += count_syscalls(dir_entry)
+            yield dir_entry
+
+    def _measure_consumer(self, walk_iter):
+        progress = self.progress
+        start = last_report = _wall_time()
+        for dir_entry in walk_iter:
+            yielded = _wall_time()
+            yield dir_entry
+            now = _wall_time()
+            self.consumer_time += now - yielded
+            self.elapsed = now - start
+            if progress is not None and now - last_report >= self.interval:
+                last_report = now
+                progress(self)
+        self.elapsed = _wall_time() - start
+        if progress is not None:
+            progress(self)
+
+    def __repr__(self):
+        lines = ["<WalkStats elapsed={0:.6f} consumer_time={1:.6f}".format(
+                     self.elapsed, self.consumer_time)]
+        lines.extend("  {0!r}".format(stage) for stage in self.stages)
+        return "\n".join(lines) + ">"
+
+# Deterministic ordering
+
+def sort_walk(walk_iter):
+    """Sort the subdirectory and file lists produced by the underlying walk
+
+    The lists are sorted in place, so a top-down walk also visits the
+    subdirectories in sorted order, and the directories are produced in
+    path component order (see :func:`dir_paths`). Combined with a
+    flattening iterator with *sorted* set, this gives a deterministic
+    stream of paths regardless of the order of the directory listings.
+    """
+    for dir_entry in walk_iter:
+        dir_entry[1].sort()
+        dir_entry[2].sort()
         yield dir_entry
 
+# Budgeted and resumable walks
+
+def limit_walk(walk_iter, max_dirs=None, max_files=None, timeout=None,
+               cursor=None):
+    """Stop a walk early once it has used up a budget
+
+    The walk stops once *max_dirs* directories have been produced, once the
+    file lists of the directories produced hold *max_files* names in total
+    (so the directory that reaches the limit is produced with all of its
+    files), or once *timeout* seconds have passed since the first
+    directory was requested (checked each time the next directory is
+    requested, so a single slow listing may overrun it). Limits of
+    ``None`` (the default) don't apply.
+
+    If the walk comes from :meth:`WalkCursor.walk`, passing the cursor as
+    *cursor* lets the cursor record the last directory produced as
+    finished. When the walk stops, the cursor is told to :meth:`~WalkCursor.stop`
+    and the underlying iterator is advanced once more, so all the pipeline
+    stages finish with that directory (for example, :func:`limit_depth`
+    prunes the subdirectory lists of the deepest directories at that point)
+    without another directory being listed.
+
+    This filter does not modify the lists produced by the underlying
+    iterator, and hence supports both top-down/breadth-first and
+    bottom-up/depth-first traversal of the directory hierarchy.
+    """
+    walk_iter = iter(walk_iter)
+    deadline = None
+    if timeout is not None:
+        deadline = _wall_time() + timeout
+    dirs = files = 0
+    while True:
+        if ((max_dirs is not None and dirs >= max_dirs) or
+                (max_files is not None and files >= max_files) or
+                (deadline is not None and _wall_time() >= deadline)):
+            if dirs and cursor is not None:
+                cursor.stop()
+                next(walk_iter, None)
+            return
+        try:
+            dir_entry = next(walk_iter)
+        except StopIteration:
+            return
+        dirs += 1
+        files += len(dir_entry[2])
+        yield dir_entry
+
+class WalkCursor(object):
+    """A resumable position in a top-down walk of *top*
+
+    :meth:`walk` produces the same ``dirpath, subdirs, files`` triples as
+    :func:`scandir_walk` (as :class:`WalkTriple` instances, in the same
+    order), while recording which directories are still to be walked. If
+    the walk is abandoned part way through (for example, by
+    :func:`limit_walk`), a later call to :meth:`walk` continues where it
+    left off, without listing any of the directories that were finished
+    again. A directory is finished once the walk moves past it, at which
+    point the subdirectories remaining in its subdirectory list (after any
+    pruning by later pipeline stages) are added to the directories still
+    to be walked. The last directory produced by an abandoned walk is
+    walked again when the walk resumes, unless the walk was ended with
+    :meth:`stop` (as :func:`limit_walk` does when given the cursor).
+
+    Cursors can be saved to disk with :meth:`save` and read back with
+    :meth:`load` (or pickled). As with :class:`DirCache`, the file format
+    uses :mod:`marshal`. The directories still to be walked are recorded as
+    names along with the index of their parent in a table of directory
+    paths, so a cursor stays compact for wide trees.
+
+    The flattening iterators treat the first directory produced when the
+    walk resumes as a new root directory, so only :func:`file_paths`
+    (without *relative*) produces the same paths as an uninterrupted walk.
+    The same goes for filters that keep track of the directories leading
+    to the current one (such as :func:`exclude_ignored`, path patterns and
+    :func:`handle_symlink_loops`), so :func:`filtered_walk` doesn't allow
+    those to be combined with a cursor.
+    """
+    _header = "walkdir-cursor-1-py{0}.{1}\n".format(*sys.version_info)
+
+    def __init__(self, top):
+        self.top = top
+        # The number of directories finished so far
+        self.dirs = 0
+        # Maps parent indices to [dirpath, depth, subdirectories pending],
+        # while the pending directories are a stack of (index, name) pairs
+        # (with an index of None for the top directory)
+        self._parents = {}
+        self._pending = [(None, top)]
+        self._next_index = 0
+        self._current = None
+        self._stopping = False
+
+    @property
+    def finished(self):
+        """Whether the walk has been completed"""
+        return not self._pending and self._current is None
+
+    def __len__(self):
+        """The number of directories known to be still to be walked"""
+        return len(self._pending) + (self._current is not None)
+
+    def walk(self, onerror=None, followlinks=False, min_file_depth=0):
+        """Walk the directories that are still to be walked
+
+        *onerror*, *followlinks* and *min_file_depth* have the same
+        meaning as they do for :func:`scandir_walk` (and should be the same
+        each time the walk is resumed). Only one walk using a given cursor
+        should be active at a time.
+
+        Requires :func:`os.scandir` (or the ``scandir`` backport on older
+        versions of Python).
+        """
+        parents = self._parents
+        pending = self._pending
+        self._stopping = False
+        if self._current is not None:
+            pending.append(self._current)
+            self._current = None
+        while pending:
+            index, name = self._current = pending.pop()
+            if index is None:
+                dirpath, depth = name, 0
+            else:
+                parent = parents[index]
+                dirpath = os.path.join(parent[0], name)
+                depth = parent[1] + 1
+            listing = _scan_dir(dirpath, onerror, depth < min_file_depth)
+            if listing is not None:
+                subdirs, files = listing
+                yield WalkTriple(dirpath, subdirs, files, depth)
+                scheduled = []
+                for subdir in subdirs:
+                    # Names added to the list by the caller won't have
+                    # cached entries
+                    if followlinks or not _is_symlink(_subdir_path(dirpath,
+                                                                   subdir)):
+                        scheduled.append((self._next_index, _plain_name(subdir)))
+                if scheduled:
+                    parents[self._next_index] = [_plain_name(dirpath), depth,
+                                                 len(scheduled)]
+                    self._next_index += 1
+                    pending.extend(reversed(scheduled))
+            if index is not None:
+                parent[2] -= 1
+                if not parent[2]:
+                    del parents[index]
+            self._current = None
+            self.dirs += 1
+            if self._stopping:
+                self._stopping = False
+                return
+
+    def stop(self):
+        """End the active walk once it has finished with the current directory
+
+        The walk produces no more directories: the next time it's advanced,
+        it records the subdirectories of the last directory produced as
+        still to be walked, and then stops without listing anything else.
+        """
+        self._stopping = True
+
+    def _state(self):
+        return (self.top, self.dirs, self._parents, self._pending,
+                self._next_index, self._current)
+
+    def save(self, filename):
+        """Write the cursor to *filename*"""
+        with open(filename, "wb") as f:
+            f.write(self._header.encode("ascii"))
+            marshal.dump(self._state(), f)
+
+    @classmethod
+    def load(cls, filename):
+        """Read a cursor previously written by :meth:`save`
+
+        Raises :exc:`ValueError` if the file was not written by :meth:`save`
+        on this version of Python.
+        """
+        header = cls._header.encode("ascii")
+        with open(filename, "rb") as f:
+            if f.read(len(header)) != header:
+                msg = "{0!r} is not a compatible walk cursor"
+                raise ValueError(msg.format(filename))
+            state = marshal.load(f)
+        self = cls(state[0])
+        (self.dirs, self._parents, self._pending, self._next_index,
+         self._current) = state[1:]
+        return self
+
+    def __repr__(self):
+        msg = "<WalkCursor {0!r}: dirs={1} pending={2}>"
+        return msg.format(self.top, self.dirs, len(self))
+
 # Convenience function that puts together an iterator pipeline
 
+def _encode_patterns(patterns):
+    if patterns is None:
+        return None
+    return [_fsencode(pattern) for pattern in patterns]
+
 def filtered_walk(top, included_files=None, included_dirs=None,
                        excluded_files=None, excluded_dirs=None,
-                       depth=None, followlinks=False, min_depth=None):
+                       depth=None, followlinks=False, min_depth=None,
+                       workers=None, cache=None, ignore_files=None,
+                       stat_filter=None, stats=None, dedup=None,
+                       subtree_depths=None, sorted=False, cursor=None,
+                       max_dirs=None, max_files=None, timeout=None):
     """This is a wrapper around ``os.walk()`` and other filesystem traversal
        iterators, with these additional features:
 
-        - *top* may be either a string (which will be passed to ``os.walk()``)
-          or any iterable that produces sequences with ``path, subdirs, files``
-          as the first three elements in the sequence
+        - *top* may be either a string or :class:`bytes` path (which will be
+          passed to :func:`scandir_walk`, or to ``os.walk()`` if
+          :func:`os.scandir` is not available) or any iterable that produces
+          sequences with ``path, subdirs, files`` as the first three
+          elements in the sequence
         - allows independent glob-style filters for filenames and subdirectories
         - allows a recursion depth limit to be specified
         - allows a minimum depth to be specified to report only subdirectory
@@ -273,99 +2427,1672 @@ def filtered_walk(top, included_files=None, included_dirs=None,
        above features.
 
        *include_files*, *include_dirs*, *exclude_files* and *exclude_dirs* are
-       used to apply the relevant filtering steps to the walk.
+       used to apply the relevant filtering steps to the walk. When *top* is
+       a :class:`bytes` path, string patterns are encoded with
+       :func:`os.fsencode`, so the names are matched without decoding them
+
+       *ignore_files* gives the names of ``.gitignore`` style ignore files
+       to honour with :func:`exclude_ignored`
+
+       *stat_filter* is a mapping of keyword arguments for
+       :func:`filter_stat` (e.g. ``{"min_size": 2**20}``). The stat results
+       are fetched with :func:`attach_stat`, so the resulting file names
+       also provide the stat results to later processing
+
+       Passing a :class:`WalkStats` instance as *stats* records counters
+       and timings for each stage of the pipeline
        
        A *depth* of ``None`` (the default) disables depth limiting. Otherwise,
        *depth* must be at least zero and indicates how far to descend into the
        directory hierarchy. A depth of zero is useful to get separate filtered
-       subdirectory and file listings for *top*.
+       subdirectory and file listings for *top*. *subtree_depths* sets
+       separate depth limits for particular subtrees (see
+       :func:`limit_depth`).
        
        Setting *min_depth* allows directories higher in the tree to be
        excluded from the walk (e.g. a *min_depth* of 1 excludes *top*, but
-       any subdirectories will still be processed)
+       any subdirectories will still be processed). Unless a *cache* or
+       *ignore_files* are in use, only the subdirectories of the excluded
+       directories are listed when *top* is a string
 
        *followlinks* enables symbolic loop detection (when set to ``True``)
-       and is also passed to ``os.walk()`` when top is a string
+       and is also passed to the underlying walk when top is a string
+
+       When following symlinks, setting *dedup* to ``True`` (or to a
+       :class:`VisitedDirs` instance, to cap its memory use or report on
+       it) also skips directories that have already been walked by a
+       different path
+
+       Setting *sorted* to ``True`` sorts the subdirectory and file lists
+       with :func:`sort_walk`, so the walk visits directories in path
+       component order (pass the result to a flattening iterator with
+       *sorted* set to get the paths in that order)
+
+       Setting *workers* walks a string *top* with :func:`parallel_walk`,
+       using that many threads to list directories
+
+       Setting *cache* to a :class:`DirCache` walks a string *top* with
+       :func:`cached_walk`, so only directories that have changed since the
+       previous walk are listed
+
+       Setting *cursor* to a :class:`WalkCursor` for *top* walks the
+       directories that are still to be walked according to the cursor, so
+       a walk stopped by *max_dirs*, *max_files* or *timeout* (see
+       :func:`limit_walk`) can be resumed by calling :func:`filtered_walk`
+       again with the same arguments. The resumed walk doesn't revisit the
+       directories above the ones it resumes from, so a cursor can't be
+       combined with the options that depend on them (*ignore_files*, path
+       patterns, *followlinks*, *dedup* and *subtree_depths*)
     """
-    if isinstance(top, str):
-        walk_iter = os.walk(top, followlinks=followlinks)
+    if stats is None:
+        def stage(walk_iter, name, count_syscalls=None):
+            return walk_iter
+    else:
+        stage = stats._wrap
+    if isinstance(top, bytes) and bytes is not str:
+        included_files = _encode_patterns(included_files)
+        included_dirs = _encode_patterns(included_dirs)
+        excluded_files = _encode_patterns(excluded_files)
+        excluded_dirs = _encode_patterns(excluded_dirs)
+    if isinstance(top, (str, bytes)):
+        # Ignore files may appear in the directories min_depth discards
+        min_file_depth = 0
+        if min_depth is not None and ignore_files is None:
+            min_file_depth = min_depth
+        if cursor is not None:
+            if workers is not None or cache is not None:
+                msg = ("Resumable walks can't be parallel or use a "
+                       "directory cache")
+                raise ValueError(msg)
+            if cursor.top != top:
+                msg = "Cursor is for {0!r}, not {1!r}"
+                raise ValueError(msg.format(cursor.top, top))
+            # These stages rely on seeing the directories above the ones
+            # the walk resumes from
+            options = [("ignore_files", ignore_files),
+                       ("followlinks", followlinks), ("dedup", dedup),
+                       ("subtree_depths", subtree_depths)]
+            for name, value in options:
+                if value:
+                    msg = "Resumable walks can't use {0!r}"
+                    raise ValueError(msg.format(name))
+            patterns = [("included_files", included_files),
+                        ("included_dirs", included_dirs),
+                        ("excluded_files", excluded_files),
+                        ("excluded_dirs", excluded_dirs)]
+            for name, value in patterns:
+                if value and _split_patterns(value)[1]:
+                    msg = "Resumable walks can't use path patterns in {0!r}"
+                    raise ValueError(msg.format(name))
+            walk_iter = cursor.walk(followlinks=followlinks,
+                                    min_file_depth=min_file_depth)
+        elif cache is not None:
+            if workers is not None:
+                msg = "Parallel walks can't use a directory cache"
+                raise ValueError(msg)
+            walk_iter = cached_walk(top, cache, followlinks=followlinks)
+        elif workers is not None:
+            walk_iter = parallel_walk(top, workers=workers,
+                                      followlinks=followlinks,
+                                      min_file_depth=min_file_depth)
+        elif _scandir is None:
+            walk_iter = os.walk(top, followlinks=followlinks)
+        else:
+            walk_iter = scandir_walk(top, followlinks=followlinks,
+                                     min_file_depth=min_file_depth)
+        walk_iter = stage(walk_iter, "walk", _count_listings)
     else:
-        walk_iter = top
+        if cursor is not None:
+            raise ValueError("Resumable walks need a path to walk")
+        walk_iter = stage(top, "walk")
+    if sorted:
+        walk_iter = stage(sort_walk(walk_iter), "sort_walk")
     # Depth limiting first, since it can cut great swathes from the tree
-    if depth is not None:
-        walk_iter = limit_depth(walk_iter, depth)
+    if depth is not None or subtree_depths:
+        walk_iter = stage(limit_depth(walk_iter, depth, subtree_depths),
+                          "limit_depth")
     # Next we do our path based filtering that can skip directories
     if included_dirs is not None:
-        walk_iter = include_dirs(walk_iter, *included_dirs)
+        walk_iter = stage(include_dirs(walk_iter, *included_dirs),
+                          "include_dirs")
     if excluded_dirs is not None:
-        walk_iter = exclude_dirs(walk_iter, *excluded_dirs)
+        walk_iter = stage(exclude_dirs(walk_iter, *excluded_dirs),
+                          "exclude_dirs")
+    if ignore_files is not None:
+        walk_iter = stage(exclude_ignored(walk_iter, *ignore_files),
+                          "exclude_ignored", _count_ignore_files(ignore_files))
     # And then we check the filesystem for symlink loops
     if followlinks:
-        walk_iter = handle_symlink_loops(walk_iter)
+        if dedup is None or dedup is False:
+            walk_iter = handle_symlink_loops(walk_iter)
+        else:
+            if dedup is True:
+                dedup = VisitedDirs()
+            walk_iter = handle_symlink_loops(walk_iter, visited=dedup,
+                                             onrepeat=_skip_repeat)
+        walk_iter = stage(walk_iter, "handle_symlink_loops",
+                          _count_identity_checks)
+    # The file filters only alter the shape of the tree when pruning
+    # subdirectories that can't match anchored path patterns, but they
+    # still need to see the top directory to match paths relative to it
+    if included_files is not None:
+        walk_iter = stage(include_files(walk_iter, *included_files),
+                          "include_files")
+    if excluded_files is not None:
+        walk_iter = stage(exclude_files(walk_iter, *excluded_files),
+                          "exclude_files")
     # Now that all other directory filtering has been handled, we can apply
     # the minimum depth check
     if min_depth is not None:
-        walk_iter = globals()["min_depth"](walk_iter, min_depth)
-    # Finally, apply the file filters that can't alter the shape of the tree
-    if included_files is not None:
-        walk_iter = include_files(walk_iter, *included_files)
-    if excluded_files is not None:
-        walk_iter = exclude_files(walk_iter, *excluded_files)
+        walk_iter = stage(globals()["min_depth"](walk_iter, min_depth),
+                          "min_depth")
+    # Finally, fetch the file metadata for the files that remain
+    if stat_filter is not None:
+        walk_iter = stage(attach_stat(walk_iter), "attach_stat",
+                          _count_stat_calls)
+        walk_iter = stage(filter_stat(walk_iter, **stat_filter), "filter_stat")
+    # The budget applies to what the caller actually receives
+    if max_dirs is not None or max_files is not None or timeout is not None:
+        walk_iter = stage(limit_walk(walk_iter, max_dirs, max_files, timeout,
+                                     cursor), "limit_walk")
+    if stats is not None:
+        walk_iter = stats._measure_consumer(walk_iter)
     for triple in walk_iter:
         yield triple
 
 
 # Iterators that flatten the output into a series of paths
 
-def dir_paths(walk_iter):
+def _path_key(path):
+    """Get the key that sorts paths in path component order"""
+    # NUL sorts before any other character
+    if isinstance(path, bytes) and bytes is not str:
+        return path.replace(_bytes_sep, b"\0")
+    return path.replace(os.sep, "\0")
+
+def _ordered_entries(walk_iter, roots=False):
+    """Produce every entry from a top-down walk in path component order
+
+    Produces ``dirpath, relpath, name, is_dir`` tuples, where *relpath* is
+    the path of the entry relative to the root of the walk. Every entry
+    in a directory is produced in sorted order, immediately followed by the
+    entries of its subtree (if it is a subdirectory that is walked). This
+    is the order given by comparing paths as sequences of path components.
+    If *roots* is true, each root directory is also produced beforehand,
+    as an entry with an empty *dirpath* and *relpath*.
+
+    The subdirectory lists are sorted in place, so that the underlying walk
+    visits subdirectories in the same order. Only the entries of the current
+    directory and its ancestors are held in memory.
+    """
+    # Stack of [dirpath, prefix, relative prefix, sorted entries, position]
+    stack = []
+    def _flush(frame, stop=None):
+        dirpath, _, rel_prefix, entries, pos = frame
+        while pos < len(entries):
+            name, is_dir = entries[pos]
+            if stop is not None and name > stop:
+                break
+            pos += 1
+            yield dirpath, rel_prefix + name, name, is_dir
+        frame[4] = pos
+    for dir_entry in walk_iter:
+        dirpath, subdirs, files = dir_entry[0], dir_entry[1], dir_entry[2]
+        sep = _path_sep(dirpath)
+        subdirs.sort()
+        while stack:
+            frame = stack[-1]
+            prefix = frame[1]
+            name = dirpath[len(prefix):]
+            if dirpath.startswith(prefix) and sep not in name:
+                for entry in _flush(frame, name):
+                    yield entry
+                rel_prefix = frame[2] + name + sep
+                break
+            for entry in _flush(stack.pop()):
+                yield entry
+        else:
+            rel_prefix = dirpath[:0]
+            if roots:
+                yield rel_prefix, rel_prefix, dirpath, True
+        entries = [(name, True) for name in subdirs]
+        entries.extend((name, False) for name in files)
+        entries.sort()
+        stack.append([dirpath, _dir_prefix(dirpath), rel_prefix, entries, 0])
+    while stack:
+        for entry in _flush(stack.pop()):
+            yield entry
+
+def _root_path(root, relative, pairs, as_bytes):
+    """Get the output for a root directory from the flattening iterators"""
+    if relative:
+        path = os.curdir
+        if isinstance(root, bytes) and bytes is not str:
+            path = _fsencode(path)
+    else:
+        path = root
+    if as_bytes:
+        path = _fsencode(path)
+    if pairs:
+        return path[:0], path
+    return path
+
+def _named_paths(dir_part, names, pairs, as_bytes):
+    """Get the output for the given names in a directory"""
+    prefix = _dir_prefix(dir_part)
+    if as_bytes and not isinstance(dir_part, bytes):
+        # Encode all the names at once (they can't contain NUL)
+        nul = "\0"
+        names = _fsencode(nul.join(names)).split(_fsencode(nul))
+        dir_part = _fsencode(dir_part)
+        prefix = _fsencode(prefix)
+    if pairs:
+        return [(dir_part, name) for name in names]
+    return [prefix + name for name in names]
+
+def _path_lists(walk_iter, files, subdirs, relative=False, pairs=False,
+                as_bytes=False, sorted=False):
+    """Produce the paths behind the flattening iterators
+
+    Produces ``dirpath, names, paths`` for every directory with something
+    to report, where *paths* holds the output for each of the *names* in
+    *dirpath*. New root directories are reported separately beforehand
+    (with an empty *dirpath*) if *subdirs* is true.
+
+    Paths are built by adding each name to a prefix calculated once per
+    directory, rather than by calling :func:`os.path.join` for every name.
+    If *sorted* is true, the entries are produced in path component order
+    (see :func:`_ordered_entries`), so the same directory may be reported
+    several times (once for each run of entries between its subtrees).
+    """
+    if sorted:
+        entries = _ordered_entries(walk_iter, roots=True)
+        runs = itertools.groupby(entries, lambda entry: entry[0])
+        for dirpath, run in runs:
+            if not dirpath:
+                for entry in run:
+                    top_prefix = _dir_prefix(entry[2])
+                    if subdirs:
+                        root_path = _root_path(entry[2], relative, pairs,
+                                               as_bytes)
+                        yield dirpath, [entry[2]], [root_path]
+                continue
+            names = [name for _, _, name, is_dir in run
+                              if (subdirs if is_dir else files)]
+            if not names:
+                continue
+            dir_part = dirpath[len(top_prefix):] if relative else dirpath
+            yield dirpath, names, _named_paths(dir_part, names, pairs,
+                                               as_bytes)
+        return
+    top = top_prefix = None
+    for dir_entry in walk_iter:
+        dirpath = dir_entry[0]
+        if top is None or (dirpath != top and
+                           not dirpath.startswith(top_prefix)):
+            top = dirpath
+            top_prefix = _dir_prefix(dirpath)
+            if subdirs:
+                yield "", [dirpath], [_root_path(dirpath, relative, pairs,
+                                                 as_bytes)]
+        names = []
+        if files:
+            names.extend(dir_entry[2])
+        if subdirs:
+            names.extend(dir_entry[1])
+        if not names:
+            continue
+        # The relative path of the top directory itself is empty
+        dir_part = dirpath[len(top_prefix):] if relative else dirpath
+        yield dirpath, names, _named_paths(dir_part, names, pairs, as_bytes)
+
+def _flattened_paths(walk_iter, files, subdirs, with_stat, **kwds):
+    """Produce the paths (or ``path, stat`` pairs) one at a time"""
+    path_lists = _path_lists(walk_iter, files, subdirs, **kwds)
+    if not with_stat:
+        for dirpath, names, paths in path_lists:
+            for path in paths:
+                yield path
+        return
+    for dirpath, names, paths in path_lists:
+        for name, path in zip(names, paths):
+            try:
+                st = _name_stat(dirpath, name)
+            except OSError:
+                continue
+            yield path, st
+
+def dir_paths(walk_iter, with_stat=False, relative=False, pairs=False,
+              as_bytes=False, sorted=False):
     """Iterate over just the directory names visited by the underlying walk
 
+    If *relative* is true, the paths are relative to the root of the walk
+    (so the root directory itself is reported as :data:`os.curdir`). If
+    *pairs* is true, ``dirpath, name`` pairs are produced instead of paths
+    (with an empty *dirpath* for the root directory). If *as_bytes* is true,
+    paths are produced as :class:`bytes` (as encoded by :func:`os.fsencode`).
+
+    If *sorted* is true, the paths for each root directory are produced in
+    path component order (that is, sorted as if each path were a sequence
+    of names), by sorting the subdirectory lists of the underlying walk in
+    place. Only the names in the current directory and its parents are
+    held in memory. Root directories are produced in the order the walk
+    produces them (see :func:`sort_walk` to sort them as well, such as the
+    subdirectories reported by a walk using :func:`min_depth`).
+
+    If *with_stat* is true, ``path, stat`` pairs are produced instead (see
+    :func:`file_paths`).
+
     This iterator expects new root directories to be emitted by the underlying
     walk before any of their contents, and hence requires a
     top-down/breadth-first traversal of the directory hierarchy.
     """
-    dir_entry = next(walk_iter, None)
-    if dir_entry is None:
-        return
-    top = dir_entry[0]
-    yield top
-    while dir_entry:
-        dirpath = dir_entry[0]
-        if not dirpath.startswith(top):
-            yield dirpath
-            top = dirpath
-        for subdir in dir_entry[1]:
-            yield os.path.join(dirpath, subdir)
-        dir_entry = next(walk_iter, None)
+    return _flattened_paths(walk_iter, False, True, with_stat,
+                            relative=relative, pairs=pairs, as_bytes=as_bytes,
+                            sorted=sorted)
 
-def file_paths(walk_iter):
-    """Iterate over the files in directories visited by the underlying walk"""
-    for dir_entry in walk_iter:
-        for fname in dir_entry[2]:
-            yield os.path.join(dir_entry[0], fname)
+def file_paths(walk_iter, with_stat=False, relative=False, pairs=False,
+               as_bytes=False, sorted=False):
+    """Iterate over the files in directories visited by the underlying walk
+
+    If *with_stat* is true, ``path, stat`` pairs are produced instead. The
+    stat results are taken from :class:`WalkEntry` names where possible
+    (such as those produced by :func:`attach_stat`), and otherwise fetched
+    with :func:`os.stat`. Paths that can't be stat-ed are skipped.
+
+    *relative*, *pairs*, *as_bytes* and *sorted* have the same meaning as
+    they do for :func:`dir_paths` (with paths relative to the first
+    directory produced by the walk, or to the most recent directory that is
+    not below that one). Sorting requires a top-down traversal of the
+    directory hierarchy.
+    """
+    return _flattened_paths(walk_iter, True, False, with_stat,
+                            relative=relative, pairs=pairs, as_bytes=as_bytes,
+                            sorted=sorted)
 
-def all_paths(walk_iter):
+def all_paths(walk_iter, with_stat=False, relative=False, pairs=False,
+              as_bytes=False, sorted=False):
     """Iterate over both files and directories visited by the underlying walk
 
+    If *with_stat* is true, ``path, stat`` pairs are produced instead (see
+    :func:`file_paths`). *relative*, *pairs*, *as_bytes* and *sorted* have
+    the same meaning as they do for :func:`dir_paths`.
+
     This iterator expects new root directories to be emitted by the underlying
     walk before any of their contents, and hence requires a
     top-down/breadth-first traversal of the directory hierarchy.
     """
-    dir_entry = next(walk_iter, None)
-    if dir_entry is None:
+    return _flattened_paths(walk_iter, True, True, with_stat,
+                            relative=relative, pairs=pairs, as_bytes=as_bytes,
+                            sorted=sorted)
+
+def _keyed_paths(paths, key, index):
+    for path in paths:
+        yield key(path), index, path
+
+def merge_sorted_paths(*path_iters):
+    """Merge several sorted streams of paths into a single sorted stream
+
+    Each iterable must produce paths in path component order, such as those
+    produced by the flattening iterators with *sorted* set (either for
+    several roots, or relative to their roots, giving the union of several
+    trees). The streams are merged lazily with :func:`heapq.merge`, so only
+    one path from each stream is held in memory. Paths that appear in more
+    than one stream are produced once for each stream.
+    """
+    keyed = [_keyed_paths(paths, _path_key, index)
+                 for index, paths in enumerate(path_iters)]
+    for key, index, path in heapq.merge(*keyed):
+        yield path
+
+def _path_batches(walk_iter, files, subdirs, batch_size, per_dir, **kwds):
+    """Produce the paths behind the batched flattening iterators"""
+    if batch_size < 1:
+        msg = "Batch size less than 1 ({0!r} provided)"
+        raise ValueError(msg.format(batch_size))
+    batch = []
+    for dirpath, names, paths in _path_lists(walk_iter, files, subdirs,
+                                             **kwds):
+        batch.extend(paths)
+        if per_dir:
+            if not dirpath:
+                # Keep root directories with their contents
+                continue
+            if len(batch) > batch_size:
+                for start in range(0, len(batch), batch_size):
+                    yield batch[start:start + batch_size]
+            else:
+                yield batch
+            batch = []
+        elif len(batch) >= batch_size:
+            end = len(batch) - len(batch) % batch_size
+            for start in range(0, end, batch_size):
+                yield batch[start:start + batch_size]
+            batch = batch[end:]
+    for start in range(0, len(batch), batch_size):
+        yield batch[start:start + batch_size]
+
+def batched_dir_paths(walk_iter, batch_size=1000, per_dir=False, **kwds):
+    """Iterate over lists of the paths produced by :func:`dir_paths`
+
+    Each list holds up to *batch_size* paths. If *per_dir* is true, each
+    list only holds paths from a single directory (so a new list is
+    started for every directory with something to report). Otherwise,
+    every list except the last holds exactly *batch_size* paths.
+
+    Handing paths over in lists avoids most of the per-path overhead of
+    the generators when the paths are passed on to bulk consumers.
+
+    The *relative*, *pairs*, *as_bytes* and *sorted* keyword arguments are
+    accepted with the same meaning as they have for :func:`dir_paths`. This iterator
+    has the same requirements as :func:`dir_paths`.
+    """
+    return _path_batches(walk_iter, False, True, batch_size, per_dir, **kwds)
+
+def batched_file_paths(walk_iter, batch_size=1000, per_dir=False, **kwds):
+    """Iterate over lists of the paths produced by :func:`file_paths`
+
+    *batch_size*, *per_dir* and the keyword arguments have the same meaning
+    as they do for :func:`batched_dir_paths`.
+    """
+    return _path_batches(walk_iter, True, False, batch_size, per_dir, **kwds)
+
+def batched_all_paths(walk_iter, batch_size=1000, per_dir=False, **kwds):
+    """Iterate over lists of the paths produced by :func:`all_paths`
+
+    *batch_size*, *per_dir* and the keyword arguments have the same meaning
+    as they do for :func:`batched_dir_paths`.
+
+    This iterator has the same requirements as :func:`all_paths`.
+    """
+    return _path_batches(walk_iter, True, True, batch_size, per_dir, **kwds)
+
+# Selecting files from the output of large walks
+
+_STAT_KEYS = {
+    "size": operator.attrgetter("st_size"),
+    "mtime": operator.attrgetter("st_mtime"),
+    "atime": operator.attrgetter("st_atime"),
+    "ctime": operator.attrgetter("st_ctime"),
+}
+
+def _stat_candidates(walk_iter, key, follow_symlinks):
+    """Produce ``value, dirpath, name, stat`` for every file that can be stat-ed"""
+    for dir_entry in walk_iter:
+        dirpath = dir_entry[0]
+        for name in dir_entry[2]:
+            try:
+                st = _name_stat(dirpath, name, follow_symlinks)
+            except OSError:
+                continue
+            yield key(st), dirpath, name, st
+
+def top_files(walk_iter, count, key="size", smallest=False,
+              follow_symlinks=True):
+    """Find the files with the largest (or smallest) stat derived values
+
+    Returns a list of up to *count* ``path, stat`` pairs, ordered from the
+    largest value to the smallest (or the reverse, if *smallest* is true).
+    *key* is one of ``"size"``, ``"mtime"``, ``"atime"`` or ``"ctime"``, or
+    a function that is called with a stat result and returns the value to
+    compare. Files with equal values are reported in walk order.
+
+    For example, the 100 largest files in a tree::
+
+        largest = top_files(attach_stat(scandir_walk(top)), 100)
+
+    Only the best *count* candidates seen so far are held in memory (in a
+    heap), and paths are only built for the files that are reported. Stat
+    results are taken from :class:`WalkEntry` names where possible (such as
+    those produced by :func:`attach_stat`), and otherwise fetched with
+    :func:`os.stat` (or :func:`os.lstat` if *follow_symlinks* is false).
+    Files that can't be stat-ed are skipped.
+    """
+    if not callable(key):
+        try:
+            key = _STAT_KEYS[key]
+        except KeyError:
+            msg = "Unknown stat key {0!r} (expected one of {1})"
+            raise ValueError(msg.format(key, ", ".join(sorted(_STAT_KEYS))))
+    select = heapq.nsmallest if smallest else heapq.nlargest
+    candidates = _stat_candidates(walk_iter, key, follow_symlinks)
+    selected = select(count, candidates, key=operator.itemgetter(0))
+    return [(_dir_prefix(dirpath) + name, st)
+                for _, dirpath, name, st in selected]
+
+def _random_weight(random, count):
+    """Draw the next weight for reservoir sampling with Algorithm L"""
+    uniform = random.random()
+    while not uniform:
+        uniform = random.random()
+    return math.exp(math.log(uniform) / count)
+
+def _random_skip(random, weight):
+    """Draw the number of files to skip before the next reservoir update"""
+    if weight >= 1.0:
+        # The chance of any further update has underflowed
+        return float("inf")
+    uniform = random.random()
+    while not uniform:
+        uniform = random.random()
+    return int(math.log(uniform) / math.log1p(-weight))
+
+def sample_files(walk_iter, count, with_stat=False, follow_symlinks=True,
+                 random=None):
+    """Select a uniform random sample of the files in the underlying walk
+
+    Returns a list of up to *count* file paths, with every file produced
+    by the walk equally likely to be included. If *with_stat* is true,
+    ``path, stat`` pairs are returned instead (with stat results fetched
+    as described for :func:`top_files`, but only for the sampled files,
+    which are skipped if they can't be stat-ed).
+
+    The sample is collected in a single pass with reservoir sampling, so
+    only *count* files are held in memory. The number of files to skip
+    before each update is drawn in advance (Algorithm L), so the random
+    number generator is only consulted when the sample changes, and the
+    file lists of directories that are skipped entirely aren't examined
+    beyond taking their length. *random* may be given as a
+    :class:`random.Random` instance to make the sample reproducible.
+    """
+    if count < 1:
+        msg = "Sample size less than 1 ({0!r} provided)"
+        raise ValueError(msg.format(count))
+    if random is None:
+        random = _random
+    reservoir = []
+    weight = _random_weight(random, count)
+    next_index = count + _random_skip(random, weight)
+    seen = 0
+    for dir_entry in walk_iter:
+        dirpath = dir_entry[0]
+        files = dir_entry[2]
+        start = seen
+        seen += len(files)
+        if len(reservoir) < count:
+            reservoir.extend((dirpath, name)
+                                 for name in files[:count - len(reservoir)])
+        while next_index < seen:
+            reservoir[random.randrange(count)] = (dirpath,
+                                                  files[next_index - start])
+            weight *= _random_weight(random, count)
+            next_index += _random_skip(random, weight) + 1
+    if not with_stat:
+        return [_dir_prefix(dirpath) + name for dirpath, name in reservoir]
+    sample = []
+    for dirpath, name in reservoir:
+        try:
+            st = _name_stat(dirpath, name, follow_symlinks)
+        except OSError:
+            continue
+        sample.append((_dir_prefix(dirpath) + name, st))
+    return sample
+
+# Finding duplicate files
+
+class DuplicateStats(object):
+    """Counters for the work done by :func:`find_duplicates`
+
+    The counters are:
+
+        - ``files``: the number of distinct regular files considered (hard
+          links to a file that was already seen are not counted)
+        - ``candidates``: the number of files sharing their size with
+          another file
+        - ``partial_hashes`` and ``full_hashes``: the number of files
+          hashed at each stage
+        - ``duplicates``: the number of files reported as duplicates
+        - ``bytes_hashed``: the number of bytes read and hashed
+        - ``hash_time``: the wall time spent hashing
+
+    """
+    def __init__(self):
+        self.files = 0
+        self.candidates = 0
+        self.partial_hashes = 0
+        self.full_hashes = 0
+        self.duplicates = 0
+        self.bytes_hashed = 0
+        self.hash_time = 0.0
+
+    @property
+    def gigabytes_per_second(self):
+        """Hashing throughput, in units of 10**9 bytes per second"""
+        if not self.hash_time:
+            return 0.0
+        return self.bytes_hashed / self.hash_time / 1e9
+
+    def __repr__(self):
+        msg = ("<DuplicateStats files={0} candidates={1} partial_hashes={2} "
+               "full_hashes={3} duplicates={4} bytes_hashed={5} "
+               "hash_time={6:.6f} gigabytes_per_second={7:.3f}>")
+        return msg.format(self.files, self.candidates, self.partial_hashes,
+                          self.full_hashes, self.duplicates, self.bytes_hashed,
+                          self.hash_time, self.gigabytes_per_second)
+
+# Each hashing thread reuses a single read buffer for full hashes
+_hash_buffers = threading.local()
+
+def _edge_digest(path, size, edge_size, hash_name):
+    """Hash the first and last *edge_size* bytes of a file"""
+    digest = hashlib.new(hash_name)
+    with open(path, "rb") as f:
+        if size <= 2 * edge_size:
+            data = f.read()
+            digest.update(data)
+            return digest.digest(), len(data)
+        head = f.read(edge_size)
+        f.seek(-edge_size, os.SEEK_END)
+        tail = f.read(edge_size)
+    digest.update(head)
+    digest.update(tail)
+    return digest.digest(), len(head) + len(tail)
+
+def _full_digest(path, size, chunk_size, hash_name):
+    """Hash the entire contents of a file"""
+    buf = getattr(_hash_buffers, "buf", None)
+    if buf is None or len(buf) != chunk_size:
+        buf = _hash_buffers.buf = bytearray(chunk_size)
+    view = memoryview(buf)
+    digest = hashlib.new(hash_name)
+    total = 0
+    with open(path, "rb") as f:
+        while True:
+            count = f.readinto(buf)
+            if not count:
+                break
+            digest.update(view[:count])
+            total += count
+    return digest.digest(), total
+
+def _read_in_worker(func, path, size, *args):
+    # Errors are collected and reported from the consuming thread
+    try:
+        return path, func(path, size, *args), None
+    except (IOError, OSError) as error:
+        return path, None, error
+
+def _bounded_map(executor, func, arg_iter, window):
+    """Like :meth:`Executor.map`, but with at most *window* calls in flight"""
+    if executor is None:
+        for args in arg_iter:
+            yield func(*args)
         return
-    top = dir_entry[0]
-    yield top
-    while dir_entry:
+    pending = collections.deque()
+    try:
+        for args in arg_iter:
+            if len(pending) >= window:
+                yield pending.popleft().result()
+            pending.append(executor.submit(func, *args))
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+def _digest_groups(executor, window, groups, func, args, onerror, stats,
+                   full):
+    """Split ``size, paths`` groups by the digests *func* gives each file"""
+    # Groups may be produced lazily by an earlier stage, so they're queued
+    # as their files are scheduled, and taken back off as results arrive
+    scheduled = collections.deque()
+    def _arg_iter():
+        for size, paths in groups:
+            scheduled.append((size, len(paths)))
+            for path in paths:
+                yield (func, path, size) + args
+    results = _bounded_map(executor, _read_in_worker, _arg_iter(), window)
+    for first in results:
+        size, count = scheduled.popleft()
+        by_digest = collections.OrderedDict()
+        group_results = itertools.chain([first],
+                                        itertools.islice(results, count - 1))
+        for path, result, error in group_results:
+            if error is not None:
+                if onerror is not None:
+                    onerror(error)
+                continue
+            digest, nbytes = result
+            stats.bytes_hashed += nbytes
+            if full:
+                stats.full_hashes += 1
+            else:
+                stats.partial_hashes += 1
+            by_digest.setdefault(digest, []).append(path)
+        for same in by_digest.values():
+            if len(same) > 1:
+                yield size, same
+
+def find_duplicates(walk_iter, min_size=1, edge_size=4096, workers=8,
+                    hash_name="sha256", chunk_size=2**20, onerror=None,
+                    stats=None):
+    """Find groups of files with identical contents
+
+    Produces lists of the paths of files with identical contents (one list
+    for each distinct content shared by more than one file), largest files
+    first. Files are compared in stages, and each stage only considers the
+    files that could still have a duplicate:
+
+        1. files are grouped by size (using :class:`WalkEntry` stat results
+           where available), ignoring files smaller than *min_size*
+        2. files sharing a size are grouped by a hash of their first and
+           last *edge_size* bytes
+        3. files sharing a partial hash are grouped by a hash of their
+           entire contents (unless the partial hash already covered them)
+
+    Full hashes read each file in *chunk_size* pieces into a buffer that
+    is reused by each hashing thread, so memory use doesn't depend on file
+    sizes. Hashing is done by a pool of *workers* threads (the hash
+    functions in :mod:`hashlib` release the GIL for large inputs), with a
+    bounded number of files in flight. Setting *workers* to ``0`` (or
+    ``None``) hashes files in the current thread instead. *hash_name* is
+    any algorithm accepted by :func:`hashlib.new`.
+
+    Only regular files are considered, and symlinks are followed. Hard
+    links (and symlinks) to a file that was already seen are skipped, so
+    each file is read at most once and reported under the first path the
+    walk produced for it. Files that can't be stat-ed are skipped, while
+    errors opening or reading candidate files are passed to *onerror* (if
+    given) before skipping them.
+
+    If *stats* is given, it should be a :class:`DuplicateStats` instance,
+    which is updated with counters (including hashing throughput) as the
+    search progresses.
+
+    The whole walk is consumed before the first group is produced, since
+    any file may share its size with the last file in the walk. This
+    function does not modify the lists produced by the underlying iterator,
+    and hence supports both top-down/breadth-first and bottom-up/depth-first
+    traversal of the directory hierarchy.
+    """
+    if stats is None:
+        stats = DuplicateStats()
+    by_size = collections.defaultdict(list)
+    seen = set()
+    for dir_entry in walk_iter:
         dirpath = dir_entry[0]
-        if not dirpath.startswith(top):
-            yield dirpath
-            top = dirpath
-        for fname in dir_entry[2]:
-            yield os.path.join(dirpath, fname)
-        for subdir in dir_entry[1]:
-            yield os.path.join(dirpath, subdir)
-        dir_entry = next(walk_iter, None)
+        prefix = None
+        for name in dir_entry[2]:
+            try:
+                st = _name_stat(dirpath, name)
+            except OSError:
+                continue
+            if not _stat.S_ISREG(st.st_mode) or st.st_size < min_size:
+                continue
+            identity = st.st_dev, st.st_ino
+            if identity in seen:
+                continue
+            seen.add(identity)
+            if prefix is None:
+                prefix = _dir_prefix(dirpath)
+            by_size[st.st_size].append(prefix + name)
+    stats.files = len(seen)
+    del seen
+    groups = sorted((item for item in by_size.items() if len(item[1]) > 1),
+                    reverse=True)
+    del by_size
+    stats.candidates = sum(len(paths) for size, paths in groups)
+    # Groups are sorted by size, so the files covered by a partial hash
+    # come after the ones that still need a full hash
+    large = [group for group in groups if group[0] > 2 * edge_size]
+    small = groups[len(large):]
+    del groups
+    executor = None
+    window = 1
+    if workers and _futures is not None:
+        executor = _futures.ThreadPoolExecutor(workers)
+        window = 4 * workers
+    try:
+        if edge_size:
+            large = _digest_groups(executor, window, large, _edge_digest,
+                                   (edge_size, hash_name), onerror, stats,
+                                   False)
+        large = _digest_groups(executor, window, large, _full_digest,
+                               (chunk_size, hash_name), onerror, stats, True)
+        small = _digest_groups(executor, window, small, _edge_digest,
+                               (edge_size, hash_name), onerror, stats, False)
+        results = itertools.chain(large, small)
+        while True:
+            start = _wall_time()
+            try:
+                size, paths = next(results)
+            except StopIteration:
+                break
+            finally:
+                stats.hash_time += _wall_time() - start
+            stats.duplicates += len(paths)
+            yield paths
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+# Searching file contents
+
+# As for git, a NUL byte near the start of a file marks it as binary
+_BINARY_CHECK_SIZE = 8000
+
+def _block_matches(block, base, patterns, starts, end, final, limit=None):
+    """Find the matches in a block of data read from file offset *base*
+
+    *starts* holds the file offset each pattern may next match from (so
+    the overlap between blocks isn't searched twice). Unless *final* is
+    set, matches starting at or after *end* are left for the next block.
+    If *limit* is given, at most that many of the first matches are found.
+    """
+    found = []
+    if limit == 0:
+        return found
+    for index, pattern in enumerate(patterns):
+        count = 0
+        for match in pattern.finditer(block, max(starts[index] - base, 0)):
+            start = match.start()
+            if start >= end and not final:
+                break
+            found.append((base + start, index, match.group()))
+            starts[index] = base + max(match.end(), start + 1)
+            # The first matches overall are among the first for each pattern
+            count += 1
+            if count == limit:
+                break
+    found.sort(key=operator.itemgetter(0, 1))
+    return found[:limit]
+
+def _search_file(path, size, patterns, chunk_size, overlap, mmap_size,
+                 skip_binary, max_count):
+    """Find the ``offset, data`` pairs for the matches in a single file"""
+    starts = [0] * len(patterns)
+    found = []
+    with open(path, "rb") as f:
+        if size >= mmap_size:
+            try:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, EnvironmentError):
+                # Such as a file that was truncated after it was stat-ed
+                data = None
+            if data is not None:
+                with contextlib.closing(data):
+                    if skip_binary and b"\0" in data[:_BINARY_CHECK_SIZE]:
+                        return []
+                    found = _block_matches(data, 0, patterns, starts, 0, True,
+                                           max_count)
+                return [(offset, match) for offset, index, match in found]
+        chunk = f.read(chunk_size)
+        if skip_binary and b"\0" in chunk[:_BINARY_CHECK_SIZE]:
+            return []
+        block = chunk
+        base = 0
+        while True:
+            final = len(chunk) < chunk_size
+            end = len(block) - overlap
+            limit = None if max_count is None else max_count - len(found)
+            found.extend(_block_matches(block, base, patterns, starts, end,
+                                        final, limit))
+            if final or len(found) == max_count:
+                return [(offset, match) for offset, index, match in found]
+            # Matches from *end* onwards are found in the next block, which
+            # also keeps the data before them for lookbehind assertions
+            starts = [max(start, base + end) for start in starts]
+            carry = block[max(end - overlap, 0):]
+            base += len(block) - len(carry)
+            chunk = f.read(chunk_size)
+            block = carry + chunk
+
+def search_files(walk_iter, patterns, workers=8, max_count=None,
+                 skip_binary=True, chunk_size=2**18, overlap=4096,
+                 mmap_size=2**22, onerror=None):
+    """Search the contents of the files in the underlying walk
+
+    *patterns* is a compiled :class:`bytes` regular expression (or a
+    sequence of them). Produces a ``path, offset, data`` tuple for every
+    match in every file, where *offset* is the position of the match in the
+    file and *data* is the matched :class:`bytes`. Matches in each file are
+    produced in order of their offsets. If *max_count* is given, at most
+    that many matches are produced for each file (and the search of each
+    file stops once they have been found).
+
+    Files of at least *mmap_size* bytes are searched through :mod:`mmap`,
+    while smaller files are read in blocks of *chunk_size* bytes. Matches
+    starting in the last *overlap* bytes of each block are left for the
+    next block, which repeats those bytes along with *overlap* bytes of
+    the data before them (so matches, and the text examined by lookbehind
+    assertions, are expected to extend no more than *overlap* bytes).
+    If *skip_binary* is true, files with a NUL byte in their first few KB
+    are skipped without reading the rest of them.
+
+    Files are searched by a pool of *workers* threads (which mostly helps
+    by overlapping reads, since regular expression searches hold the
+    GIL), with a bounded number of files in flight, and the matches are
+    produced lazily, so the consumer can stop at any point. Setting
+    *workers* to ``0`` (or ``None``) searches files in the current thread
+    instead. Only regular files are searched (following symlinks), using
+    :class:`WalkEntry` stat results where available. Errors opening or
+    reading files are passed to *onerror* (if given) before skipping them.
+
+    For example, to find files that may contain private keys::
+
+        pattern = re.compile(b"-----BEGIN [A-Z ]*PRIVATE KEY-----")
+        for path, offset, data in search_files(walk_iter, pattern):
+            print(path)
+
+    This function does not modify the lists produced by the underlying
+    iterator, and hence supports both top-down/breadth-first and
+    bottom-up/depth-first traversal of the directory hierarchy.
+    """
+    if isinstance(patterns, (bytes, str, type(re.compile(b"")))):
+        patterns = [patterns]
+    patterns = [re.compile(pattern) for pattern in patterns]
+    for pattern in patterns:
+        if not isinstance(pattern.pattern, bytes):
+            msg = "Search patterns must be bytes ({0!r} provided)"
+            raise TypeError(msg.format(pattern.pattern))
+    if not 0 <= overlap < chunk_size:
+        msg = "Overlap not between 0 and the chunk size ({0!r} provided)"
+        raise ValueError(msg.format(overlap))
+    def _arg_iter():
+        for dir_entry in walk_iter:
+            dirpath = dir_entry[0]
+            prefix = None
+            for name in dir_entry[2]:
+                try:
+                    st = _name_stat(dirpath, name)
+                except OSError:
+                    continue
+                if not _stat.S_ISREG(st.st_mode) or not st.st_size:
+                    continue
+                if prefix is None:
+                    prefix = _dir_prefix(dirpath)
+                yield (_search_file, prefix + name, st.st_size, patterns,
+                       chunk_size, overlap, mmap_size, skip_binary, max_count)
+    executor = None
+    window = 1
+    if workers and _futures is not None:
+        executor = _futures.ThreadPoolExecutor(workers)
+        window = 4 * workers
+    results = _bounded_map(executor, _read_in_worker, _arg_iter(), window)
+    try:
+        for path, found, error in results:
+            if error is not None:
+                if onerror is not None:
+                    onerror(error)
+                continue
+            for offset, data in found:
+                yield path, offset, data
+    finally:
+        results.close()
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+# Disk usage
+
+DiskUsage = collections.namedtuple("DiskUsage", "size allocated files dirs")
+
+def _allocated_size(st):
+    blocks = getattr(st, "st_blocks", None)
+    return st.st_size if blocks is None else blocks * 512
+
+def _file_usage(dirpath, files, follow_symlinks, linked):
+    """Total up a single directory, skipping repeated hard links
+
+    The totals include the space used by the directory itself.
+    """
+    size = allocated = count = 0
+    try:
+        if isinstance(dirpath, _EntryName):
+            st = dirpath.stat()
+        else:
+            st = os.stat(dirpath)
+    except OSError:
+        pass
+    else:
+        size = st.st_size
+        allocated = _allocated_size(st)
+    for name in files:
+        try:
+            st = _name_stat(dirpath, name, follow_symlinks)
+        except OSError:
+            continue
+        if st.st_nlink > 1:
+            identity = st.st_dev, st.st_ino
+            if identity in linked:
+                continue
+            linked.add(identity)
+        size += st.st_size
+        allocated += _allocated_size(st)
+        count += 1
+    return [size, allocated, count, 0]
+
+def _add_usage(totals, subdir_totals):
+    """Add the totals for a subdirectory to those of its parent"""
+    totals[0] += subdir_totals[0]
+    totals[1] += subdir_totals[1]
+    totals[2] += subdir_totals[2]
+    totals[3] += subdir_totals[3] + 1
+
+def _parent_prefix(dirpath):
+    """Get the :func:`_dir_prefix` of the parent of *dirpath*"""
+    sep = _path_sep(dirpath)
+    stripped = dirpath.rstrip(sep)
+    return stripped[:stripped.rfind(sep) + 1]
+
+def disk_usage(walk_iter, topdown=True, follow_symlinks=False):
+    """Total up the space used by each directory in the underlying walk
+
+    Produces a ``dirpath, usage`` pair for every directory, where *usage*
+    is a :class:`DiskUsage` tuple for the directory and everything below
+    it that the walk visited:
+
+        - ``size``: the total apparent size of the files and directories,
+          in bytes
+        - ``allocated``: the total space allocated to the files and
+          directories, in bytes (from ``st_blocks``, where the platform
+          provides it)
+        - ``files``: the number of files
+        - ``dirs``: the number of subdirectories (not counting *dirpath*)
+
+    Each directory is reported as soon as its totals are complete, so
+    subdirectories are always reported before their parents (as by
+    ``du``). Totals are rolled up into each parent as its subdirectories
+    are finished, so only the totals for the directories leading to the
+    current one are held in memory.
+
+    *topdown* must match the order of the underlying walk: for a top-down
+    walk, directories are finished once the walk leaves them, while for a
+    bottom-up walk (such as :func:`os.walk` with ``topdown=False``), they
+    are finished as soon as the walk reaches them.
+
+    Stat results are taken from :class:`WalkEntry` names where possible
+    (such as those produced by :func:`attach_stat` with *follow_symlinks*
+    set to the same value), and otherwise fetched with :func:`os.lstat` (or
+    :func:`os.stat` if *follow_symlinks* is true). Files that can't be
+    stat-ed are skipped, and files with several hard links are only
+    counted the first time they're seen. As for ``du``, the totals include
+    the space used by the directories themselves, which needs one more
+    stat call per directory (following symlinks, since the walk went
+    inside the directory).
+    """
+    linked = set()
+    if not topdown:
+        # Stack of [prefix, totals] for the finished subdirectories of the
+        # directories leading to the current one, waiting for their parent
+        pending = []
+        for dir_entry in walk_iter:
+            dirpath = dir_entry[0]
+            prefix = _dir_prefix(dirpath)
+            # A parent is reached before the walk leaves it, so entries the
+            # walk has left are for the parent of a root, which never comes
+            while pending and not prefix.startswith(pending[-1][0]):
+                pending.pop()
+            totals = _file_usage(dirpath, dir_entry[2], follow_symlinks,
+                                 linked)
+            if pending and pending[-1][0] == prefix:
+                subdir_totals = pending.pop()[1]
+                for i in range(4):
+                    totals[i] += subdir_totals[i]
+            yield dirpath, DiskUsage(*totals)
+            if getattr(dir_entry, "depth", None) == 0:
+                continue
+            parent_prefix = _parent_prefix(dirpath)
+            if not pending or pending[-1][0] != parent_prefix:
+                pending.append([parent_prefix, [0, 0, 0, 0]])
+            _add_usage(pending[-1][1], totals)
+        return
+    # Stack of [dirpath, prefix, totals] for the directories leading to
+    # the current one
+    stack = []
+    def _finish():
+        dirpath, _, totals = stack.pop()
+        if stack:
+            _add_usage(stack[-1][2], totals)
+        return dirpath, DiskUsage(*totals)
+    for dir_entry in walk_iter:
+        dirpath = dir_entry[0]
+        while stack and not dirpath.startswith(stack[-1][1]):
+            yield _finish()
+        totals = _file_usage(dirpath, dir_entry[2], follow_symlinks, linked)
+        stack.append([dirpath, _dir_prefix(dirpath), totals])
+    while stack:
+        yield _finish()
+
+# Walking subtrees in separate processes
+
+def _shard_source(top, relparts, ignore_names, followlinks, min_file_depth):
+    """Walk the subtree at *relparts* below *top*, including its ancestors
+
+    The ancestors are reported with just the subdirectory leading to the
+    subtree and any ignore files, so the usual filters see the same path
+    from *top* (and the same ignore rules) as they would in a full walk.
+    """
+    dirpath = top
+    for depth, name in enumerate(relparts):
+        files = [ignore_name for ignore_name in ignore_names
+                     if os.path.isfile(os.path.join(dirpath, ignore_name))]
+        subdirs = [name]
+        yield WalkTriple(dirpath, subdirs, files, depth)
+        if name not in subdirs:
+            # The subtree was pruned by a filter
+            return
+        dirpath = os.path.join(dirpath, name)
+    depth = len(relparts)
+    if _scandir is not None:
+        for dir_entry in _scandir_walk(dirpath, True, None, followlinks,
+                                       depth, min_file_depth):
+            yield dir_entry
+        return
+    prefix = _dir_prefix(dirpath)
+    for subtree_path, subdirs, files in os.walk(dirpath,
+                                                followlinks=followlinks):
+        if subtree_path == dirpath:
+            subtree_depth = depth
+        else:
+            subtree_depth = depth + 1 + subtree_path.count(os.sep, len(prefix))
+        yield WalkTriple(subtree_path, subdirs, files, subtree_depth)
+
+def _encode_triple(fields, dirpath, subdirs, files, depth):
+    fields.append(dirpath)
+    fields.append(str(depth))
+    fields.append(str(len(subdirs)))
+    fields.append(str(len(files)))
+    fields.extend(subdirs)
+    fields.extend(files)
+
+def _decode_triples(batch):
+    fields = batch.split("\0")
+    index = 0
+    while index < len(fields):
+        dirpath = fields[index]
+        depth = int(fields[index + 1])
+        subdirs_start = index + 4
+        files_start = subdirs_start + int(fields[index + 2])
+        index = files_start + int(fields[index + 3])
+        yield WalkTriple(dirpath, fields[subdirs_start:files_start],
+                         fields[files_start:index], depth)
+
+def _walk_shard(top, relparts, kwds, handoff_depth, handoff_dirs, paths):
+    """Walk one shard of a :func:`sharded_walk` in a worker process
+
+    Returns the results as a single ``"\\0"`` separated string, along with
+    the subtrees handed back to the parent process to be walked as new
+    shards (once the walk reaches *handoff_depth*, or once *handoff_dirs*
+    directories have been walked).
+    """
+    kwds = dict(kwds)
+    root_depth = kwds.get("min_depth") or 0
+    min_depth = max(root_depth, len(relparts))
+    kwds["min_depth"] = min_depth or None
+    ignore_names = kwds.get("ignore_files")
+    if ignore_names is None:
+        ignore_names = ()
+        min_file_depth = min_depth
+    else:
+        min_file_depth = 0
+    followlinks = kwds.get("followlinks", False)
+    walk_iter = filtered_walk(_shard_source(top, relparts, ignore_names,
+                                            followlinks, min_file_depth),
+                              **kwds)
+    # Subtrees at the depth limit are reported, but not walked
+    depth_limit = kwds.get("depth")
+    if kwds.get("subtree_depths"):
+        depth_limit = None
+    prefix = _dir_prefix(top)
+    fields = []
+    subtrees = []
+    for dirs_walked, dir_entry in enumerate(walk_iter, 1):
+        dirpath, subdirs, files = dir_entry[0:3]
+        depth = dir_entry.depth
+        if paths is None:
+            _encode_triple(fields, dirpath, subdirs, files, depth)
+        else:
+            # The same paths the flattening iterators would produce
+            if paths != "files" and depth == root_depth:
+                fields.append(dirpath)
+            dir_prefix = _dir_prefix(dirpath)
+            if paths != "dirs":
+                fields.extend([dir_prefix + fname for fname in files])
+            if paths != "files":
+                fields.extend([dir_prefix + subdir for subdir in subdirs])
+        if not subdirs:
+            continue
+        if depth_limit is not None and depth >= depth_limit:
+            continue
+        if ((handoff_depth is not None and depth >= handoff_depth) or
+            (handoff_dirs is not None and dirs_walked >= handoff_dirs)):
+            if depth:
+                dir_relparts = tuple(dirpath[len(prefix):].split(os.sep))
+            else:
+                dir_relparts = ()
+            for subdir in subdirs:
+                if followlinks or not _is_symlink(_subdir_path(dirpath, subdir)):
+                    subtrees.append(dir_relparts + (str(subdir),))
+            subdirs[:] = []
+    return "\0".join(fields), subtrees
+
+_SHARED_STATE_OPTIONS = ("workers", "cache", "stats", "dedup")
+_BUDGET_OPTIONS = ("cursor", "max_dirs", "max_files", "timeout")
+
+def sharded_walk(top, split_depth=1, processes=None, handoff_dirs=1000,
+                 paths=None, **kwds):
+    """Walk the subtrees of *top* with :func:`filtered_walk` in several processes
+
+    The tree is split into shards at *split_depth* levels below *top*
+    (or at the *min_depth* level, if that is deeper), and each shard is
+    walked by a :func:`filtered_walk` pipeline in a
+    :class:`~concurrent.futures.ProcessPoolExecutor` with *processes*
+    worker processes, so filtering and path manipulation aren't limited to
+    a single core. The keyword arguments are passed to
+    :func:`filtered_walk`, and each shard is walked with the same paths
+    from *top* (so path patterns, ignore files, depth limits and symlink
+    loop detection all behave just as they do for a single walk). The
+    arguments must be picklable, so any *predicate* in a *stat_filter*
+    must be a module level function.
+
+    Rather than sending back one tuple per directory, each shard sends its
+    results back to the parent process as a single string. If a worker
+    walks *handoff_dirs* directories without finishing its shard, it hands
+    the remaining subdirectories back to be walked as separate shards, so a
+    single huge subtree is spread across all of the workers rather than
+    being left to one of them (``None`` disables this).
+
+    Produces :class:`WalkTriple` instances in the order the shards complete
+    (each shard is in top-down order), with plain string names. Since the
+    shards have already been walked, changing the subdirectory lists has no
+    effect. If *paths* is ``"files"``, ``"dirs"`` or ``"all"``, the paths
+    :func:`file_paths`, :func:`dir_paths` or :func:`all_paths` would produce
+    are built in the worker processes and produced instead.
+
+    *workers*, *cache*, *stats* and *dedup* rely on state that would need
+    to be shared between processes, so they aren't supported. Neither are
+    the *cursor*, *max_dirs*, *max_files* and *timeout* options, since each
+    shard would apply them separately rather than to the walk as a whole
+    (*handoff_dirs* only controls how the tree is split between workers,
+    and never stops the walk early).
+
+    *top* must be a string, since the shard results are sent back as
+    strings.
+
+    Requires :mod:`concurrent.futures` (or the ``futures`` backport on
+    older versions of Python).
+    """
+    if _futures is None:
+        msg = ("Sharded walks require concurrent.futures (or the futures "
+               "backport)")
+        raise RuntimeError(msg)
+    if isinstance(top, bytes) and bytes is not str:
+        raise TypeError("Sharded walks can't walk bytes paths")
+    if split_depth < 1:
+        msg = "Split depth less than 1 ({0!r} provided)"
+        raise ValueError(msg.format(split_depth))
+    for option in _SHARED_STATE_OPTIONS + _BUDGET_OPTIONS:
+        if kwds.get(option) is not None:
+            msg = "Sharded walks can't use {0!r}"
+            raise ValueError(msg.format(option))
+    if paths not in (None, "files", "dirs", "all"):
+        msg = "Unknown kind of paths: {0!r}"
+        raise ValueError(msg.format(paths))
+    return _sharded_walk(top, split_depth, processes, handoff_dirs, paths,
+                         kwds)
+
+def _sharded_walk(top, split_depth, processes, handoff_dirs, paths, kwds):
+    handoff_depth = max(split_depth - 1, kwds.get("min_depth") or 0)
+    executor = _futures.ProcessPoolExecutor(max_workers=processes)
+    pending = set([executor.submit(_walk_shard, top, (), kwds, handoff_depth,
+                                   handoff_dirs, paths)])
+    try:
+        while pending:
+            done, pending = _futures.wait(pending,
+                                          return_when=_futures.FIRST_COMPLETED)
+            for future in done:
+                batch, subtrees = future.result()
+                for relparts in subtrees:
+                    pending.add(executor.submit(_walk_shard, top, relparts,
+                                                kwds, None, handoff_dirs,
+                                                paths))
+                if not batch:
+                    continue
+                if paths is None:
+                    for dir_entry in _decode_triples(batch):
+                        yield dir_entry
+                else:
+                    for path in batch.split("\0"):
+                        yield path
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+# Asynchronous iteration
+
+class _AsyncIterator(object):
+    """Adapt a synchronous iterable for use with ``async for``
+
+    Items are fetched from the iterable in batches of *batch_size* by running
+    it in *executor* (the event loop's default executor if ``None``), so the
+    event loop is never blocked by the underlying filesystem operations.
+    Concurrent calls take turns with an :class:`asyncio.Lock`, so the
+    iterable is only ever advanced from one thread at a time.
+    """
+    def __init__(self, iterable, batch_size, executor=None):
+        self._iterable = iterable
+        self._iter = None
+        self._batch_size = batch_size
+        self._executor = executor
+        self._buffer = collections.deque()
+        self._exhausted = False
+        self._lock = None
+
+    def __aiter__(self):
+        return self
+
+    def _fetch(self):
+        if self._iter is None:
+            self._iter = iter(self._iterable)
+        return list(itertools.islice(self._iter, self._batch_size))
+
+    def _locked(self, loop, result, callback):
+        """Call *callback* once the lock is held (it must release the lock)"""
+        # The lock is created lazily, as older versions bind it to a loop
+        if self._lock is None:
+            self._lock = _asyncio.Lock()
+        def _acquired(acquire):
+            if acquire.cancelled():
+                result.cancel()
+            elif result.cancelled():
+                self._lock.release()
+            else:
+                callback()
+        acquire = _asyncio.ensure_future(self._lock.acquire())
+        acquire.add_done_callback(_acquired)
+
+    def _fetched(self, fetch, result):
+        self._lock.release()
+        # Batches are kept even if the awaiting task was cancelled
+        if not fetch.cancelled() and fetch.exception() is None:
+            batch = fetch.result()
+            self._buffer.extend(batch)
+            if len(batch) < self._batch_size:
+                self._exhausted = True
+        if result.cancelled():
+            return
+        if fetch.cancelled():
+            result.cancel()
+        elif fetch.exception() is not None:
+            result.set_exception(fetch.exception())
+        else:
+            self._set_next(result)
+
+    def _set_next(self, result):
+        if self._buffer:
+            result.set_result(self._buffer.popleft())
+        else:
+            result.set_exception(StopAsyncIteration())
+
+    def __anext__(self):
+        loop = _asyncio.get_event_loop()
+        result = loop.create_future()
+        def _next():
+            if self._buffer or self._exhausted:
+                self._lock.release()
+                self._set_next(result)
+                return
+            fetch = loop.run_in_executor(self._executor, self._fetch)
+            fetch.add_done_callback(lambda fetch: self._fetched(fetch, result))
+        # While a batch is being fetched, later calls wait their turn
+        unlocked = self._lock is None or not self._lock.locked()
+        if unlocked and (self._buffer or self._exhausted):
+            self._set_next(result)
+        else:
+            self._locked(loop, result, _next)
+        return result
+
+    def aclose(self):
+        """Close the underlying iterator (from the executor)"""
+        self._exhausted = True
+        self._buffer.clear()
+        loop = _asyncio.get_event_loop()
+        result = loop.create_future()
+        def _close():
+            close = getattr(self._iter, "close", None)
+            if close is None:
+                self._lock.release()
+                result.set_result(None)
+                return
+            closing = loop.run_in_executor(self._executor, close)
+            closing.add_done_callback(lambda closing: self._closed(closing,
+                                                                   result))
+        self._locked(loop, result, _close)
+        return result
+
+    def _closed(self, closing, result):
+        self._lock.release()
+        if result.cancelled():
+            return
+        if closing.cancelled():
+            result.cancel()
+        elif closing.exception() is not None:
+            result.set_exception(closing.exception())
+        else:
+            result.set_result(None)
+
+def _sync_walk(walk_iter):
+    """Get the synchronous walk underlying an asynchronous walk"""
+    if isinstance(walk_iter, _AsyncIterator):
+        if walk_iter._iter is not None:
+            raise ValueError("Asynchronous walk has already been started")
+        return walk_iter._iterable
+    return walk_iter
+
+def async_filtered_walk(top, workers=8, batch_size=100, **kwds):
+    """An asynchronous version of :func:`filtered_walk` for use with ``async for``
+
+    Accepts the same keyword arguments as :func:`filtered_walk`, and applies
+    the same filtering, depth limiting and symlink loop handling.
+
+    When *top* is a string, it is walked with :func:`parallel_walk`, so at
+    most *workers* directory listings are in progress at any one time.
+    *workers* is ignored if a *cache* or *cursor* is given, since those
+    walks can't be parallel. The filtering pipeline itself is advanced in
+    the event loop's default executor, *batch_size* triples at a time, so
+    the event loop is never blocked waiting on the filesystem.
+
+    Pass the result to :func:`async_all_paths`, :func:`async_dir_paths` or
+    :func:`async_file_paths` (before starting to iterate over it) to iterate
+    over paths instead.
+
+    Requires :mod:`asyncio` (Python 3.5+ to use ``async for``).
+    """
+    if (isinstance(top, (str, bytes)) and kwds.get("cache") is None and
+            kwds.get("cursor") is None):
+        kwds["workers"] = workers
+    return _AsyncIterator(filtered_walk(top, **kwds), batch_size)
+
+def async_all_paths(walk_iter, batch_size=1000, with_stat=False):
+    """An asynchronous version of :func:`all_paths` for use with ``async for``
+
+    *walk_iter* may be either an ordinary walk iterable or the result of
+    :func:`async_filtered_walk`. Paths are produced from the event loop's
+    default executor, *batch_size* paths at a time. *with_stat* is passed
+    to the synchronous version.
+    """
+    return _AsyncIterator(all_paths(_sync_walk(walk_iter), with_stat), batch_size)
+
+def async_dir_paths(walk_iter, batch_size=1000, with_stat=False):
+    """An asynchronous version of :func:`dir_paths` for use with ``async for``
+
+    *walk_iter* may be either an ordinary walk iterable or the result of
+    :func:`async_filtered_walk`. Paths are produced from the event loop's
+    default executor, *batch_size* paths at a time. *with_stat* is passed
+    to the synchronous version.
+    """
+    return _AsyncIterator(dir_paths(_sync_walk(walk_iter), with_stat), batch_size)
+
+def async_file_paths(walk_iter, batch_size=1000, with_stat=False):
+    """An asynchronous version of :func:`file_paths` for use with ``async for``
+
+    *walk_iter* may be either an ordinary walk iterable or the result of
+    :func:`async_filtered_walk`. Paths are produced from the event loop's
+    default executor, *batch_size* paths at a time. *with_stat* is passed
+    to the synchronous version.
+    """
+    return _AsyncIterator(file_paths(_sync_walk(walk_iter), with_stat), batch_size)
+
+# Snapshots of walk results
+
+SnapshotEntry = collections.namedtuple("SnapshotEntry",
+                                       "path is_dir size mtime_ns ino")
+
+SnapshotDiff = collections.namedtuple("SnapshotDiff", "status path old new")
+
+def snapshot_entries(walk_iter, stat=False):
+    """Iterate over the entries in a walk in snapshot order
+
+    Produces a ``SnapshotEntry(path, is_dir, size, mtime_ns, ino)`` named
+    tuple for every file and subdirectory reported by the underlying walk,
+    with *path* relative to the first directory produced by the walk. The
+    entries are produced in path component order (see :func:`diff_snapshots`)
+    by sorting the subdirectory lists in place, which requires a top-down
+    traversal of the directory hierarchy.
+
+    The *size*, *mtime_ns* and *ino* fields are ``None`` unless *stat* is
+    true, in which case they are taken from :func:`os.lstat` (reusing the
+    cached results for :class:`WalkEntry` names).
+    """
+    for dirpath, path, name, is_dir in _ordered_entries(walk_iter):
+        size = mtime_ns = ino = None
+        if stat:
+            try:
+                st = _name_stat(dirpath, name, follow_symlinks=False)
+            except OSError:
+                pass
+            else:
+                size, mtime_ns, ino = st.st_size, _mtime_ns(st), st.st_ino
+        yield SnapshotEntry(path, is_dir, size, mtime_ns, ino)
+
+_SNAPSHOT_HEADER = b"walkdir-snapshot-1\n"
+_SNAPSHOT_RECORD = struct.Struct("<HHB")
+_SNAPSHOT_STAT = struct.Struct("<qqQ")
+_SNAPSHOT_IS_DIR = 1
+_SNAPSHOT_HAS_STAT = 2
+
+def _common_prefix_length(a, b):
+    limit = min(len(a), len(b))
+    i = 0
+    while i < limit and a[i] == b[i]:
+        i += 1
+    return i
+
+def write_snapshot(walk_iter, filename, stat=False):
+    """Write the entries in a walk to a snapshot file
+
+    The entries are those produced by :func:`snapshot_entries` (which is
+    passed *walk_iter* and *stat*). Paths are stored sorted and prefix
+    compressed (each path only records how much it shares with the previous
+    one), along with the optional size, modification time and inode number.
+    The snapshot is written as the walk proceeds, without holding the
+    entries in memory.
+
+    Returns the number of entries written.
+    """
+    count = 0
+    previous = b""
+    with open(filename, "wb") as f:
+        f.write(_SNAPSHOT_HEADER)
+        for entry in snapshot_entries(walk_iter, stat):
+            path = _fsencode(entry.path)
+            shared = _common_prefix_length(previous, path)
+            flags = _SNAPSHOT_IS_DIR if entry.is_dir else 0
+            if entry.size is not None:
+                flags |= _SNAPSHOT_HAS_STAT
+            f.write(_SNAPSHOT_RECORD.pack(shared, len(path) - shared, flags))
+            f.write(path[shared:])
+            if entry.size is not None:
+                f.write(_SNAPSHOT_STAT.pack(entry.size, entry.mtime_ns,
+                                            entry.ino))
+            previous = path
+            count += 1
+    return count
+
+def read_snapshot(filename):
+    """Iterate over the entries in a snapshot file written by :func:`write_snapshot`
+
+    Produces ``SnapshotEntry(path, is_dir, size, mtime_ns, ino)`` named
+    tuples in the order they were written, reading the file incrementally.
+    Raises :exc:`ValueError` if the file is not a snapshot.
+    """
+    with open(filename, "rb") as f:
+        if f.read(len(_SNAPSHOT_HEADER)) != _SNAPSHOT_HEADER:
+            msg = "{0!r} is not a walkdir snapshot"
+            raise ValueError(msg.format(filename))
+        record_size = _SNAPSHOT_RECORD.size
+        stat_size = _SNAPSHOT_STAT.size
+        path = b""
+        while True:
+            record = f.read(record_size)
+            if not record:
+                break
+            shared, length, flags = _SNAPSHOT_RECORD.unpack(record)
+            path = path[:shared] + f.read(length)
+            size = mtime_ns = ino = None
+            if flags & _SNAPSHOT_HAS_STAT:
+                size, mtime_ns, ino = _SNAPSHOT_STAT.unpack(f.read(stat_size))
+            yield SnapshotEntry(_fsdecode(path), bool(flags & _SNAPSHOT_IS_DIR),
+                                size, mtime_ns, ino)
+
+def _entry_changed(old, new, compare_inodes):
+    if old.is_dir != new.is_dir:
+        return True
+    if old.is_dir or old.size is None or new.size is None:
+        return False
+    if compare_inodes and old.ino != new.ino:
+        return True
+    return old.size != new.size or old.mtime_ns != new.mtime_ns
+
+def diff_snapshots(old, new, compare_inodes=False):
+    """Iterate over the differences between two snapshots
+
+    *old* and *new* may each be the name of a snapshot file written by
+    :func:`write_snapshot`, or an iterable of snapshot entries (such as
+    :func:`snapshot_entries` for a live walk, or :func:`read_snapshot`).
+    Both must be in path component order (that is, sorted as if each path
+    were a sequence of path components).
+
+    Produces a ``SnapshotDiff(status, path, old, new)`` named tuple for each
+    path that was ``"added"``, ``"removed"`` or ``"changed"``, with *old* and
+    *new* set to the relevant snapshot entries (or ``None``). An entry is
+    changed if it switched between being a file and a directory or (if both
+    snapshots include file metadata) if the file size or modification time
+    differs. Inode numbers are only compared if *compare_inodes* is true.
+
+    The snapshots are merged in a single pass, so memory use does not depend
+    on the size of the snapshots.
+    """
+    if isinstance(old, _str_base):
+        old = read_snapshot(old)
+    if isinstance(new, _str_base):
+        new = read_snapshot(new)
+    old = iter(old)
+    new = iter(new)
+    old_entry = next(old, None)
+    new_entry = next(new, None)
+    while old_entry is not None and new_entry is not None:
+        old_key = _path_key(old_entry.path)
+        new_key = _path_key(new_entry.path)
+        if old_key < new_key:
+            yield SnapshotDiff("removed", old_entry.path, old_entry, None)
+            old_entry = next(old, None)
+        elif new_key < old_key:
+            yield SnapshotDiff("added", new_entry.path, None, new_entry)
+            new_entry = next(new, None)
+        else:
+            if _entry_changed(old_entry, new_entry, compare_inodes):
+                yield SnapshotDiff("changed", new_entry.path,
+                                   old_entry, new_entry)
+            old_entry = next(old, None)
+            new_entry = next(new, None)
+    while old_entry is not None:
+        yield SnapshotDiff("removed", old_entry.path, old_entry, None)
+        old_entry = next(old, None)
+    while new_entry is not None:
+        yield SnapshotDiff("added", new_entry.path, None, new_entry)
+        new_entry = next(new, None)
 
 # Legacy API
 iter_dir_paths = dir_paths